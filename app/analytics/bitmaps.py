@@ -0,0 +1,120 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Bitmap indexes over the categorical columns of the ENE microdata. For every value of a column, the rows
+# holding it are a packed bit array (one bit per row), so a filter is a bitwise OR of the bitmaps of the
+# selected values of a column, AND-ed over the filtered columns, and a count is a popcount.
+# Two-way crosstabs count the AND of the row value, column value and filter bitmaps of every cell, or,
+# weighted by the expansion factors, sum the weights of the filtered rows in one bincount over the
+# (row value, column value) cells. Bitmaps are built on the first use of a column.
+
+import threading
+
+import numpy as np
+
+
+# Number of set bits of every byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits, axis=None):
+    # Set bits of packed bit arrays, in total or along axis
+    counts = np.bitwise_count(bits) if hasattr(np, 'bitwise_count') else POPCOUNT[bits]
+    return counts.sum(axis=axis, dtype=np.int64)
+
+
+class ColumnBitmaps:
+    def __init__(self, values):
+        # values: codes of a column, float with NaN for missing values
+        self.values = np.unique(values[~np.isnan(values)]).astype(np.int64)
+        self.position = {int(value): i for i, value in enumerate(self.values)}
+        self.bitmaps = np.empty((len(self.values), (len(values) + 7) // 8), dtype=np.uint8)
+        for i, value in enumerate(self.values):
+            self.bitmaps[i] = np.packbits(values == value)
+        self.bitmaps.flags.writeable = False
+        # Rows with a value
+        self.present = np.packbits(~np.isnan(values))
+        self.present.flags.writeable = False
+
+        # Position of the value of every row among the values, -1 for missing values
+        codes = np.searchsorted(self.values, np.nan_to_num(values, nan=-1))
+        codes = np.where(np.isin(values, self.values), codes, -1)
+        self.codes = codes.astype(np.int16 if len(self.values) < 2**15 else np.int32)
+        self.codes.flags.writeable = False
+
+    @property
+    def nbytes(self):
+        return self.bitmaps.nbytes + self.present.nbytes + self.codes.nbytes
+
+    def union(self, values):
+        # Rows holding any of values
+        rows = [self.position[int(value)] for value in values if int(value) in self.position]
+        if not rows:
+            return np.zeros(self.bitmaps.shape[1], dtype=np.uint8)
+        return np.bitwise_or.reduce(self.bitmaps[rows], axis=0)
+
+
+class BitmapIndex:
+    def __init__(self, columns, weights=None):
+        # columns: {name: codes} of the same length, integer or nullable arrays; weights: expansion factors
+        self.columns = columns
+        self.rows = len(next(iter(columns.values()))) if columns else 0
+        self.weights = None if weights is None else np.nan_to_num(np.asarray(weights, dtype=np.float64))
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+        self.all_rows = np.packbits(np.ones(self.rows, dtype=bool))
+        self.all_rows.flags.writeable = False
+
+    def bitmaps(self, name):
+        column = self._bitmaps.get(name)
+        if column is None:
+            if name not in self.columns:
+                raise ValueError(f'''The microdata has no column {name}''')
+            with self._lock:
+                column = self._bitmaps.get(name)
+                if column is None:
+                    values = self.columns[name]
+                    values = values.to_numpy(dtype=np.float64, na_value=np.nan) if hasattr(values, 'to_numpy') \
+                        else np.asarray(values, dtype=np.float64)
+                    column = self._bitmaps[name] = ColumnBitmaps(values)
+        return column
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in list(self._bitmaps.values())) + self.all_rows.nbytes
+
+    def values(self, name):
+        return self.bitmaps(name).values
+
+    def mask(self, filters=None):
+        # Rows matching all filters {column: [values]}, as a bitmap; a None list of values doesn't filter
+        bits = self.all_rows
+        for name, values in (filters or {}).items():
+            if values is not None:
+                bits = bits & self.bitmaps(name).union(values)
+        return bits
+
+    def count(self, filters=None, present=()):
+        # Rows matching all filters and with a value in every column of present
+        bits = self.mask(filters)
+        for name in present:
+            bits = bits & self.bitmaps(name).present
+        return int(popcount(bits))
+
+    def crosstab(self, row_column, col_column, filters=None, weighted=False):
+        # Row values, column values and the [row value, column value] table of counts or weighted totals
+        rows, cols = self.bitmaps(row_column), self.bitmaps(col_column)
+        bits = self.mask(filters)
+        if weighted:
+            if self.weights is None:
+                raise ValueError('The microdata has no expansion factors')
+            selected = np.unpackbits(bits, count=self.rows).view(bool) & (rows.codes >= 0) & (cols.codes >= 0)
+            index = np.flatnonzero(selected)
+            cells = rows.codes.take(index).astype(np.int64) * len(cols.values) + cols.codes.take(index)
+            table = np.bincount(cells, self.weights.take(index), minlength=len(rows.values) * len(cols.values))
+            return rows.values, cols.values, table.reshape(len(rows.values), len(cols.values))
+
+        table = np.zeros((len(rows.values), len(cols.values)), dtype=np.int64)
+        for i in range(len(rows.values)):
+            table[i] = popcount(cols.bitmaps & (rows.bitmaps[i] & bits), axis=1)
+        return rows.values, cols.values, table
@@ -0,0 +1,54 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Grouping of categorical dimensions into buckets (e.g. tramo_edad into the age groups of age_ranges.csv).
+# Values are mapped to bucket ids with a precompiled lookup array, and all buckets are reduced together
+# in a single pass, so the cost of a request doesn't depend on the number of buckets.
+
+import json
+
+import numpy as np
+import pandas as pd
+
+from analytics import indicators, metrics
+
+
+class Bucketing:
+    def __init__(self, buckets, size):
+        # buckets: list of (label, values), size: number of possible values of the dimension
+        self.labels = [label for label, _ in buckets]
+        self.lookup = np.full(size, -1, dtype=np.int64)
+        for bucket_id, (_, values) in enumerate(buckets):
+            self.lookup[np.asarray(values, dtype=np.int64)] = bucket_id
+        self.lookup.flags.writeable = False
+
+        # One-hot [value, bucket] matrix, values outside all buckets are dropped
+        self.matrix = (self.lookup[:, np.newaxis] == np.arange(len(self.labels))).astype(np.int64)
+        self.matrix.flags.writeable = False
+
+    @classmethod
+    def from_reference(cls, reference, size):
+        # reference: {'[1,2]': '15-24', ...} as read from age_ranges.csv
+        return cls([(label, json.loads(values)) for values, label in reference.items()], size)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def bucket_ids(self, values):
+        return self.lookup[np.asarray(values, dtype=np.int64)]
+
+    @metrics.timed('buckets')
+    def reduce(self, values, axis):
+        # Sums over the values of every bucket along axis, which becomes the bucket axis
+        return np.moveaxis(np.tensordot(values, self.matrix, axes=([axis], [0])), -1, axis)
+
+
+def bucket_rates(cube, region_list, bucketing, names, weighted=False, monthly=False):
+    # Quarterly values, or the values of every moving quarter with monthly, of the indicators in names for
+    # every bucket of the age axis, as a wide frame with (indicator, bucket label) columns
+    counts = bucketing.reduce(cube.age_counts(region_list, weighted), axis=1)
+    rates = indicators.by_period(cube, counts, names, monthly)
+
+    columns = pd.MultiIndex.from_product([list(names), bucketing.labels])
+    index = cube.moving_quarters if monthly else cube.quarters.labels
+    return pd.DataFrame(np.hstack([rates[name] for name in names]), index=index, columns=columns)
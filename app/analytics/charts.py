@@ -0,0 +1,199 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Quarterly chart data shared by the Dash apps. The full quarterly series of a selection is sent once to
+# the browser in a dcc.Store, and the figure for a time period is built from it by the clientside callback
+# dash_clientside.charts.quarterly_figure (static/js/charts.js). build_quarterly_figure() is its
+# server-side counterpart, and both must produce the same figure.
+# Monthly series (one value per moving quarter) keep the quarterly time period slider: the store holds the
+# quarter of every month, and a time period shows the months of the selected quarters.
+# To keep the payloads small, the period labels are sent once in the store, values are rounded to
+# RATE_DIGITS decimals (hundredths of a percentage point) and the averages are two-point lines.
+# The small multiples of the regional comparison are built the same way, by dash_clientside.charts.grid_figure
+# from the periods and the values of every panel in a store, with build_grid_figure() as its counterpart.
+
+import bisect
+
+import numpy as np
+
+from analytics import metrics
+
+
+# Style of the dotted lines showing the average of a series over the time period
+AVERAGE_STYLE = {'line': {'color': 'rgba(153, 153, 153, 0.5)', 'width': 2, 'dash': 'dot'},
+                 'name': 'average', 'legendgroup': 'group3'}
+
+# Confidence bands: a lower bound line and an upper bound line filled down to it, both hidden in the legend
+BAND_STYLE = {'mode': 'lines', 'line': {'width': 0}, 'showlegend': False, 'hoverinfo': 'skip'}
+BAND_OPACITY = 0.15
+
+CHART_LAYOUT = {'legend': {'x': 1.01, 'y': 0.5, 'orientation': 'v'}, 'margin': {'t': 80}}
+
+RATE_DIGITS = 4
+
+
+def get_age_str(min_age, max_age):
+    # Label of the ages min_age..max_age of the age sliders and chart titles
+    if min_age == 12:
+        return '70+'
+    elif max_age == 12:
+        return f'''{10 + min_age * 5}-70+'''
+    else:
+        return f'''{10 + min_age * 5}-{15 + max_age * 5}'''
+
+
+def json_values(values, digits=RATE_DIGITS):
+    # Rates as a JSON-friendly list rounded to digits decimals, missing values as None
+    values = np.round(np.asarray(values, dtype=float), digits)
+    return [None if np.isnan(v) else float(v) for v in values]
+
+
+def band_color(style):
+    # Fill color of the confidence band of a series, its line color made transparent
+    color = style.get('line', {}).get('color', 'rgb(153, 153, 153)')
+    if color.startswith('rgb('):
+        return f'''rgba({color[4:-1]}, {BAND_OPACITY})'''
+    return f'''rgba(153, 153, 153, {BAND_OPACITY})'''
+
+
+@metrics.timed('chart_data')
+def quarterly_chart_data(quarters, title, series, y_range=None, months=None, month_quarters=None):
+    # series: list of {'y': quarterly (or monthly) values, 'style': trace properties, 'average': draw its average line,
+    #                  'margin': half width of its confidence band, or None}
+    # y_range: fixed range of the y axis, or None to scale it to the series maximum in the time period
+    # months, month_quarters: labels of the months and position of their quarters, for monthly series
+    return {
+        'quarters': [str(quarter) for quarter in quarters],
+        'months': None if months is None else [str(month) for month in months],
+        'month_quarters': None if month_quarters is None else [int(position) for position in month_quarters],
+        'title': title,
+        'series': [{'y': json_values(s['y']), 'style': s['style'], 'average': s.get('average', False),
+                    'band': None if s.get('margin') is None else
+                    {'margin': json_values(s['margin']), 'fillcolor': band_color(s['style'])}}
+                   for s in series],
+        'y_range': y_range,
+        'average_style': AVERAGE_STYLE,
+        'band_style': BAND_STYLE,
+        'layout': CHART_LAYOUT,
+    }
+
+
+def _mean(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else None
+
+
+@metrics.timed('figure')
+def build_quarterly_figure(chart_data, date_range=None):
+    quarters = chart_data['quarters']
+    if date_range is None:
+        date_range = [0, len(quarters) - 1]
+    first, last = date_range[0], date_range[1] + 1
+    periods = quarters
+    if chart_data.get('months') is not None:
+        # Months of the quarters first..last - 1
+        periods = chart_data['months']
+        first = bisect.bisect_left(chart_data['month_quarters'], first)
+        last = bisect.bisect_left(chart_data['month_quarters'], last)
+    x = periods[first:last]
+
+    chart_mode = 'lines' if len(x) > 10 else 'lines+markers'
+    x_range = [-1, len(x)] if len(x) > 10 else [-0.1*len(x), len(x) - 1 + 0.1*len(x)]
+
+    bands, traces, averages, maxima = [], [], [], []
+    for series in chart_data['series']:
+        y = np.array([np.nan if v is None else v for v in series['y'][first:last]], dtype=float)
+        traces.append(dict({'x': x, 'y': series['y'][first:last], 'mode': chart_mode}, **series['style']))
+        if series.get('band'):
+            margin = np.array([np.nan if v is None else v for v in series['band']['margin'][first:last]], dtype=float)
+            upper = y + margin
+            band_style = dict(chart_data['band_style'])
+            if 'legendgroup' in series['style']:
+                band_style['legendgroup'] = series['style']['legendgroup']
+            bands.append(dict({'x': x, 'y': json_values(y - margin)}, **band_style))
+            bands.append(dict({'x': x, 'y': json_values(upper), 'fill': 'tonexty',
+                               'fillcolor': series['band']['fillcolor']}, **band_style))
+            if len(upper) and not np.isnan(upper).all():
+                maxima.append(float(np.nanmax(upper)))
+        if len(y) and not np.isnan(y).all():
+            maxima.append(float(np.nanmax(y)))
+        if series['average']:
+            average = dict({'x': x[:1] + x[-1:], 'y': [_mean(y)] * len(x[:1] + x[-1:]), 'mode': 'lines'},
+                           **chart_data['average_style'])
+            if averages:
+                average['showlegend'] = False
+            averages.append(average)
+
+    y_range = chart_data['y_range']
+    if y_range is None:
+        max_value = max(maxima) if maxima else 0
+        y_range = [-0.02 * max_value, 1.1 * max_value]
+
+    return {
+        'data': bands + traces + averages,
+        'layout': dict({'title': {'text': chart_data['title']},
+                        'xaxis': {'showgrid': False, 'range': x_range},
+                        'yaxis': {'tickformat': ',.0%', 'range': y_range}},
+                       **chart_data['layout'])
+    }
+
+
+@metrics.timed('chart_data')
+def grid_chart_data(periods, title, panel_titles, series, cols=4, y_range=None):
+    # Small multiples sharing their axes: one panel per title, drawn in rows of cols panels
+    # series: list of {'y': values [period, panel], 'style': trace properties}, shown in the legend once
+    # y_range: fixed range of the y axes, or None to scale them all to the maximum of all panels
+    # The periods are sent once for all panels, the traces get them back in the browser
+    if y_range is None:
+        maxima = [float(np.nanmax(s['y'])) for s in series if np.size(s['y']) and not np.isnan(s['y']).all()]
+        max_value = max(maxima) if maxima else 0
+        y_range = [-0.02 * max_value, 1.1 * max_value]
+    return {
+        'periods': [str(period) for period in periods],
+        'title': title,
+        'panel_titles': list(panel_titles),
+        'series': [{'y': [json_values(np.asarray(s['y'], dtype=float)[:, panel]) for panel in range(len(panel_titles))],
+                    'style': s['style']}
+                   for s in series],
+        'cols': cols,
+        'y_range': y_range,
+    }
+
+
+@metrics.timed('figure')
+def build_grid_figure(chart_data):
+    # Server-side counterpart of the clientside callback dash_clientside.charts.grid_figure
+    x = chart_data['periods']
+    panel_titles = chart_data['panel_titles']
+    cols = chart_data['cols']
+    rows = (len(panel_titles) + cols - 1) // cols
+    gap = 0.02
+    data, annotations = [], []
+    layout = {'title': {'text': chart_data['title']}, 'showlegend': True,
+              'legend': {'orientation': 'h', 'x': 0.5, 'xanchor': 'center', 'y': -0.05},
+              'margin': {'t': 80, 'l': 50, 'r': 20, 'b': 40}}
+
+    for panel, panel_title in enumerate(panel_titles):
+        row, col = divmod(panel, cols)
+        suffix = '' if panel == 0 else str(panel + 1)
+        x_domain = [col / cols + gap, (col + 1) / cols - gap]
+        y_domain = [1 - (row + 1) / rows + 2 * gap, 1 - row / rows - 2 * gap]
+        layout[f'''xaxis{suffix}'''] = {'domain': x_domain, 'anchor': f'''y{suffix}''', 'showgrid': False,
+                                        'nticks': 3, 'tickangle': 0, 'showticklabels': row == rows - 1}
+        layout[f'''yaxis{suffix}'''] = {'domain': y_domain, 'anchor': f'''x{suffix}''', 'tickformat': ',.0%',
+                                        'showticklabels': col == 0}
+        if panel:
+            layout[f'''xaxis{suffix}''']['matches'] = 'x'
+            layout[f'''yaxis{suffix}''']['matches'] = 'y'
+        annotations.append({'text': panel_title, 'x': sum(x_domain) / 2, 'y': y_domain[1], 'xref': 'paper',
+                            'yref': 'paper', 'xanchor': 'center', 'yanchor': 'bottom', 'showarrow': False})
+
+        for i, s in enumerate(chart_data['series']):
+            data.append(dict({'x': x, 'y': s['y'][panel], 'mode': 'lines', 'xaxis': f'''x{suffix}''',
+                              'yaxis': f'''y{suffix}''', 'legendgroup': f'''series{i}''', 'showlegend': panel == 0},
+                             **s['style']))
+
+    if panel_titles:
+        layout['yaxis']['range'] = chart_data['y_range']
+    layout['annotations'] = annotations
+    return {'data': data, 'layout': layout}
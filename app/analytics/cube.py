@@ -0,0 +1,183 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Dense data cube over the aggregated ENE data, indexed [month, region, tramo_edad, metric].
+# Counts are stored as cumulative sums over the age axis and rolled up for every region or zone
+# from regions.csv, so a region selection and an age range reduce to a single subtraction.
+# When the aggregate has the weighted totals (w_<metric> columns, sums of the expansion factors), they are
+# stored in a second plane of the same layout, so weighted selections cost the same as unweighted ones.
+# The prefix sums and rollups can be given prebuilt, e.g. memory-mapped from the binary snapshot
+# (analytics/snapshot.py), so the workers share them instead of building a private copy each.
+
+import json
+
+import numpy as np
+
+from analytics import metrics
+from analytics.periods import QuarterIndex, moving_quarter_labels
+
+
+WEIGHTED_PREFIX = 'w_'
+
+
+class EneCube:
+    def __init__(self, agg, count_columns, regions, arrays=None):
+        self.metrics = tuple(count_columns)
+        self.metric_index = {metric: i for i, metric in enumerate(self.metrics)}
+
+        # Month axis, in chronological order
+        month_keys = agg['year'].to_numpy(dtype=np.int64) * 12 + agg['month'].to_numpy(dtype=np.int64) - 1
+        month_axis, month_pos = np.unique(month_keys, return_inverse=True)
+        self.years = month_axis // 12
+        self.months = month_axis % 12 + 1
+
+        # Quarter of every month on the month axis, and the moving quarter centred on every month
+        self.quarters = QuarterIndex(self.years, self.months)
+        self.moving_quarters = moving_quarter_labels(self.years, self.months)
+        self.moving_quarters.flags.writeable = False
+
+        region = agg['region'].to_numpy(dtype=np.int64)
+        age = agg['tramo_edad'].to_numpy(dtype=np.int64)
+        self.region_ids = np.arange(1, region.max() + 1)
+        self.ages = np.arange(0, age.max() + 1)
+
+        # Weighted plane, when the aggregate has a weighted total for every metric
+        self.has_weights = all(f'''{WEIGHTED_PREFIX}{metric}''' in agg for metric in self.metrics)
+
+        cells = (month_pos, region - 1, age)
+        shape = (len(month_axis), len(self.region_ids), len(self.ages), len(self.metrics))
+        prefix_shape = (shape[0], shape[1], shape[2] + 1, shape[3])
+        arrays = arrays or {}
+        unique_cells = None
+        self.prefixes = {}
+        for weighted in ([False, True] if self.has_weights else [False]):
+            dtype = np.float64 if weighted else np.int64
+            prefix = arrays.get(self.array_name('prefix', weighted))
+            # Prebuilt arrays of another layout are built again
+            if prefix is None or prefix.shape != prefix_shape or prefix.dtype != dtype:
+                if unique_cells is None:
+                    unique_cells = len(np.unique(np.ravel_multi_index(cells, shape[:3]))) == len(month_pos)
+                columns = [f'''{WEIGHTED_PREFIX}{metric}''' for metric in self.metrics] if weighted else self.metrics
+                prefix = self.build_prefix(agg, columns, cells, shape, unique_cells, dtype)
+            self.prefixes[weighted] = prefix
+        self.prefix = self.prefixes[False]
+
+        # Rollups over the regions and zones offered in the region selector
+        self.rollups = {weighted: {} for weighted in self.prefixes}
+        rollup_shape = prefix_shape[:1] + prefix_shape[2:]
+        for key in regions:
+            region_key = self.region_key(json.loads(key))
+            for weighted in self.prefixes:
+                rollup = arrays.get(self.array_name('rollup', weighted, region_key))
+                if rollup is None or rollup.shape != rollup_shape or rollup.dtype != self.prefixes[weighted].dtype:
+                    rollup = self.sum_regions(region_key, weighted)
+                self.rollups[weighted][region_key] = rollup
+
+    @staticmethod
+    def build_prefix(agg, columns, cells, shape, unique_cells, dtype):
+        cube = np.zeros(shape, dtype=dtype)
+        values = np.column_stack([agg[column].to_numpy(dtype=dtype) for column in columns])
+        if unique_cells:
+            cube[cells] = values
+        else:
+            np.add.at(cube, cells, values)
+
+        # prefix[:, r, a] holds the counts of ages below a, so ages lo..hi are prefix[:, r, hi + 1] - prefix[:, r, lo]
+        prefix = np.zeros((shape[0], shape[1], shape[2] + 1, shape[3]), dtype=dtype)
+        np.cumsum(cube, axis=2, out=prefix[:, :, 1:])
+        prefix.flags.writeable = False
+        return prefix
+
+    @staticmethod
+    def array_name(kind, weighted, region_key=None):
+        # 'prefix.counts', 'rollup.weighted.1-2-3'...
+        name = f'''{kind}.{'weighted' if weighted else 'counts'}'''
+        return f'''{name}.{'-'.join(str(r) for r in region_key)}''' if region_key is not None else name
+
+    def arrays(self):
+        # {name: array} of the prefix sums and rollups, as given back to EneCube(arrays=)
+        arrays = {self.array_name('prefix', weighted): prefix for weighted, prefix in self.prefixes.items()}
+        for weighted, rollups in self.rollups.items():
+            for region_key, rollup in rollups.items():
+                arrays[self.array_name('rollup', weighted, region_key)] = rollup
+        return arrays
+
+    @property
+    def nbytes(self):
+        return sum(prefix.nbytes for prefix in self.prefixes.values()) + \
+            sum(rollup.nbytes for rollups in self.rollups.values() for rollup in rollups.values())
+
+    def region_key(self, region_list):
+        # [0] stands for the whole country
+        if list(region_list) == [0]:
+            return tuple(int(r) for r in self.region_ids)
+        return tuple(sorted(set(int(r) for r in region_list)))
+
+    def sum_regions(self, region_key, weighted=False):
+        rollup = self.prefixes[weighted][:, np.array(region_key) - 1].sum(axis=1)
+        rollup.flags.writeable = False
+        return rollup
+
+    def region_prefix(self, region_list, weighted=False):
+        # weighted selects the plane of the weighted totals, KeyError when the data has no weights
+        region_key = self.region_key(region_list)
+        rollup = self.rollups[weighted].get(region_key)
+        return rollup if rollup is not None else self.sum_regions(region_key, weighted)
+
+    @staticmethod
+    def age_runs(ages):
+        # Split a set of ages into contiguous [lo, hi] runs
+        ages = sorted(set(int(a) for a in ages))
+        runs = []
+        for age in ages:
+            if runs and runs[-1][1] == age - 1:
+                runs[-1][1] = age
+            else:
+                runs.append([age, age])
+        return runs
+
+    @metrics.timed('counts')
+    def counts(self, region_list, age_range, weighted=False):
+        # Monthly counts [month, metric] for regions in region_list and ages age_range[0]..age_range[1]
+        prefix = self.region_prefix(region_list, weighted)
+        return prefix[:, age_range[1] + 1] - prefix[:, age_range[0]]
+
+    @metrics.timed('counts')
+    def region_counts(self, age_range, weighted=False):
+        # Monthly counts [month, region, metric] of every region, for ages age_range[0]..age_range[1]
+        prefix = self.prefixes[weighted]
+        return prefix[:, :, age_range[1] + 1] - prefix[:, :, age_range[0]]
+
+    @metrics.timed('counts')
+    def region_age_counts(self, weighted=False):
+        # Counts by single age of every region, [month, region, tramo_edad, metric]
+        return np.diff(self.prefixes[weighted], axis=2)
+
+    def select(self, region_list, age_range, weighted=False):
+        # Same as counts(), as {metric: array}
+        return dict(zip(self.metrics, self.counts(region_list, age_range, weighted).T))
+
+    def select_ages(self, region_list, ages, weighted=False):
+        # Same as select(), for an arbitrary list of ages
+        prefix = self.region_prefix(region_list, weighted)
+        counts = sum(prefix[:, hi + 1] - prefix[:, lo] for lo, hi in self.age_runs(ages))
+        return dict(zip(self.metrics, counts.T))
+
+    @metrics.timed('counts')
+    def age_counts(self, region_list, weighted=False):
+        # Counts by single age for regions in region_list, [month, tramo_edad, metric]
+        return np.diff(self.region_prefix(region_list, weighted), axis=1)
+
+    @staticmethod
+    def ratio(numerator, denominator):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1.0 * numerator / denominator
+
+    def quarterly_mean(self, values):
+        # Average of the monthly values inside each quarter, ignoring months without data.
+        # values has months on its first axis, and may have any number of other axes.
+        valid = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(valid, values, 0.0), self.quarters.starts, axis=0)
+        counts = np.add.reduceat(valid.astype(np.int64), self.quarters.starts, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
@@ -0,0 +1,284 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Process-wide in-memory store for the aggregated ENE data and its reference tables.
+# The data is loaded and typed once per process and shared read-only by all Dash apps.
+
+import hashlib
+import io
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+
+from analytics import metrics, snapshot, standard_errors
+from analytics.bucketing import Bucketing
+from analytics.cube import WEIGHTED_PREFIX, EneCube
+
+
+logger = logging.getLogger(__name__)
+
+app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CSV_DIR = os.path.join(app_path, 'data', 'csv')
+AGG_FILE = os.path.join(CSV_DIR, 'agg_by_gender_age_month_region.zip')
+REGIONS_FILE = os.path.join(CSV_DIR, 'regions.csv')
+AGE_RANGES_FILE = os.path.join(CSV_DIR, 'age_ranges.csv')
+
+# Dimension columns of the aggregate and the narrowest types holding their values,
+# all other columns are respondent counts
+KEY_DTYPES = {
+    'year': np.uint16,
+    'month': np.uint8,
+    'region': np.uint8,
+    'tramo_edad': np.uint8,
+}
+
+# 'auto' reads the binary snapshot when it was built from the current CSV and falls back to the CSV,
+# 'csv' and 'snapshot' force one of them, 'sql' aggregates the ene table of the database
+DATA_SOURCE = os.environ.get('ENE_DATA_SOURCE', 'auto')
+
+
+class EneDataset:
+    def __init__(self, agg, regions, age_ranges, version, source=None, cube_arrays=None):
+        self.agg = agg
+        self.source = source
+        self.regions = MappingProxyType(regions)
+        self.age_ranges = MappingProxyType(age_ranges)
+        self.cube = EneCube(agg, self.count_columns, regions, cube_arrays)
+        self.age_buckets = Bucketing.from_reference(age_ranges, size=len(self.cube.ages))
+        self.region_names = {self.cube.region_key(json.loads(key)): name for key, name in regions.items()}
+        self.version = version
+        self.load_seconds = None
+        # Standard errors of the rates for the confidence bands, None without analytics/variance.py results
+        self.standard_errors = None
+
+    @property
+    def quarters(self):
+        # Labels of all quarters in the data, in chronological order
+        return self.cube.quarters.labels
+
+    @property
+    def moving_quarters(self):
+        # Labels of all moving quarters in the data, one per month, in chronological order
+        return self.cube.moving_quarters
+
+    @property
+    def month_quarters(self):
+        # Position among the quarters of the quarter of every month
+        return self.cube.quarters.position
+
+    @property
+    def count_columns(self):
+        # Respondent counts; the weighted totals w_<column>, when present, are the second plane of the cube
+        return [column for column in self.agg.columns
+                if column not in KEY_DTYPES and not column.startswith(WEIGHTED_PREFIX)]
+
+    @property
+    def has_weights(self):
+        return self.cube.has_weights
+
+    @metrics.timed('margins')
+    def confidence_margin(self, name, region_list, ages, weighted=False, monthly=False):
+        # Half width of the 95% confidence band of rate name for every quarter, None if it was not estimated.
+        # The standard errors are estimated for the calendar quarters only, so monthly series have no band.
+        if self.standard_errors is None or monthly:
+            return None
+        return self.standard_errors.margin(self.quarters, name, self.cube.region_key(region_list), ages, weighted)
+
+    def region_name(self, region_list):
+        region_key = self.cube.region_key(region_list)
+        if region_key in self.region_names:
+            return self.region_names[region_key]
+        # Selections that are not offered in regions.csv are named after their regions
+        return ', '.join(self.region_names.get((r,), str(r)).strip() for r in region_key)
+
+    @property
+    def memory_bytes(self):
+        se_bytes = self.standard_errors.nbytes if self.standard_errors is not None else 0
+        return int(self.agg.memory_usage(index=True, deep=True).sum()) + self.cube.nbytes + se_bytes
+
+
+_current = None
+_lock = threading.Lock()
+# Dataset pinned in a thread, e.g. for a whole request while a reload swaps the current one
+_pinned = threading.local()
+
+
+def process_rss_bytes():
+    # Current resident set size of this process; peak RSS where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def file_version(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+def dataset_version(data_version, references, standard_errors_version):
+    # Version of the aggregate data and of the reference and standard error files it was read with
+    extra = json.dumps([references, standard_errors_version], sort_keys=True)
+    return f'''{data_version}-{hashlib.sha1(extra.encode()).hexdigest()[:8]}'''
+
+
+def narrow_dtype(values):
+    # Smallest unsigned type holding all counts of a column, weighted totals are kept as they are
+    if values.dtype.kind == 'f':
+        return np.float64
+    if len(values) and values.min() < 0:
+        return np.int64
+    return np.min_scalar_type(values.max() if len(values) else 0)
+
+
+def read_only_frame(frame):
+    columns = {}
+    for column in frame.columns:
+        values = frame[column].to_numpy()
+        values = np.ascontiguousarray(values, dtype=KEY_DTYPES.get(column) or narrow_dtype(values))
+        values.flags.writeable = False
+        columns[column] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def read_reference(path, index_col):
+    # {key: label} of a reference CSV, and the version of the content read
+    with open(path, 'rb') as f:
+        content = f.read()
+    reference = pd.read_csv(io.BytesIO(content), index_col=index_col)
+    return dict(reference[reference.columns[0]]), hashlib.sha1(content).hexdigest()[:12]
+
+
+def read_references():
+    # Regions and age ranges, with the versions of their files (the references of a snapshot)
+    regions, regions_version = read_reference(REGIONS_FILE, 'id')
+    age_ranges, age_ranges_version = read_reference(AGE_RANGES_FILE, 'range')
+    return regions, age_ranges, {'regions': regions_version, 'age_ranges': age_ranges_version}
+
+
+def reference_versions():
+    return {'regions': file_version(REGIONS_FILE), 'age_ranges': file_version(AGE_RANGES_FILE)}
+
+
+def read_csv_sources(agg_file=AGG_FILE):
+    agg = read_only_frame(pd.read_csv(agg_file))
+    regions, age_ranges, references = read_references()
+    return agg, regions, age_ranges, file_version(agg_file), references
+
+
+def read_sql_sources():
+    from app import db
+    from analytics import sql_aggregates
+
+    agg = read_only_frame(sql_aggregates.read_aggregates(db))
+    version = hashlib.sha1(pd.util.hash_pandas_object(agg, index=False).to_numpy().tobytes()).hexdigest()[:12]
+    regions, age_ranges, references = read_references()
+    return agg, regions, age_ranges, version, references
+
+
+def read_sources(source=DATA_SOURCE):
+    if source == 'sql':
+        return 'sql', read_sql_sources()
+    if source != 'csv':
+        try:
+            sources = snapshot.load()
+        except snapshot.SnapshotError as e:
+            if source == 'snapshot':
+                raise
+            logger.info(f'''{e}, reading the CSV files''')
+        else:
+            try:
+                csv_version = file_version(AGG_FILE)
+            except OSError:
+                csv_version = None
+            try:
+                references = reference_versions()
+            except OSError:
+                references = None
+            if source == 'snapshot' or (csv_version in (None, sources[3]) and references in (None, sources[4])):
+                return 'snapshot', sources
+            if csv_version not in (None, sources[3]):
+                logger.warning(f'''Snapshot {sources[3]} is older than the CSV {csv_version}, reading the CSV files''')
+            else:
+                # The region groupings and age ranges of the snapshot, and its cube rollups, are out of date
+                logger.warning(f'''Snapshot {sources[3]} was built from other reference files, reading the CSV files''')
+    return 'csv', read_csv_sources()
+
+
+def read_cube_arrays(source, version, references):
+    # Prebuilt cube of the snapshot, None to build it
+    if source != 'snapshot':
+        return None
+    try:
+        return snapshot.load_cube(version, references)
+    except snapshot.SnapshotError as e:
+        logger.warning(f'''{e}, building the data cube''')
+        return None
+
+
+def read_dataset(source=DATA_SOURCE):
+    # The version is the one of the aggregate data and of the reference and standard error files it was read
+    # from (those of the manifest for a snapshot), so the cached figures and the ETags of a dataset are not served
+    # for another with new labels or confidence bands
+    start = time.perf_counter()
+    source, (agg, regions, age_ranges, data_version, references) = read_sources(source)
+    se = standard_errors.read_standard_errors()
+    version = dataset_version(data_version, references, se.version if se is not None else None)
+    ds = EneDataset(agg, regions, age_ranges, version, source=source,
+                    cube_arrays=read_cube_arrays(source, data_version, references))
+    ds.standard_errors = se
+    ds.load_seconds = time.perf_counter() - start
+    return ds
+
+
+def _load():
+    global _current
+    ds = read_dataset()
+    _current = ds
+    logger.info(f'''ENE dataset {ds.version} loaded from {ds.source} in {ds.load_seconds:.3f}s: {len(ds.agg)} rows, '''
+                f'''{ds.memory_bytes / 2**20:.2f} MiB in memory, process RSS {process_rss_bytes() / 2**20:.1f} MiB''')
+    return ds
+
+
+def load():
+    # (Re)load the dataset from disk and make it the current one for this process
+    with _lock:
+        return _load()
+
+
+def replace(ds):
+    # Make ds the current dataset of this process, e.g. a synthetic one of tools/benchmark.py
+    global _current
+    with _lock:
+        _current = ds
+    return ds
+
+
+def pin(ds=None):
+    # Make get() return ds, or the current dataset, in this thread until unpin()
+    _pinned.ds = ds if ds is not None else get()
+    return _pinned.ds
+
+
+def unpin():
+    _pinned.ds = None
+
+
+def get():
+    # Dataset shared by all callbacks of this process, loaded on first use if not preloaded
+    ds = getattr(_pinned, 'ds', None)
+    if ds is not None:
+        return ds
+    ds = _current
+    if ds is None:
+        with _lock:
+            ds = _current if _current is not None else _load()
+    return ds
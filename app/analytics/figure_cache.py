@@ -0,0 +1,232 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Bounded LRU cache for the chart figures shared by all Dash apps.
+# Keys are built from normalized chart parameters and the dataset version, so reloading the data
+# invalidates all cached figures. The size bound is set with ENE_FIGURE_CACHE_SIZE (number of figures).
+# During a hot reload (analytics/reloader.py) the cache holds the figures of two versions: those of the
+# new version are computed before it is swapped in, while the requests in flight finish on the old one.
+# The figures of a version are dropped when a newer one replaces it (retire), or when a third one is seen.
+# Misses are single-flight: while a figure is computed, the threads of the process asking for the same
+# figure wait for that computation and share its result instead of computing it again. A waiting thread
+# computes the figure itself after ENE_SINGLE_FLIGHT_TIMEOUT seconds.
+# The lookups and computations of every memoized function are recorded in the metrics of analytics/metrics.py.
+
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from analytics import dataset, metrics
+
+
+DEFAULT_MAX_ENTRIES = 1024
+MAX_VERSIONS = 2
+DEFAULT_FLIGHT_TIMEOUT = 30
+
+
+class FigureCache:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # Versions with figures in the cache, oldest first, and the versions replaced by a reload
+        self.versions = []
+        self.retired = set()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, version, key):
+        with self._lock:
+            if version not in self.versions and version not in self.retired:
+                self._add_version(version)
+            try:
+                value = self._entries[(version, key)]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((version, key))
+            self.hits += 1
+            return value
+
+    def put(self, version, key, value):
+        with self._lock:
+            # The dataset was replaced while the figure was computed: don't keep it
+            if version not in self.versions:
+                return
+            self._entries[(version, key)] = value
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _add_version(self, version):
+        self.versions.append(version)
+        while len(self.versions) > MAX_VERSIONS:
+            self._drop(self.versions.pop(0))
+
+    def _drop(self, version):
+        keys = [key for key in self._entries if key[0] == version]
+        if keys:
+            self.invalidations += 1
+        for key in keys:
+            del self._entries[key]
+
+    def activate(self, version):
+        # Cache the figures of version, a new one or one replaced before and now loaded again
+        with self._lock:
+            self.retired.discard(version)
+            if version not in self.versions:
+                self._add_version(version)
+
+    def retire(self, version):
+        # Drop the figures of a version replaced by a reload, and don't cache it again
+        with self._lock:
+            if version in self.versions:
+                self.versions.remove(version)
+            self.retired.add(version)
+            self._drop(version)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Raised in the threads waiting for a computation that failed, from the exception of the computing thread
+class FlightError(RuntimeError):
+    pass
+
+
+class Flight:
+    # One computation in progress, and its outcome for the threads waiting for it
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiting = 0
+
+
+class SingleFlight:
+    def __init__(self, timeout=DEFAULT_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.computations = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def do(self, key, func):
+        # Result of func(), computed once for all the threads calling do() with key at the same time
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.computations += 1
+            else:
+                flight.waiting += 1
+                self.coalesced += 1
+
+        if not leader:
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    raise FlightError(f'''Computation of {key!r} failed in another thread''') from flight.error
+                return flight.result
+            with self._lock:
+                self.timeouts += 1
+            return func()
+
+        try:
+            flight.result = func()
+            return flight.result
+        except BaseException as e:
+            # Interrupted too, the waiting threads must not take the missing result for None
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'computations': self.computations,
+                'coalesced': self.coalesced,
+                'timeouts': self.timeouts,
+            }
+
+
+cache = FigureCache(int(os.environ.get('ENE_FIGURE_CACHE_SIZE', DEFAULT_MAX_ENTRIES)))
+flights = SingleFlight(float(os.environ.get('ENE_SINGLE_FLIGHT_TIMEOUT', DEFAULT_FLIGHT_TIMEOUT)))
+
+lookups = metrics.counter('ene_figure_cache_lookups_total', 'Figure cache lookups by memoized function and result',
+                          ['function', 'result'])
+compute_seconds = metrics.histogram('ene_figure_compute_seconds', 'Time to compute a figure missing from the cache',
+                                    ['function'])
+
+
+def canonical_regions(region_list):
+    # '[15,1,2]' from the region dropdown, [2, 1] and (1, 2) all give the same sorted list
+    if isinstance(region_list, str):
+        region_list = json.loads(region_list)
+    regions = sorted(set(int(r) for r in region_list))
+    return [0] if regions == [0] else regions
+
+
+def freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
+
+
+def memoize(func):
+    # Cache the figures returned by func; the cached figure is shared, callers must not modify it
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        if 'region_list' in bound.arguments:
+            bound.arguments['region_list'] = canonical_regions(bound.arguments['region_list'])
+        key = (func.__module__, func.__name__) + tuple((name, freeze(value)) for name, value in bound.arguments.items())
+
+        version = dataset.get().version
+        figure = cache.get(version, key)
+        if figure is not None:
+            lookups.inc(func.__name__, 'hit')
+            return figure
+        lookups.inc(func.__name__, 'miss')
+        return flights.do((version, key), lambda: compute(version, key, bound))
+
+    def compute(version, key, bound):
+        start = time.perf_counter()
+        figure = func(*bound.args, **bound.kwargs)
+        compute_seconds.observe(time.perf_counter() - start, func.__name__)
+        cache.put(version, key, figure)
+        return figure
+
+    wrapper.uncached = func
+    return wrapper
@@ -0,0 +1,140 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Registry of the labour market indicators shown in the Dash apps. Every indicator is declared as a sum of
+# aggregate columns, or as a ratio of two such sums. A set of indicators is compiled into numerator and
+# denominator weight matrices, so all of them are computed in one matrix product over the selected counts,
+# whatever the region, age or bucket dimensions of the selection.
+
+import functools
+
+import numpy as np
+
+from analytics.metrics import timed
+
+
+class Indicator:
+    def __init__(self, name, numerator, denominator=None, label=None):
+        # numerator, denominator: {column: weight}, a list of columns means weight 1 for each
+        self.name = name
+        self.numerator = numerator if isinstance(numerator, dict) else {column: 1 for column in numerator}
+        self.denominator = denominator if denominator is None or isinstance(denominator, dict) \
+            else {column: 1 for column in denominator}
+        self.label = label or name.replace('_', ' ')
+
+    @property
+    def is_ratio(self):
+        return self.denominator is not None
+
+
+class Gap:
+    # Difference between two indicators, e.g. between men and women
+    def __init__(self, name, minuend, subtrahend, label=None):
+        self.name = name
+        self.minuend = minuend
+        self.subtrahend = subtrahend
+        self.label = label or name.replace('_', ' ')
+
+
+INDICATORS = {}
+
+
+def register(indicator):
+    INDICATORS[indicator.name] = indicator
+    return indicator
+
+
+# Workforce participation: share of the population that is employed or looking for a job
+register(Indicator('participation_rate', ['is_workforce'], ['total']))
+register(Indicator('participation_rate_m', ['male_workforce'], ['male']))
+register(Indicator('participation_rate_f', ['female_workforce'], ['female']))
+
+# Unemployment: share of the workforce without a job
+register(Indicator('unemployment_rate', ['unemployed'], ['is_workforce']))
+register(Indicator('unemployment_rate_m', ['male_unemployed'], ['male_workforce']))
+register(Indicator('unemployment_rate_f', ['female_unemployed'], ['female_workforce']))
+
+# Employment: share of the population with a job
+register(Indicator('employment_rate', ['employed'], ['total']))
+register(Indicator('employment_rate_m', ['male_employed'], ['male']))
+register(Indicator('employment_rate_f', ['female_employed'], ['female']))
+
+# Inactivity: share of the population out of the workforce
+register(Indicator('inactivity_rate', ['not_workforce'], ['total']))
+register(Indicator('inactivity_rate_m', {'male': 1, 'male_workforce': -1}, ['male']))
+register(Indicator('inactivity_rate_f', {'female': 1, 'female_workforce': -1}, ['female']))
+
+# Gender gaps, in percentage points
+register(Gap('participation_gender_gap', 'participation_rate_m', 'participation_rate_f'))
+register(Gap('unemployment_gender_gap', 'unemployment_rate_f', 'unemployment_rate_m'))
+register(Gap('employment_gender_gap', 'employment_rate_m', 'employment_rate_f'))
+
+# Counts
+register(Indicator('population', ['total']))
+register(Indicator('workforce', ['is_workforce']))
+register(Indicator('unemployed', ['unemployed']))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_indicators(metrics, names):
+    # Numerator and denominator weights [metric, indicator] of all indicators needed for names
+    metric_index = {metric: i for i, metric in enumerate(metrics)}
+    base = []
+    for name in names:
+        indicator = INDICATORS[name]
+        for base_name in ([indicator.minuend, indicator.subtrahend] if isinstance(indicator, Gap) else [name]):
+            if base_name not in base:
+                base.append(base_name)
+
+    numerators = np.zeros((len(metrics), len(base)))
+    denominators = np.zeros((len(metrics), len(base)))
+    for i, name in enumerate(base):
+        indicator = INDICATORS[name]
+        for column, weight in indicator.numerator.items():
+            numerators[metric_index[column], i] = weight
+        if indicator.is_ratio:
+            for column, weight in indicator.denominator.items():
+                denominators[metric_index[column], i] = weight
+        else:
+            # Sums are divided by 1
+            denominators[:, i] = np.nan
+    numerators.flags.writeable = False
+    denominators.flags.writeable = False
+    return base, numerators, denominators
+
+
+def compute(metrics, counts, names):
+    # Values of the indicators in names for counts [..., metric], as {name: array [...]}
+    names = tuple(names)
+    base, numerators, denominators = compile_indicators(tuple(metrics), names)
+
+    values = counts @ numerators
+    is_ratio = ~np.isnan(denominators[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values[..., is_ratio] /= counts @ denominators[:, is_ratio]
+    by_name = {name: values[..., i] for i, name in enumerate(base)}
+
+    result = {}
+    for name in names:
+        indicator = INDICATORS[name]
+        if isinstance(indicator, Gap):
+            result[name] = by_name[indicator.minuend] - by_name[indicator.subtrahend]
+        else:
+            result[name] = by_name[name]
+    return result
+
+
+def quarterly(cube, counts, names):
+    # Quarterly means of the monthly indicator values, for counts with months on the first axis
+    return {name: cube.quarterly_mean(values) for name, values in compute(cube.metrics, counts, names).items()}
+
+
+def monthly(cube, counts, names):
+    # Indicator values of the moving quarter of every month, for counts with months on the first axis.
+    # The counts of a month already sum the three months of its moving quarter.
+    return compute(cube.metrics, counts, names)
+
+
+@timed('indicators')
+def by_period(cube, counts, names, monthly_periods=False):
+    return monthly(cube, counts, names) if monthly_periods else quarterly(cube, counts, names)
@@ -0,0 +1,282 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Bulk loader of the INE ENE microdata files (one CSV per moving quarter, optionally zipped or gzipped)
+# into the ene table of create_db.sql / create_db_sqlite.sql.
+# Files are streamed in chunks of bounded size; the INE column names are normalized onto the schema
+# (case, accents, spaces), columns missing in a period (a6_otro_covid, estrato_unico, the mercado/s_formal
+# block of 2019-12...) are left NULL, and values are narrowed to the declared tinyint/smallint/int widths,
+# out of range values being stored as NULL. Chunks are inserted with a single executemany, or with
+# LOAD DATA LOCAL INFILE on MySQL.
+# Every file is loaded in one transaction together with its row in ene_load_log, so an interrupted load
+# is resumed by running the same command again: files already loaded are skipped, changed files replace
+# the periods they loaded before.
+#
+#   cd app && python -m analytics.ingest [--db-url sqlite:///ene.db] [--chunk-size 50000] [--load-data] files or dirs
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import unicodedata
+import zipfile
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from analytics import schema
+
+
+CHUNK_SIZE = 50000
+SEPARATORS = [';', ',', '\t', '|']
+FILE_SUFFIXES = ('.csv', '.csv.gz', '.zip', '.txt')
+# Characters decoded to choose the encoding of a file: the INE headers are ASCII, the first accented values
+# come in the rows
+SNIFF_SIZE = 2**16
+
+# Files loaded into ene, one row per file, written in the same transaction as its rows. Created here on the
+# first load, on MySQL and SQLite alike, and not in create_db*.sql.
+LOAD_LOG_DDL = '''create table if not exists ene_load_log (
+    file_name varchar(255) primary key not null,
+    file_version char(40) not null,  -- SHA-1 of the file content
+    periods varchar(1024),  -- JSON list of the [ano_trimestre, mes_central] loaded from the file
+    rows_loaded int,
+    seconds float,
+    loaded_at timestamp default current_timestamp
+)'''
+
+PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+
+def normalize_column(name):
+    # INE headers differ between periods in case, accents and separators: 'AÑO_TRIMESTRE', 'Region', 'mes central'
+    name = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    return name.strip().strip('"').strip().lower().replace(' ', '_').replace('-', '_').replace('.', '_')
+
+
+def open_text(path, encoding):
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        return io.TextIOWrapper(archive.open(archive.namelist()[0]), encoding=encoding)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding=encoding)
+    return open(path, encoding=encoding)
+
+
+def sniff(path):
+    # Separator, decimal mark, encoding and header of a source file
+    for encoding in ('utf-8-sig', 'latin-1'):
+        try:
+            with open_text(path, encoding) as f:
+                header = f.readline()
+                f.read(SNIFF_SIZE)
+            break
+        except UnicodeDecodeError:
+            continue
+    sep = max(SEPARATORS, key=header.count)
+    columns = next(csv.reader([header], delimiter=sep))
+    decimal = ',' if sep == ';' else '.'
+    return sep, decimal, encoding, columns
+
+
+def file_version(path):
+    # Hash of the file content, read in blocks
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(FILE_SUFFIXES))
+        else:
+            files.append(path)
+    return files
+
+
+class SourceFile:
+    def __init__(self, path, columns=schema.ENE_COLUMNS):
+        self.path = path
+        self.sep, self.decimal, self.encoding, header = sniff(path)
+        self.source_columns = {}
+        self.unknown_columns = []
+        for source_name in header:
+            name = normalize_column(source_name)
+            if name in columns and name not in self.source_columns.values():
+                self.source_columns[source_name] = name
+            else:
+                self.unknown_columns.append(source_name)
+        self.columns = [columns[name] for name in self.source_columns.values()]
+        self.missing_columns = [name for name in columns if name not in self.source_columns.values()]
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        # Frames of at most chunk_size rows with the schema columns present in the file, narrowed to the schema types
+        text_columns = {source_name: str for source_name, name in self.source_columns.items()
+                        if schema.ENE_COLUMNS[name].is_text}
+        reader = pd.read_csv(self.path, sep=self.sep, decimal=self.decimal, encoding=self.encoding,
+                             usecols=list(self.source_columns), dtype=text_columns, skipinitialspace=True,
+                             chunksize=chunk_size, low_memory=False)
+        for chunk in reader:
+            chunk = chunk.rename(columns=self.source_columns)
+            yield narrow(chunk[[column.name for column in self.columns]], self.columns)
+
+
+def narrow(chunk, columns):
+    # Values converted to the type of their column, returned with the number of values set to NULL per column
+    nulled = {}
+    narrowed = {}
+    for column in columns:
+        values = chunk[column.name]
+        if column.is_text:
+            values = values.str.strip()
+            narrowed[column.name] = values.where(values.notna() & (values != ''), None)
+            continue
+        if values.dtype == object:
+            values = values.where(values.isna(), values.astype(str)).str.strip().str.replace(',', '.', regex=False)
+        numbers = pd.to_numeric(values, errors='coerce')
+        valid = numbers.notna()
+        if np.issubdtype(column.dtype, np.integer):
+            info = np.iinfo(column.dtype)
+            valid &= (numbers >= info.min) & (numbers <= info.max) & (numbers == numbers.round())
+        elif column.unsigned:
+            valid &= numbers >= 0
+        lost = int((values.notna() & ~valid).sum())
+        if lost:
+            nulled[column.name] = lost
+        narrowed[column.name] = numbers.where(valid).astype(column.nullable_dtype)
+    return pd.DataFrame(narrowed, index=chunk.index), nulled
+
+
+def insert_sql(engine, table, names):
+    placeholder = PLACEHOLDERS[engine.dialect.paramstyle]
+    return f'''insert into {table} ({', '.join(names)}) values ({', '.join([placeholder] * len(names))})'''
+
+
+def insert_chunk(cursor, sql, frame):
+    # One executemany per chunk, with NULL for missing values
+    values = frame.astype(object).where(frame.notna(), None)
+    cursor.executemany(sql, list(values.itertuples(index=False, name=None)))
+
+
+def load_data_chunk(cursor, table, frame):
+    # MySQL bulk path: the chunk is written as a tab separated file and read by the server in one statement
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8', delete=False) as f:
+        frame.to_csv(f, sep='\t', header=False, index=False, na_rep='\\N', quoting=csv.QUOTE_NONE, escapechar='\\')
+        path = f.name
+    try:
+        cursor.execute(f'''load data local infile %s into table {table} character set utf8mb4
+            fields terminated by '\\t' escaped by '\\\\' lines terminated by '\\n' ({', '.join(frame.columns)})''',
+                       (path,))
+    finally:
+        os.remove(path)
+
+
+def read_load_log(engine):
+    with engine.begin() as connection:
+        connection.execute(sa.text(LOAD_LOG_DDL))
+        rows = connection.execute(sa.text('select file_name, file_version, periods from ene_load_log')).fetchall()
+    return {file_name: (file_version, json.loads(periods or '[]')) for file_name, file_version, periods in rows}
+
+
+def delete_periods(cursor, engine, periods):
+    placeholder = PLACEHOLDERS[engine.dialect.paramstyle]
+    cursor.executemany(f'''delete from ene where ano_trimestre = {placeholder} and mes_central = {placeholder}''',
+                       [tuple(period) for period in periods])
+
+
+def load_file(engine, path, version, replace_periods=(), chunk_size=CHUNK_SIZE, load_data=False, report=print):
+    # Loads one file in a single transaction, returns the number of rows
+    source = SourceFile(path)
+    if source.unknown_columns:
+        report(f'''  columns not in the schema, skipped: {', '.join(source.unknown_columns)}''')
+    if source.missing_columns:
+        report(f'''  {len(source.missing_columns)} schema columns not in the file, left NULL''')
+    sql = insert_sql(engine, 'ene', [column.name for column in source.columns])
+
+    start = time.perf_counter()
+    rows = 0
+    periods = set()
+    nulled = {}
+    with engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        if replace_periods:
+            delete_periods(cursor, engine, replace_periods)
+        for frame, chunk_nulled in source.chunks(chunk_size):
+            if load_data:
+                load_data_chunk(cursor, 'ene', frame)
+            else:
+                insert_chunk(cursor, sql, frame)
+            rows += len(frame)
+            if 'ano_trimestre' in frame and 'mes_central' in frame:
+                keys = frame[['ano_trimestre', 'mes_central']].dropna().drop_duplicates()
+                periods.update((int(year), int(month)) for year, month in keys.itertuples(index=False, name=None))
+            for name, count in chunk_nulled.items():
+                nulled[name] = nulled.get(name, 0) + count
+        seconds = time.perf_counter() - start
+        connection.execute(sa.text('delete from ene_load_log where file_name = :file_name'),
+                           {'file_name': os.path.basename(path)})
+        connection.execute(sa.text('''insert into ene_load_log (file_name, file_version, periods, rows_loaded, seconds)
+            values (:file_name, :file_version, :periods, :rows_loaded, :seconds)'''),
+                           {'file_name': os.path.basename(path), 'file_version': version,
+                            'periods': json.dumps(sorted(periods)), 'rows_loaded': rows, 'seconds': seconds})
+
+    for name, count in sorted(nulled.items()):
+        report(f'''  {count} values of {name} out of the range of its type, stored as NULL''')
+    report(f'''  {rows} rows in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} rows/s), '''
+           f'''periods {', '.join(f'{year}-{month:02d}' for year, month in sorted(periods))}''')
+    return rows
+
+
+def load_files(engine, paths, chunk_size=CHUNK_SIZE, load_data=False, report=print):
+    loaded = read_load_log(engine)
+    start = time.perf_counter()
+    total = 0
+    for path in source_files(paths):
+        name = os.path.basename(path)
+        version = file_version(path)
+        previous = loaded.get(name)
+        if previous is not None and previous[0] == version:
+            report(f'''{name}: already loaded, skipped''')
+            continue
+        report(f'''{name}: {'changed, replacing its periods' if previous is not None else 'loading'}''')
+        total += load_file(engine, path, version, previous[1] if previous is not None else (),
+                           chunk_size, load_data, report)
+    seconds = time.perf_counter() - start
+    report(f'''{total} rows loaded in {seconds:.1f}s ({total / max(seconds, 1e-9):.0f} rows/s)''')
+    return total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m analytics.ingest', description='Load INE ENE CSV files into the ene table')
+    parser.add_argument('paths', nargs='+', help='CSV files or directories with CSV files')
+    parser.add_argument('--db-url', help='database URL, the app database by default')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows read and inserted at a time')
+    parser.add_argument('--load-data', action='store_true', help='insert with LOAD DATA LOCAL INFILE (MySQL)')
+    args = parser.parse_args(argv[1:])
+
+    if args.db_url:
+        engine = sa.create_engine(args.db_url)
+    else:
+        from app import db as engine
+    if args.load_data:
+        if engine.dialect.name != 'mysql':
+            parser.error('--load-data is only supported on MySQL')
+        engine = sa.create_engine(engine.url, connect_args={'local_infile': True})
+
+    load_files(engine, args.paths, args.chunk_size, args.load_data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,177 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Latency histograms and counters of the hot paths, kept in the memory of the process and rendered in the
+# Prometheus text format by the /metrics endpoint (dash_apps/instrumentation.py). Recording a timing takes
+# two perf_counter calls and a few additions under a lock, cheap enough to leave on in production.
+# The stages timed while a request is served are also summed for its Server-Timing header.
+#   @metrics.timed('counts')
+#   def counts(...):
+#   with metrics.timer('crosstab'):
+# Every gunicorn worker keeps its own metrics, a scrape reports those of the worker serving it.
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds of the histogram buckets, in seconds: 50 us to 10 s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+# Metrics in the order they are rendered
+REGISTRY = []
+
+_request = threading.local()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'''{name}="{escape(value)}"''' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def metric_lines(name, kind, help, samples):
+    # Prometheus text of a metric: samples are (labels {name: value}, value)
+    lines = [f'''# HELP {name} {help}''', f'''# TYPE {name} {kind}''']
+    for labels, value in samples:
+        lines.append(f'''{name}{format_labels(labels.keys(), labels.values())} {format_value(value)}''')
+    return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values: [counts of every bucket and of +Inf, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def lines(self):
+        with self._lock:
+            series = [(values, list(counts), total) for values, (counts, total) in sorted(self._series.items())]
+        lines = [f'''# HELP {self.name} {self.help}''', f'''# TYPE {self.name} histogram''']
+        for values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self.labels, values, [('le', format_value(float(bound)))])
+                lines.append(f'''{self.name}_bucket{labels} {cumulative}''')
+            lines.append(f'''{self.name}_sum{format_labels(self.labels, values)} {total!r}''')
+            lines.append(f'''{self.name}_count{format_labels(self.labels, values)} {cumulative}''')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f'''# HELP {self.name} {self.help}''', f'''# TYPE {self.name} counter'''] + \
+            [f'''{self.name}{format_labels(self.labels, labels)} {value}''' for labels, value in values]
+
+
+def histogram(name, help, labels=()):
+    metric = Histogram(name, help, labels)
+    REGISTRY.append(metric)
+    return metric
+
+
+def counter(name, help, labels=()):
+    metric = Counter(name, help, labels)
+    REGISTRY.append(metric)
+    return metric
+
+
+stage_seconds = histogram('ene_stage_seconds', 'Time spent in a stage of the chart and crosstab computations',
+                          ['stage'])
+
+
+def start_request():
+    # Collect the stages timed from now on in this thread, for the Server-Timing header of the request
+    _request.stages = {}
+
+
+def stop_request():
+    # {stage: seconds} timed in this thread since start_request()
+    stages = getattr(_request, 'stages', None)
+    _request.stages = None
+    return stages or {}
+
+
+def record(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+    add_request_time(stage, seconds)
+
+
+def add_request_time(stage, seconds):
+    stages = getattr(_request, 'stages', None)
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    # Decorator recording the time of every call of a function as stage
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def render(collectors=()):
+    # Prometheus text of all the registered metrics, followed by the lines of every collector()
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.lines()
+    for collector in collectors:
+        lines += collector()
+    return '\n'.join(lines) + '\n'
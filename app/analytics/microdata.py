@@ -0,0 +1,279 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Compact frames and ad-hoc crosstabs over the ENE microdata of the ene table.
+# read_microdata() reads only the columns a query needs, in chunks, each one converted to the narrowest
+# type of create_db.sql (tinyint codes -> UInt8, smallint -> UInt16, fact -> float32...) instead of the
+# int64/object columns of pandas defaults; free text columns are dropped or read as categoricals.
+# The categorical columns offered for crosstabs of a period (the moving quarter of an ano_trimestre and
+# mes_central) are read once that way and indexed with bitmaps (analytics/bitmaps.py); the last periods read
+# are kept in memory. Coded values are labelled from the ene_* reference tables of create_db_reference.sql.
+
+import argparse
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from analytics import metrics, schema
+from analytics.bitmaps import BitmapIndex
+from analytics.figure_cache import SingleFlight
+
+
+logger = logging.getLogger(__name__)
+
+# Categorical columns offered in the crosstabs
+CROSSTAB_COLUMNS = [
+    'region', 'tipo', 'sexo', 'tramo_edad', 'parentesco', 'est_conyugal', 'nivel', 'cine', 'nacionalidad',
+    'activ', 'cae_general', 'cae_especifico', 'categoria_ocupacion', 'sector', 'ocup_form',
+    'b1', 'b8', 'b9', 'r_p_rev4cl_caenes', 'c1', 'e9',
+]
+WEIGHT_COLUMNS = ['fact_cal', 'fact']
+
+# Reference tables missing from the foreign keys of create_db.sql
+REFERENCES = {'cae_especifico': 'ene_cae_especifico'}
+
+# Number of periods (moving quarters) kept indexed in memory
+CACHED_PERIODS = 6
+
+# Rows fetched and converted at a time
+CHUNK_SIZE = 100000
+
+# Seconds the periods of the ene table are kept before they are read again, so the periods loaded since show up
+PERIODS_TTL = 300
+
+
+def column_reference(name):
+    return REFERENCES.get(name) or schema.ENE_COLUMNS[name].reference
+
+
+def column_label(name):
+    # Description of a column from create_db.sql, without its reference note
+    description = schema.ENE_COLUMNS[name].description.split('(Ref')[0].strip().rstrip(',')
+    return f'''{name}: {description}''' if description else name
+
+
+def tramo_edad_labels():
+    labels = {0: 'under 15'}
+    labels.update({age: f'''{10 + age * 5}-{14 + age * 5}''' for age in range(1, 12)})
+    labels[12] = '70+'
+    return labels
+
+
+# {(engine, table): labels} of the reference tables read, the failed reads are tried again
+_labels = {}
+# Tables already reported missing
+_missing_labels = set()
+
+
+def read_labels(engine, table):
+    # {code: label} of a reference table, English labels first; empty when the table can't be read or is empty
+    labels = _labels.get((engine, table))
+    if labels is not None:
+        return labels
+    try:
+        with engine.connect() as connection:
+            result = connection.execute(sa.text(f'''select * from {table}'''))
+            columns = list(result.keys())
+            rows = result.fetchall()
+    except sa.exc.SQLAlchemyError as e:
+        if table not in _missing_labels:
+            _missing_labels.add(table)
+            logger.warning(f'''No labels from {table}: {e}''')
+        return {}
+    names = [column for column in columns if column.endswith('_name')] or \
+        [column for column in columns if column.endswith('_name_es')] or columns[1:2]
+    labels = {}
+    if names:
+        label_index = columns.index(names[0])
+        labels = {int(row[0]): str(row[label_index]) for row in rows if row[0] is not None}
+    _labels[(engine, table)] = labels
+    return labels
+
+
+def value_labels(engine, name):
+    if name == 'tramo_edad':
+        return tramo_edad_labels()
+    reference = column_reference(name)
+    return read_labels(engine, reference) if reference else {}
+
+
+def compact_column(values, column, text='drop'):
+    # Fetched values of a column in its narrow type, missing values kept
+    if column.is_text:
+        return pd.Series(values, dtype=object).astype('category') if text == 'category' else None
+    if np.dtype(column.dtype).itemsize == 8 and np.issubdtype(column.dtype, np.integer):
+        # bigint identifiers may not be exact as float64
+        return pd.Series(pd.array(values, dtype=column.nullable_dtype))
+    values = np.array(values, dtype=np.float64)
+    if np.issubdtype(column.dtype, np.integer):
+        missing = np.isnan(values)
+        return pd.Series(pd.arrays.IntegerArray(np.where(missing, 0, values).astype(column.dtype), missing))
+    return pd.Series(values.astype(column.dtype))
+
+
+def read_microdata(engine, columns, where=None, params=None, text='drop', chunk_size=CHUNK_SIZE):
+    # Frame of columns of the ene table for the rows matching where, each column in its narrow type
+    unknown = [name for name in columns if name not in schema.ENE_COLUMNS]
+    if unknown:
+        raise ValueError(f'''Unknown columns of the ene table: {', '.join(unknown)}''')
+    columns = [name for name in columns if text != 'drop' or not schema.ENE_COLUMNS[name].is_text]
+    query = f'''select {', '.join(columns)} from ene''' + (f''' where {where}''' if where else '')
+
+    chunks = {name: [] for name in columns}
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(sa.text(query), params or {})
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for name, values in zip(columns, zip(*rows)):
+                column = schema.ENE_COLUMNS[name]
+                # Text is categorized once at the end, categories of the chunks would differ
+                chunks[name].append(list(values) if column.is_text else compact_column(values, column))
+
+    frame = {}
+    for name in columns:
+        column = schema.ENE_COLUMNS[name]
+        if column.is_text:
+            frame[name] = compact_column([value for values in chunks[name] for value in values], column, text)
+        elif chunks[name]:
+            frame[name] = pd.concat(chunks[name], ignore_index=True)
+        else:
+            frame[name] = compact_column([], column)
+        chunks[name] = None
+    return pd.DataFrame(frame)
+
+
+def memory_report(frame):
+    # Bytes of every column of a compact frame, and of the int64/object column pandas would read by default
+    report = pd.DataFrame({
+        'dtype': frame.dtypes.astype(str),
+        'bytes': frame.memory_usage(index=False, deep=True),
+        'default_bytes': [frame[name].astype(object).memory_usage(index=False, deep=True)
+                          if schema.ENE_COLUMNS[name].is_text else len(frame) * 8 for name in frame.columns],
+    })
+    report.loc['total'] = ['', report['bytes'].sum(), report['default_bytes'].sum()]
+    report['ratio'] = (report['bytes'] / report['default_bytes']).round(3)
+    return report
+
+
+def read_period(engine, year, month, columns=CROSSTAB_COLUMNS):
+    # {column: values} of the microdata of the moving quarter centred on month of year, in the types of
+    # create_db.sql, and the expansion factors. A respondent is in 3 overlapping moving quarters, and the
+    # expansion factors of every one add up to the population: one period is counted and weighted at a time.
+    frame = read_microdata(engine, list(columns) + WEIGHT_COLUMNS, 'ano_trimestre = :year and mes_central = :month',
+                           {'year': int(year), 'month': int(month)})
+    data = {name: frame[name] for name in columns}
+    weights = frame['fact_cal'].fillna(frame['fact']).to_numpy(np.float32)
+    return data, weights
+
+
+class MicrodataIndex:
+    # Bitmap indexes of the last (year, month) periods read, shared by all requests of the process
+    def __init__(self, engine_factory, cached_periods=CACHED_PERIODS):
+        self.engine_factory = engine_factory
+        self.cached_periods = cached_periods
+        self._indexes = OrderedDict()
+        self._periods = None
+        self._periods_read = None
+        self._lock = threading.Lock()
+        # Reading a period takes as long as it takes, the requests waiting for it don't read it again
+        self._flights = SingleFlight(timeout=None)
+
+    @property
+    def engine(self):
+        return self.engine_factory()
+
+    def periods(self):
+        # (year, month) periods of the ene table, in order; read again after PERIODS_TTL seconds, only successful
+        # reads are kept
+        with self._lock:
+            if self._periods is not None and time.monotonic() - self._periods_read < PERIODS_TTL:
+                return self._periods
+        with self.engine.connect() as connection:
+            rows = connection.execute(sa.text('''select distinct ano_trimestre, mes_central from ene''')).fetchall()
+        periods = sorted((int(year), int(month)) for year, month in rows if year is not None and month is not None)
+        with self._lock:
+            self._periods, self._periods_read = periods, time.monotonic()
+        return periods
+
+    def is_indexed(self, period):
+        with self._lock:
+            return tuple(period) in self._indexes
+
+    def get(self, period):
+        # The lock only guards the indexes: a period is read once for all the requests asking for it at the same
+        # time, while the indexed periods are served
+        period = tuple(period)
+        with self._lock:
+            index = self._indexes.get(period)
+            if index is not None:
+                self._indexes.move_to_end(period)
+                return index
+        return self._flights.do(period, functools.partial(self._load, period))
+
+    def _load(self, period):
+        start = time.perf_counter()
+        with metrics.timer('microdata_index'):
+            data, weights = read_period(self.engine, *period)
+            index = BitmapIndex(data, weights if np.isfinite(weights).any() else None)
+        # Labels of all the columns read now, the missing reference tables are reported once here
+        for name in CROSSTAB_COLUMNS:
+            value_labels(self.engine, name)
+        with self._lock:
+            self._indexes[period] = index
+            while len(self._indexes) > self.cached_periods:
+                self._indexes.popitem(last=False)
+        logger.info(f'''ENE microdata of {period[0]}-{period[1]:02d} indexed in {time.perf_counter() - start:.2f}s: '''
+                    f'''{index.rows} rows''')
+        return index
+
+    def crosstab(self, period, row_column, col_column, filters=None, weighted=False):
+        # Labelled crosstab of a (year, month) period as a frame, with the number of rows matching the filters in
+        # the table
+        index = self.get(period)
+        with metrics.timer('crosstab'):
+            rows, cols, table = index.crosstab(row_column, col_column, filters, weighted)
+        row_labels = value_labels(self.engine, row_column)
+        col_labels = value_labels(self.engine, col_column)
+        frame = pd.DataFrame(table, index=[row_labels.get(int(v), str(v)) for v in rows],
+                             columns=[col_labels.get(int(v), str(v)) for v in cols])
+        # Respondents of the table: those without a row or column value are not in it
+        return frame, index.count(filters, present=(row_column, col_column))
+
+
+def app_engine():
+    from app import db
+    return db
+
+
+microdata_index = MicrodataIndex(app_engine)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m analytics.microdata',
+                                     description='Read ENE microdata in compact types and report its memory by column')
+    parser.add_argument('columns', nargs='*', help='columns of the ene table, all by default')
+    parser.add_argument('--db-url', help='database URL, the app database by default')
+    parser.add_argument('--year', type=int, help='only the rows of a year')
+    parser.add_argument('--text', choices=['drop', 'category'], default='drop', help='free text columns')
+    args = parser.parse_args(argv[1:])
+
+    engine = sa.create_engine(args.db_url) if args.db_url else app_engine()
+    start = time.perf_counter()
+    where, params = ('ano_trimestre = :year', {'year': args.year}) if args.year else (None, None)
+    frame = read_microdata(engine, args.columns or list(schema.ENE_COLUMNS), where, params, args.text)
+    print(memory_report(frame).to_string())
+    print(f'''{len(frame)} rows read in {time.perf_counter() - start:.2f}s''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,53 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Period indexing shared by all Dash apps: calendar quarters computed from year/month columns in one
+# vectorized pass. Quarter keys are year * 4 + quarter - 1, so they sort chronologically and stay the same
+# for a given quarter whatever the data loaded.
+# Every month of the data is the moving quarter (trimestre móvil) centred on it, as published by INE:
+# the aggregate of mes_central 2 of 2010 holds the respondents of January to March 2010.
+
+import numpy as np
+
+
+MONTH_NAMES = np.array(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+
+
+def quarter_keys(year, month):
+    year = np.asarray(year, dtype=np.int64)
+    month = np.asarray(month, dtype=np.int64)
+    return year * 4 + (month - 1) // 3
+
+
+def quarter_labels(keys):
+    # 'Q1 2010' style labels for an array of quarter keys
+    keys = np.asarray(keys, dtype=np.int64)
+    quarter = np.char.add('Q', (keys % 4 + 1).astype(str))
+    return np.char.add(np.char.add(quarter, ' '), (keys // 4).astype(str))
+
+
+def moving_quarter_labels(year, month):
+    # 'Jan-Mar 2010' style labels of the moving quarters centred on every (year, month), with both years
+    # for the quarters across the new year: 'Dec 2009-Feb 2010', 'Nov 2010-Jan 2011'
+    year = np.asarray(year, dtype=np.int64)
+    month = np.asarray(month, dtype=np.int64)
+    first_year = np.where(month == 1, year - 1, year).astype(str)
+    last_year = np.where(month == 12, year + 1, year).astype(str)
+    first = MONTH_NAMES[(month - 2) % 12]
+    last = np.char.add(np.char.add(MONTH_NAMES[month % 12], ' '), last_year)
+    first = np.where((month == 1) | (month == 12), np.char.add(np.char.add(first, ' '), first_year), first)
+    return np.char.add(np.char.add(first, '-'), last)
+
+
+class QuarterIndex:
+    # Maps every (year, month) row to the position of its quarter among all quarters present.
+    # For rows sorted by date, starts holds the first row of every quarter.
+    def __init__(self, year, month):
+        self.keys, self.starts, self.position = np.unique(quarter_keys(year, month), return_index=True,
+                                                          return_inverse=True)
+        self.position = self.position.reshape(-1)
+        self.labels = quarter_labels(self.keys)
+        self.labels.flags.writeable = False
+
+    def __len__(self):
+        return len(self.keys)
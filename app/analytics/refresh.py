@@ -0,0 +1,265 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Incremental refresh of the aggregate CSV from the ene table. Every (ano_trimestre, mes_central) period of
+# the table gets a fingerprint computed from the (ano_trimestre, mes_central, region, tramo_edad, sexo, activ)
+# index only: a hash of the row count of every (region, tramo_edad, sexo, activ) cell of the period, which
+# changes whenever the aggregates of the period change. Fingerprints are compared with the ones stored next to the CSV, and
+# only the new or changed periods are aggregated again and replaced in the CSV, periods removed from the
+# table are dropped. The new CSV gets a new version, which invalidates the figure caches and the snapshot.
+# Weighted aggregates also fingerprint the exact sum of the expansion factors of every cell.
+# Only the periods of the files loaded, replaced or deleted in ene_load_log (analytics/ingest.py) since the last
+# refresh are fingerprinted again, the others keep their stored fingerprints; all periods are fingerprinted
+# when the load log can't be read or is empty, and with --scan-all for changes made outside the loader.
+# A full refresh keeps the periods of the existing CSV missing from the table (e.g. the shipped CSV refreshed
+# from a database with the last years only), unless --drop-missing; it is refused when they are weighted and
+# the refresh is not, or the other way round. --output-dir writes the CSV, its state and the snapshot into
+# another directory than data/csv, e.g. a staging copy.
+#
+#   cd app && python -m analytics.refresh [--db-url sqlite:///ene.db] [--full] [--scan-all] [--drop-missing]
+#       [--weighted] [--snapshot] [--output-dir staging]
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+import sqlalchemy as sa
+
+from analytics import dataset, snapshot, sql_aggregates
+from analytics.cube import WEIGHTED_PREFIX
+
+
+STATE_FILE = os.path.join(dataset.CSV_DIR, 'agg_by_gender_age_month_region.state.json')
+
+
+class RefreshError(Exception):
+    pass
+
+
+# Columns of the cells of a period, the aggregated columns of the rows
+CELL_COLUMNS = ['region', 'tramo_edad', 'sexo', 'activ']
+
+
+def fingerprint_query(weighted=False, periods=None):
+    # Query of the cells of all periods, or of the (year, month) periods with the params of periods_params()
+    cells = ', '.join(CELL_COLUMNS)
+    weight = f''', sum({sql_aggregates.WEIGHT}) as w''' if weighted else ''
+    where = ''
+    if periods is not None:
+        where = 'where ' + ' or '.join(f'''(ano_trimestre = :year{i} and mes_central = :month{i})'''
+                                       for i in range(len(periods)))
+    return sa.text(f'''select ano_trimestre, mes_central, {cells}, count(*) as n{weight}
+        from ene {where}
+        group by ano_trimestre, mes_central, {cells}''')
+
+
+def periods_params(periods):
+    params = {}
+    for i, (year, month) in enumerate(periods):
+        params[f'''year{i}'''] = year
+        params[f'''month{i}'''] = month
+    return params
+
+
+def period_key(year, month):
+    return f'''{int(year)}-{int(month):02d}'''
+
+
+def parse_period(key):
+    year, month = key.split('-')
+    return int(year), int(month)
+
+
+def cell_fingerprint(values):
+    # Cell columns and row count of a cell as integers, its weight sum as it is: a change of an expansion factor,
+    # however small, changes the fingerprint
+    counts = tuple(None if value is None else int(value) for value in values[:len(CELL_COLUMNS) + 1])
+    return repr(counts + tuple(str(value) for value in values[len(CELL_COLUMNS) + 1:]))
+
+
+def read_fingerprints(engine, weighted=False, periods=None):
+    # {'2010-02': hash of the cells of the period} of all periods of the ene table, or of the (year, month) periods
+    with engine.connect() as connection:
+        rows = connection.execute(fingerprint_query(weighted, periods),
+                                  periods_params(periods) if periods is not None else {}).fetchall()
+    cells = {}
+    for year, month, *values in rows:
+        if year is not None and month is not None:
+            cells.setdefault(period_key(year, month), []).append(cell_fingerprint(values))
+    return {period: hashlib.sha1('\n'.join(sorted(period_cells)).encode()).hexdigest()
+            for period, period_cells in cells.items()}
+
+
+def read_load_log(engine):
+    # {file_name: {'loaded': 'version at time', 'periods': ['2010-02', ...]}} of ene_load_log, None if it can't be read
+    try:
+        with engine.connect() as connection:
+            rows = connection.execute(sa.text('''select file_name, file_version, periods, loaded_at
+                from ene_load_log''')).fetchall()
+    except sa.exc.SQLAlchemyError:
+        return None
+    return {file_name: {'loaded': f'''{file_version} at {loaded_at}''',
+                        'periods': sorted(period_key(year, month) for year, month in json.loads(periods or '[]'))}
+            for file_name, file_version, periods, loaded_at in rows}
+
+
+def candidate_periods(load_log, stored_log):
+    # Periods of the files loaded, replaced or deleted since the stored load log
+    candidates = set()
+    for name, entry in load_log.items():
+        previous = stored_log.get(name)
+        if previous != entry:
+            candidates.update(entry['periods'])
+            candidates.update(previous['periods'] if previous else [])
+    for name, previous in stored_log.items():
+        if name not in load_log:
+            candidates.update(previous['periods'])
+    return sorted(candidates)
+
+
+def read_state(path=STATE_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'version': None, 'weighted': False, 'periods': {}, 'load_log': None}
+
+
+def write_state(state, path=STATE_FILE):
+    temp_path = f'''{path}.tmp'''
+    with open(temp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def changed_periods(fingerprints, state):
+    # New or changed periods, and periods no longer in the table
+    stored = state['periods']
+    changed = sorted(period for period, fingerprint in fingerprints.items() if stored.get(period) != fingerprint)
+    removed = sorted(period for period in stored if period not in fingerprints)
+    return changed, removed
+
+
+def agg_periods(agg):
+    # '2010-02' period of every row of an aggregate frame
+    return agg['year'].astype(str) + '-' + agg['month'].map('{:02d}'.format)
+
+
+def merge(agg, fresh, periods):
+    # agg with the rows of periods replaced by fresh, in the order of the key columns
+    keys = list(sql_aggregates.KEY_COLUMNS)
+    merged = pd.concat([agg[~agg_periods(agg).isin(periods)], fresh], ignore_index=True)
+    return merged.sort_values(keys, kind='stable').reset_index(drop=True)
+
+
+def scan_fingerprints(engine, state, weighted, load_log, report=print):
+    # Fingerprints of all periods: the stored ones, with the periods changed in the load log fingerprinted again
+    if not load_log or state.get('load_log') is None:
+        return read_fingerprints(engine, weighted)
+    candidates = candidate_periods(load_log, state['load_log'])
+    report(f'''{len(candidates)} periods loaded since the last refresh''')
+    fingerprints = {period: fingerprint for period, fingerprint in state['periods'].items() if period not in candidates}
+    if candidates:
+        fingerprints.update(read_fingerprints(engine, weighted, [parse_period(period) for period in candidates]))
+    return fingerprints
+
+
+def refresh(engine, agg_file=dataset.AGG_FILE, state_file=STATE_FILE, full=False, weighted=False, scan_all=False,
+            drop_missing=False, report=print):
+    # Brings agg_file up to date with the ene table, returns the new dataset version or None if nothing changed
+    start = time.perf_counter()
+    state = read_state(state_file)
+    if not full and (not os.path.exists(agg_file) or state['version'] != dataset.file_version(agg_file)):
+        report('The aggregate CSV was not written by the last refresh, aggregating all periods')
+        full = True
+    if not full and state.get('weighted', False) != weighted:
+        report(f'''Switching to {'weighted' if weighted else 'unweighted'} aggregates, aggregating all periods''')
+        full = True
+    if full:
+        state = {'version': None, 'weighted': weighted, 'periods': {}, 'load_log': None}
+
+    load_log = read_load_log(engine)
+    fingerprints = scan_fingerprints(engine, state, weighted, None if scan_all else load_log, report)
+    changed, removed = changed_periods(fingerprints, state)
+    if not changed and not removed:
+        if load_log != state.get('load_log'):
+            write_state(dict(state, load_log=load_log), state_file)
+        report(f'''{len(fingerprints)} periods up to date, version {state['version']}''')
+        return None
+
+    current = None
+    if full and os.path.exists(agg_file) and not drop_missing:
+        # Periods of the CSV the table doesn't have are kept, the others replaced
+        current = pd.read_csv(agg_file)
+        kept = sorted(set(agg_periods(current)) - set(fingerprints))
+        listed = f'''({', '.join(kept[:3])}{'...' if len(kept) > 3 else ''})'''
+        current_weighted = any(column.startswith(WEIGHTED_PREFIX) for column in current.columns)
+        if kept and current_weighted != weighted:
+            raise RefreshError(f'''{len(kept)} periods of the aggregate CSV not in the ene table {listed} have '''
+                               f'''{'weighted' if current_weighted else 'unweighted'} aggregates, they can't be '''
+                               f'''kept in {'weighted' if weighted else 'unweighted'} ones: refresh with '''
+                               f'''--drop-missing to drop them''')
+        if kept:
+            report(f'''{len(kept)} periods of the aggregate CSV not in the ene table kept {listed}, '''
+                   f'''--drop-missing drops them''')
+
+    periods = None if full else [parse_period(period) for period in changed]
+    fresh = sql_aggregates.read_aggregates(engine, periods, weighted)
+    if current is not None:
+        agg = merge(current, fresh, list(fingerprints))
+    elif full:
+        agg = fresh
+    else:
+        agg = merge(pd.read_csv(agg_file), fresh, changed + removed)
+    sql_aggregates.write_csv(agg, agg_file)
+
+    version = dataset.file_version(agg_file)
+    write_state({'version': version, 'weighted': weighted, 'periods': fingerprints, 'load_log': load_log}, state_file)
+    report(f'''{len(changed)} periods aggregated ({', '.join(changed[:3])}{'...' if len(changed) > 3 else ''}), '''
+           f'''{len(removed)} removed, {len(fresh)} rows in {time.perf_counter() - start:.2f}s, version {version}''')
+    return version
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m analytics.refresh', description='Refresh the aggregate CSV from the ene table')
+    parser.add_argument('--db-url', help='database URL, the app database by default')
+    parser.add_argument('--full', action='store_true', help='aggregate all periods again')
+    parser.add_argument('--scan-all', action='store_true',
+                        help='fingerprint all periods, not only the ones loaded since the last refresh')
+    parser.add_argument('--drop-missing', action='store_true',
+                        help='drop the periods of the aggregate CSV missing from the table in a full refresh')
+    parser.add_argument('--weighted', action='store_true', help='add the totals weighted by the expansion factors')
+    parser.add_argument('--snapshot', action='store_true', help='rebuild the binary snapshot after a change')
+    parser.add_argument('--output-dir', default=dataset.CSV_DIR,
+                        help='directory of the aggregate CSV and its state, data/csv by default')
+    args = parser.parse_args(argv[1:])
+
+    if args.db_url:
+        engine = sa.create_engine(args.db_url)
+    else:
+        from app import db as engine
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    agg_file = os.path.join(args.output_dir, os.path.basename(dataset.AGG_FILE))
+    try:
+        version = refresh(engine, agg_file, os.path.join(args.output_dir, os.path.basename(STATE_FILE)),
+                          full=args.full, weighted=args.weighted, scan_all=args.scan_all,
+                          drop_missing=args.drop_missing)
+    except RefreshError as e:
+        print(e)
+        return 1
+    if version is not None and args.snapshot:
+        # The snapshot of a CSV written elsewhere goes next to it
+        snapshot_dir = snapshot.SNAPSHOT_DIR if os.path.samefile(args.output_dir, dataset.CSV_DIR) else \
+            os.path.join(args.output_dir, 'snapshot')
+        snapshot.build(*dataset.read_csv_sources(agg_file), snapshot_dir=snapshot_dir)
+        print(f'''Snapshot {version} written to {snapshot_dir}''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,166 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Hot reload of the dataset, without restarting the workers. A watcher thread polls the dataset files (the
+# aggregate CSV, the snapshot manifest, the reference CSVs, the standard errors and a reload stamp) every
+# ENE_RELOAD_INTERVAL seconds; once they changed and stayed unchanged for one more poll, the dataset is
+# reloaded. The new dataset (cube, quarters, region and age lookups) is read in the background while the
+# requests are served from the current one, the default views of its version are computed in the figure
+# cache, and it is then swapped in. Requests pin the dataset they started with (dash_apps/reloading.py),
+# so the requests in flight finish on the old version.
+#   data_reloader = reloader.DatasetReloader(warm_up=dash_apps.warm_up)
+#   data_reloader.start()       # in every worker process
+#   data_reloader.trigger()     # reload now, and make the watchers of the other workers follow
+
+import datetime
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from analytics import dataset, figure_cache, metrics, snapshot, standard_errors
+
+
+logger = logging.getLogger()
+
+DEFAULT_INTERVAL = 30
+# Touched by trigger(), so the watchers of all the workers of the host reload
+RELOAD_STAMP = os.environ.get('ENE_RELOAD_STAMP', os.path.join(tempfile.gettempdir(), 'ene-reload.stamp'))
+
+reloads = metrics.counter('ene_dataset_reloads_total', 'Dataset reloads by result', ['result'])
+reload_seconds = metrics.histogram('ene_dataset_reload_seconds', 'Time to read, warm up and swap in a new dataset')
+
+
+def watched_files():
+    return [dataset.AGG_FILE, dataset.REGIONS_FILE, dataset.AGE_RANGES_FILE,
+            os.path.join(snapshot.SNAPSHOT_DIR, snapshot.MANIFEST), standard_errors.STANDARD_ERRORS_FILE,
+            RELOAD_STAMP]
+
+
+def files_signature(paths):
+    # Modification time and size of every file, None for the missing ones
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+class DatasetReloader:
+    def __init__(self, warm_up=None, interval=None, paths=None):
+        self.warm_up = warm_up
+        self.interval = float(os.environ.get('ENE_RELOAD_INTERVAL', DEFAULT_INTERVAL)) if interval is None \
+            else interval
+        self.paths = paths or watched_files()
+        self.signature = files_signature(self.paths)
+        self.last = None
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reload(self, force=False):
+        # Read the dataset files and swap the new dataset in if its version or the watched files changed, or
+        # anyway with force.
+        # Returns the status of the reload; a reload already running makes it return at once.
+        if not self._lock.acquire(blocking=False):
+            return {'result': 'busy'}
+        try:
+            self.last = self._reload(force)
+            return self.last
+        finally:
+            self._lock.release()
+
+    def _reload(self, force):
+        start = time.perf_counter()
+        current = dataset.get()
+        signature = files_signature(self.paths)
+        status = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'previous': current.version}
+        try:
+            ds = dataset.read_dataset()
+        except Exception as e:
+            logger.exception('ENE dataset reload failed, keeping the current dataset')
+            reloads.inc('error')
+            return dict(status, result='error', error=f'''{e.__class__.__name__}: {e}''')
+        # The version covers the aggregate data, the reference files and the standard errors
+        files_changed = signature != self.signature
+        self.signature = signature
+
+        if ds.version == current.version and not force and not files_changed:
+            reloads.inc('unchanged')
+            return dict(status, result='unchanged', version=ds.version)
+
+        figure_cache.cache.activate(ds.version)
+        if self.warm_up is not None:
+            # Default views of the new version, computed before it is served
+            dataset.pin(ds)
+            try:
+                self.warm_up()
+            except Exception:
+                logger.exception(f'''Warm up of the ENE dataset {ds.version} failed''')
+            finally:
+                dataset.unpin()
+
+        dataset.replace(ds)
+        if ds.version != current.version:
+            figure_cache.cache.retire(current.version)
+        seconds = time.perf_counter() - start
+        reload_seconds.observe(seconds)
+        reloads.inc('swapped')
+        logger.info(f'''ENE dataset {ds.version} swapped in for {current.version} in {seconds:.2f}s '''
+                    f'''(loaded from {ds.source} in {ds.load_seconds or 0:.2f}s)''')
+        return dict(status, result='swapped', version=ds.version, seconds=seconds)
+
+    def poll(self):
+        # Reload when the files changed since the last reload and did not change since the last poll
+        signature = files_signature(self.paths)
+        if signature == self.signature:
+            self._pending = None
+            return None
+        if signature != self._pending:
+            self._pending = signature
+            return None
+        self._pending = None
+        return self.reload()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('ENE dataset watcher failed')
+
+    def start(self):
+        # Watch the files in a thread of this process; threads don't survive a fork, so every worker starts its own
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='ene-dataset-reloader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def trigger(self, force=False):
+        # Reload this process now, and touch the stamp so the watchers of the other workers reload too
+        try:
+            with open(RELOAD_STAMP, 'a'):
+                os.utime(RELOAD_STAMP)
+        except OSError as e:
+            logger.warning(f'''Can't touch the reload stamp {RELOAD_STAMP}: {e}''')
+        return self.reload(force)
+
+    def status(self):
+        ds = dataset.get()
+        return {
+            'version': ds.version,
+            'source': ds.source,
+            'watching': self._thread is not None and self._thread.is_alive(),
+            'interval': self.interval,
+            'cached_versions': list(figure_cache.cache.versions),
+            'last': self.last,
+        }
@@ -0,0 +1,90 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Columns of the ene microdata table as declared in data/create_db.sql, with the narrowest NumPy types
+# holding the declared SQL types (tinyint unsigned -> uint8, smallint unsigned -> uint16, float -> float32...),
+# their descriptions and the ene_* reference tables of their codes (create_db_reference.sql), including the
+# foreign keys commented out because of the limit of 64 per table.
+
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+
+
+app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SCHEMA_FILE = os.path.join(app_path, 'data', 'create_db.sql')
+
+COLUMN_RE = re.compile(r'''^\s*(\w+)\s+(tinyint|smallint|int|bigint|float|double|text|varchar)\b(\(\d+\))?(\s+unsigned)?''',
+                       re.IGNORECASE)
+REFERENCE_RE = re.compile(r'''foreign key \((\w+)\) references (\w+)\(id\)''', re.IGNORECASE)
+
+INTEGER_DTYPES = {
+    ('tinyint', False): np.int8, ('tinyint', True): np.uint8,
+    ('smallint', False): np.int16, ('smallint', True): np.uint16,
+    ('int', False): np.int32, ('int', True): np.uint32,
+    ('bigint', False): np.int64, ('bigint', True): np.uint64,
+}
+
+
+class Column:
+    def __init__(self, name, sql_type, unsigned, description='', reference=None):
+        self.name = name
+        self.sql_type = sql_type
+        self.unsigned = unsigned
+        self.description = description
+        # ene_* table with the labels of the codes of the column
+        self.reference = reference
+
+    @property
+    def is_text(self):
+        return self.sql_type in ('text', 'varchar')
+
+    @property
+    def dtype(self):
+        # NumPy type of the column, None for text
+        if self.is_text:
+            return None
+        if self.sql_type == 'float':
+            return np.float32
+        if self.sql_type == 'double':
+            return np.float64
+        return INTEGER_DTYPES[(self.sql_type, self.unsigned)]
+
+    @property
+    def nullable_dtype(self):
+        # pandas type keeping missing values: 'UInt8', 'Int16', 'float32'...
+        dtype = self.dtype
+        if dtype is None:
+            return object
+        if np.issubdtype(dtype, np.integer):
+            name = np.dtype(dtype).name
+            return 'U' + name[1:].capitalize() if self.unsigned else name.capitalize()
+        return dtype
+
+
+def read_columns(path=SCHEMA_FILE, table='ene'):
+    # {name: Column} of the table, in declaration order, without the auto increment id
+    columns = OrderedDict()
+    in_table = False
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if re.match(rf'''\s*create table {table}\s*\(''', line, re.IGNORECASE):
+                in_table = True
+                continue
+            if in_table:
+                if line.startswith(')'):
+                    break
+                match = COLUMN_RE.match(line)
+                if match and 'auto_increment' not in line.lower():
+                    name, sql_type, _, unsigned = match.groups()
+                    description = line.split('--', 1)[1].strip() if '--' in line else ''
+                    columns[name] = Column(name, sql_type.lower(), bool(unsigned), description)
+                reference = REFERENCE_RE.search(line)
+                if reference and reference.group(1) in columns:
+                    columns[reference.group(1)].reference = reference.group(2)
+    return columns
+
+
+ENE_COLUMNS = read_columns()
@@ -0,0 +1,202 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Columnar binary snapshot of the aggregated ENE data and its reference tables.
+# Every column is stored as a .npy file with the narrowest unsigned type holding its values, next to a
+# manifest.json with the column types, the content hashes, the version of the source CSV and the versions of
+# the reference CSVs (regions.csv, age_ranges.csv) its labels and cube rollups come from.
+# The prefix sums and rollups of the data cube (analytics/cube.py) are stored the same way, as cube.*.npy.
+# The serving processes memory-map the columns and the cube read-only, so all workers on a machine share the
+# same page cache pages and start without decompressing and parsing the CSV or building the cube.
+#
+# Build it after changing the CSV files, and check it against them:
+#   cd app && python -m analytics.snapshot build
+#   cd app && python -m analytics.snapshot verify
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 3
+MANIFEST = 'manifest.json'
+
+app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SNAPSHOT_DIR = os.path.join(app_path, 'data', 'snapshot')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def column_hash(values):
+    return hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+def content_hash(columns):
+    # Hash of all columns, in the order of the manifest
+    digest = hashlib.sha256()
+    for name, info in columns.items():
+        digest.update(f'''{name}:{info['dtype']}:{info['sha256']}'''.encode())
+    return digest.hexdigest()
+
+
+def save_array(build_dir, file_name, values):
+    values = np.ascontiguousarray(values)
+    np.save(os.path.join(build_dir, file_name), values, allow_pickle=False)
+    return {'file': file_name, 'dtype': values.dtype.str, 'shape': list(values.shape), 'sha256': column_hash(values)}
+
+
+def load_array(snapshot_dir, name, info, verify):
+    try:
+        values = np.load(os.path.join(snapshot_dir, info['file']), mmap_mode='r', allow_pickle=False)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f'''Array {name} of {snapshot_dir} can't be read: {e}''')
+    if values.dtype.str != info['dtype'] or list(values.shape) != info['shape']:
+        raise SnapshotError(f'''Array {name} of {snapshot_dir} doesn't match the manifest''')
+    if verify and column_hash(values) != info['sha256']:
+        raise SnapshotError(f'''Array {name} of {snapshot_dir} is corrupted''')
+    return values
+
+
+def build(agg, regions, age_ranges, version, references, snapshot_dir=SNAPSHOT_DIR):
+    # Write the snapshot into a new directory and swap it in, so readers never see a partial snapshot
+    from analytics import dataset
+
+    parent = os.path.dirname(os.path.abspath(snapshot_dir))
+    os.makedirs(parent, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix='.snapshot-', dir=parent)
+    os.chmod(build_dir, 0o755)
+
+    columns = {name: save_array(build_dir, f'''agg.{name}.npy''', agg[name].to_numpy()) for name in agg.columns}
+    cube_arrays = dataset.EneDataset(agg, regions, age_ranges, version).cube.arrays()
+    cube = {name: save_array(build_dir, f'''cube.{name}.npy''', values) for name, values in cube_arrays.items()}
+
+    manifest = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'references': dict(references),
+        'rows': len(agg),
+        'columns': columns,
+        'content_sha256': content_hash(columns),
+        'cube': cube,
+        'cube_sha256': content_hash(cube),
+        'regions': dict(regions),
+        'age_ranges': dict(age_ranges),
+    }
+    with open(os.path.join(build_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+
+    old_dir = None
+    if os.path.exists(snapshot_dir):
+        old_dir = tempfile.mkdtemp(prefix='.snapshot-old-', dir=parent)
+        os.rename(snapshot_dir, os.path.join(old_dir, 'snapshot'))
+    os.rename(build_dir, snapshot_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return manifest
+
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f'''No readable snapshot in {snapshot_dir}: {e}''')
+    if manifest.get('format') != FORMAT_VERSION:
+        raise SnapshotError(f'''Unsupported snapshot format {manifest.get('format')} in {snapshot_dir}''')
+    return manifest
+
+
+def load(snapshot_dir=SNAPSHOT_DIR, verify=False):
+    # Memory-mapped read-only columns as a frame, with the reference tables, the dataset version and the versions
+    # of the reference files
+    manifest = read_manifest(snapshot_dir)
+    columns = {}
+    for name, info in manifest['columns'].items():
+        columns[name] = load_array(snapshot_dir, name, info, verify)
+        if len(columns[name]) != manifest['rows']:
+            raise SnapshotError(f'''Column {name} of {snapshot_dir} doesn't match the manifest''')
+    if verify and content_hash(manifest['columns']) != manifest['content_sha256']:
+        raise SnapshotError(f'''Manifest of {snapshot_dir} is corrupted''')
+
+    agg = pd.DataFrame(columns, copy=False)
+    # pandas versions consolidating the columns copy them out of the memory maps, into the memory of the process
+    copied = [name for name, values in columns.items() if not np.shares_memory(agg[name].to_numpy(), values)]
+    if copied:
+        logger.warning(f'''{len(copied)} columns of {snapshot_dir} copied by pandas {pd.__version__}, they are not '''
+                       f'''shared with the other processes''')
+    return agg, manifest['regions'], manifest['age_ranges'], manifest['version'], manifest['references']
+
+
+def load_cube(version, references, snapshot_dir=SNAPSHOT_DIR, verify=False):
+    # Memory-mapped read-only arrays of the data cube, for EneCube(arrays=); None when the snapshot was
+    # replaced by another version, or one built from other reference files, since its columns were loaded
+    manifest = read_manifest(snapshot_dir)
+    if manifest['version'] != version or manifest['references'] != references:
+        return None
+    if verify and content_hash(manifest['cube']) != manifest['cube_sha256']:
+        raise SnapshotError(f'''Manifest of {snapshot_dir} is corrupted''')
+    return {name: load_array(snapshot_dir, name, info, verify) for name, info in manifest['cube'].items()}
+
+
+def verify(snapshot_dir=SNAPSHOT_DIR):
+    # Compare the snapshot with the CSV files it was built from
+    from analytics import dataset
+
+    agg, regions, age_ranges, version, references = load(snapshot_dir, verify=True)
+    csv_agg, csv_regions, csv_age_ranges, csv_version, csv_references = dataset.read_csv_sources()
+    problems = []
+    if version != csv_version:
+        problems.append(f'''snapshot version {version}, CSV version {csv_version}''')
+    if list(agg.columns) != list(csv_agg.columns) or len(agg) != len(csv_agg):
+        problems.append('columns or row count differ')
+    else:
+        problems += [f'''column {name} differs''' for name in agg.columns
+                     if not np.array_equal(agg[name].to_numpy(), csv_agg[name].to_numpy())]
+    if regions != csv_regions or age_ranges != csv_age_ranges or references != csv_references:
+        problems.append('reference tables differ')
+
+    # The cube of the snapshot against the one built from the CSV
+    cube = load_cube(version, references, snapshot_dir, verify=True) or {}
+    csv_cube = dataset.EneDataset(csv_agg, csv_regions, csv_age_ranges, csv_version).cube.arrays()
+    if sorted(cube) != sorted(csv_cube):
+        problems.append('cube arrays differ')
+    else:
+        problems += [f'''cube array {name} differs''' for name in cube if not np.array_equal(cube[name], csv_cube[name])]
+    return problems
+
+
+def main(argv):
+    from analytics import dataset
+
+    command = argv[1] if len(argv) > 1 else 'build'
+    if command == 'build':
+        agg, regions, age_ranges, version, references = dataset.read_csv_sources()
+        manifest = build(agg, regions, age_ranges, version, references)
+        size = sum(os.path.getsize(os.path.join(SNAPSHOT_DIR, info['file']))
+                   for info in list(manifest['columns'].values()) + list(manifest['cube'].values()))
+        print(f'''Snapshot {version} written to {SNAPSHOT_DIR}: {manifest['rows']} rows, {size / 2**20:.2f} MiB''')
+    elif command == 'verify':
+        problems = verify()
+        for problem in problems:
+            print(problem)
+        print('Snapshot matches the CSV files' if not problems else 'Snapshot is out of date, rebuild it')
+        return 1 if problems else 0
+    else:
+        print('Usage: python -m analytics.snapshot [build|verify]')
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
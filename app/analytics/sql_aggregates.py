@@ -0,0 +1,137 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Monthly region x tramo_edad x sex aggregates computed in the database from the ene microdata table,
+# in the same format as data/csv/agg_by_gender_age_month_region.zip. The aggregation is a single GROUP BY
+# over the (ano_trimestre, mes_central, region, tramo_edad, sexo, activ) index created in create_db.sql
+# and create_db_sqlite.sql, written in SQL that runs on both MySQL and SQLite.
+# With weighted=True, every count also gets its weighted total w_<column> in the same pass: the sum of the
+# calibrated quarterly expansion factor fact_cal of the respondents, or fact where fact_cal is missing.
+#
+# Export the aggregates as the CSV served by the app:
+#   cd app && python -m analytics.sql_aggregates [--db-url sqlite:///ene.db] [--weighted] [output.zip]
+
+import argparse
+import os
+import sys
+from collections import OrderedDict
+
+import pandas as pd
+import sqlalchemy as sa
+
+from analytics.cube import WEIGHTED_PREFIX
+
+
+KEY_COLUMNS = OrderedDict([
+    ('year', 'ano_trimestre'),
+    ('month', 'mes_central'),
+    ('region', 'region'),
+    ('tramo_edad', 'tramo_edad'),
+])
+
+# Conditions counted by every aggregate column; sex is only counted for people of working age (activ set)
+MALE = 'sexo = 1 and activ is not null'
+FEMALE = 'sexo = 2 and activ is not null'
+COUNT_CONDITIONS = OrderedDict([
+    ('total', None),
+    ('male', MALE),
+    ('female', FEMALE),
+    ('employed', 'activ = 1'),
+    ('male_employed', 'sexo = 1 and activ = 1'),
+    ('female_employed', 'sexo = 2 and activ = 1'),
+    ('unemployed', 'activ = 2'),
+    ('male_unemployed', 'sexo = 1 and activ = 2'),
+    ('female_unemployed', 'sexo = 2 and activ = 2'),
+    ('is_workforce', 'activ in (1, 2)'),
+    ('male_workforce', 'sexo = 1 and activ in (1, 2)'),
+    ('female_workforce', 'sexo = 2 and activ in (1, 2)'),
+    ('not_workforce', 'activ = 3'),
+])
+
+WEIGHT = 'coalesce(fact_cal, fact, 0)'
+
+
+def aggregate_columns(weighted=False):
+    columns = [f'''{source} as {name}''' for name, source in KEY_COLUMNS.items()]
+    for name, condition in COUNT_CONDITIONS.items():
+        if condition is None:
+            columns.append(f'''count(*) as {name}''')
+        else:
+            columns.append(f'''sum(case when {condition} then 1 else 0 end) as {name}''')
+    if weighted:
+        for name, condition in COUNT_CONDITIONS.items():
+            if condition is None:
+                columns.append(f'''sum({WEIGHT}) as {WEIGHTED_PREFIX}{name}''')
+            else:
+                columns.append(f'''sum(case when {condition} then {WEIGHT} else 0 end) as {WEIGHTED_PREFIX}{name}''')
+    return columns
+
+
+def weighted_columns():
+    return [f'''{WEIGHTED_PREFIX}{name}''' for name in COUNT_CONDITIONS]
+
+
+def aggregate_query(periods=None, weighted=False):
+    # periods: optional list of (ano_trimestre, mes_central) to aggregate, all periods by default
+    params = {}
+    where = ['region is not null', 'tramo_edad is not null']
+    if periods is not None:
+        period_conditions = []
+        for i, (year, month) in enumerate(periods):
+            period_conditions.append(f'''(ano_trimestre = :year_{i} and mes_central = :month_{i})''')
+            params[f'''year_{i}'''] = int(year)
+            params[f'''month_{i}'''] = int(month)
+        where.append('(' + (' or '.join(period_conditions) or '1 = 0') + ')')
+
+    keys = ', '.join(KEY_COLUMNS.values())
+    sql = f'''select {', '.join(aggregate_columns(weighted))}
+        from ene
+        where {' and '.join(where)}
+        group by {keys}
+        order by {keys}'''
+    return sa.text(sql), params
+
+
+def read_aggregates(engine, periods=None, weighted=False):
+    query, params = aggregate_query(periods, weighted)
+    with engine.connect() as connection:
+        result = connection.execute(query, params)
+        agg = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    columns = list(KEY_COLUMNS) + list(COUNT_CONDITIONS)
+    counts = agg[columns].fillna(0).astype('int64')
+    if not weighted:
+        return counts
+    weights = agg[weighted_columns()].fillna(0).astype('float64').round(3)
+    return pd.concat([counts, weights], axis=1)
+
+
+def write_csv(agg, path):
+    # Zipped CSV with the same layout as the one shipped in data/csv, replacing path atomically
+    temp_path = f'''{path}.tmp'''
+    agg.to_csv(temp_path, index=False, compression={'method': 'zip', 'archive_name': os.path.basename(path)})
+    os.replace(temp_path, path)
+
+
+def main(argv):
+    from analytics import dataset
+
+    parser = argparse.ArgumentParser(prog='python -m analytics.sql_aggregates',
+                                     description='Export the aggregates of the ene table as the CSV served by the app')
+    parser.add_argument('output', nargs='?', default=dataset.AGG_FILE, help='zipped CSV written')
+    parser.add_argument('--db-url', help='database URL, the app database by default')
+    parser.add_argument('--weighted', action='store_true', help='add the totals weighted by the expansion factors')
+    args = parser.parse_args(argv[1:])
+
+    if args.db_url:
+        engine = sa.create_engine(args.db_url)
+    else:
+        from app import db as engine
+
+    agg = read_aggregates(engine, weighted=args.weighted)
+    write_csv(agg, args.output)
+    print(f'''{len(agg)} aggregate rows written to {args.output}''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Standard errors of the rates estimated offline by analytics/variance.py, read by the serving processes.
+# Kept apart from the estimation so the app doesn't import the database and bootstrap stack on startup.
+
+import hashlib
+import io
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+from analytics.periods import quarter_labels
+
+
+logger = logging.getLogger(__name__)
+
+app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STANDARD_ERRORS_FILE = os.path.join(app_path, 'data', 'csv', 'agg_by_gender_age_month_region.se.npz')
+
+
+class StandardErrors:
+    # Standard errors stored by variance.estimate(), looked up by chart parameters
+    def __init__(self, path=STANDARD_ERRORS_FILE):
+        with open(path, 'rb') as f:
+            content = f.read()
+        # Version of the content read, part of the dataset version
+        self.version = hashlib.sha1(content).hexdigest()[:12]
+        with np.load(io.BytesIO(content), allow_pickle=False) as data:
+            self.quarter_labels = quarter_labels(data['quarter_keys'])
+            self.se = data['se']
+            meta = json.loads(str(data['meta']))
+        self.se.flags.writeable = False
+        self.rate_index = {name: i for i, name in enumerate(meta['rates'])}
+        self.plane_index = {weighted: i for i, weighted in enumerate(meta['planes'])}
+        self.region_index = {tuple(region_key): i for i, region_key in enumerate(meta['region_keys'])}
+        self.age_index = {tuple(age_range): i for i, age_range in enumerate(meta['age_ranges'])}
+        self.replicates = meta['replicates']
+        self.z = meta['z']
+
+    @property
+    def nbytes(self):
+        return self.se.nbytes
+
+    def lookup(self, quarters, name, region_key, ages, weighted=False):
+        # Standard errors of rate name for the quarters labels, None if the cut was not estimated
+        try:
+            index = (self.plane_index[weighted], self.rate_index[name], self.region_index[tuple(region_key)],
+                     self.age_index[(min(ages), max(ages))])
+        except KeyError:
+            return None
+        by_quarter = dict(zip(self.quarter_labels, self.se[(slice(None),) + index]))
+        return np.array([by_quarter.get(quarter, np.nan) for quarter in quarters], dtype=np.float64)
+
+    def margin(self, quarters, name, region_key, ages, weighted=False):
+        # Half width of the 95% confidence band
+        se = self.lookup(quarters, name, region_key, ages, weighted)
+        return None if se is None else self.z * se
+
+
+def read_standard_errors(path=STANDARD_ERRORS_FILE):
+    # Standard errors of path, None when it is missing or can't be read: the charts are drawn without bands
+    if not os.path.exists(path):
+        return None
+    try:
+        return StandardErrors(path)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning(f'''Standard errors {path} can't be read, no confidence bands: {e.__class__.__name__}: {e}''')
+        return None
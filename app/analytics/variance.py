@@ -0,0 +1,240 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Design-based standard errors of the rates shown in the Dash apps, estimated with the Rao-Wu rescaling
+# bootstrap over the ENE sample design: in every stratum (estrato) of n primary sampling units (id_upm, or
+# conglomerado since 2020), n - 1 units are drawn with replacement and the weights of their respondents are
+# rescaled by n / (n - 1) times the number of draws. All replicates of a quarter are reduced together: the
+# respondents are summed by sampling unit and cell once with bincount, and the replicate totals are the
+# sums of these totals times the replicate multipliers, reduced by cell in one pass. Quarters are estimated
+# in parallel in a process pool.
+#
+# The standard errors of the quarterly means of the monthly rates are stored next to the aggregate CSV for
+# every region option of regions.csv, every age range of the sliders and both the respondent counts and the
+# weighted totals, so the charts draw confidence bands without any computation at request time.
+#
+#   cd app && python -m analytics.variance [--db-url sqlite:///ene.db] [--replicates 200] [--workers 4]
+
+import argparse
+import json
+import os
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import sqlalchemy as sa
+
+from analytics import indicators, microdata
+from analytics.standard_errors import STANDARD_ERRORS_FILE
+
+
+REPLICATES = 200
+# Two-sided 95% confidence bands
+Z_95 = 1.959964
+
+# Indicators with confidence bands, and the planes of the cube they are estimated for
+RATES = ('participation_rate', 'participation_rate_m', 'participation_rate_f',
+         'unemployment_rate', 'unemployment_rate_m', 'unemployment_rate_f')
+PLANES = (False, True)
+
+# Cells of a quarter: month of the quarter x region x tramo_edad
+CELL_SHAPE = (3, 16, 13)
+
+# Replicate totals are computed for blocks of replicates of about this many values
+BLOCK_VALUES = 2**24
+
+# Microdata of a quarter, read in the compact types of analytics/microdata.py
+MICRODATA_COLUMNS = ['mes_central', 'region', 'tramo_edad', 'sexo', 'activ', 'estrato',
+                     'id_upm', 'conglomerado', 'id_directorio', 'fact_cal', 'fact']
+MICRODATA_WHERE = '''ano_trimestre = :year and mes_central in (:month_1, :month_2, :month_3)
+    and region is not null and tramo_edad is not null'''
+
+
+def respondent_metrics(sexo, activ):
+    # 0/1 [respondent, metric] matrix of the aggregate columns, as counted by sql_aggregates.COUNT_CONDITIONS
+    male = sexo == 1
+    female = sexo == 2
+    working_age = activ > 0
+    workforce = (activ == 1) | (activ == 2)
+    columns = {
+        'total': np.ones(len(sexo), dtype=bool),
+        'male': male & working_age,
+        'female': female & working_age,
+        'employed': activ == 1,
+        'male_employed': male & (activ == 1),
+        'female_employed': female & (activ == 1),
+        'unemployed': activ == 2,
+        'male_unemployed': male & (activ == 2),
+        'female_unemployed': female & (activ == 2),
+        'is_workforce': workforce,
+        'male_workforce': male & workforce,
+        'female_workforce': female & workforce,
+        'not_workforce': activ == 3,
+    }
+    return list(columns), np.column_stack(list(columns.values())).astype(np.float64)
+
+
+def bootstrap_multipliers(stratum, replicates, rng):
+    # Rao-Wu multipliers [replicate, psu] for PSUs sorted by stratum; PSUs alone in their stratum keep 1
+    strata, starts, sizes = np.unique(stratum, return_index=True, return_counts=True)
+    sampled = sizes > 1
+    draws = np.repeat(np.flatnonzero(sampled), sizes[sampled] - 1)
+    chosen = starts[draws] + (rng.random((replicates, len(draws))) * sizes[draws]).astype(np.int64)
+    flat = (np.arange(replicates)[:, np.newaxis] * len(stratum) + chosen).ravel()
+    counts = np.bincount(flat, minlength=replicates * len(stratum)).reshape(replicates, len(stratum))
+
+    size = np.repeat(sizes, sizes)
+    multipliers = counts * np.where(size > 1, size / np.maximum(size - 1, 1), 0.0)
+    multipliers[:, size == 1] = 1.0
+    return multipliers
+
+
+def replicate_totals(multipliers, group_psu, group_cell, group_totals, cells):
+    # Totals [replicate, cell, column] of every replicate, from the totals of the (psu, cell) groups
+    replicates = len(multipliers)
+    order = np.argsort(group_cell, kind='stable')
+    group_psu, group_cell, group_totals = group_psu[order], group_cell[order], group_totals[order]
+    present, starts = np.unique(group_cell, return_index=True)
+
+    totals = np.zeros((replicates, cells, group_totals.shape[1]))
+    block = max(1, BLOCK_VALUES // max(1, group_totals.size))
+    for first in range(0, replicates, block):
+        weights = multipliers[first:first + block][:, group_psu]
+        totals[first:first + block, present] = np.add.reduceat(weights[:, :, np.newaxis] * group_totals, starts, axis=1)
+    return totals
+
+
+def age_ranges(max_age=12):
+    # All [lo, hi] ranges of the age sliders
+    return [(lo, hi) for lo in range(1, max_age + 1) for hi in range(lo, max_age + 1)]
+
+
+def region_matrix(region_keys):
+    # One-hot [region, option] matrix of the region options
+    matrix = np.zeros((CELL_SHAPE[1], len(region_keys)))
+    for option, region_key in enumerate(region_keys):
+        matrix[np.array(region_key) - 1, option] = 1
+    return matrix
+
+
+_engines = {}
+
+
+def estimate_quarter(task):
+    # Standard errors [plane, rate, region option, age range] of one quarter, run in the worker processes
+    db_url, year, quarter, region_keys, replicates, seed = task
+    engine = _engines.get(str(db_url)) or _engines.setdefault(str(db_url), sa.create_engine(db_url))
+    months = [quarter * 3 + 1, quarter * 3 + 2, quarter * 3 + 3]
+    frame = microdata.read_microdata(engine, MICRODATA_COLUMNS, MICRODATA_WHERE,
+                                     {'year': year, 'month_1': months[0], 'month_2': months[1], 'month_3': months[2]})
+    if not len(frame):
+        return None
+    month, region, age = (frame[name].to_numpy(np.int64) for name in ('mes_central', 'region', 'tramo_edad'))
+    sexo, activ, estrato = (frame[name].fillna(0).to_numpy(np.int64) for name in ('sexo', 'activ', 'estrato'))
+    psu = frame['id_upm'].fillna(frame['conglomerado']).fillna(frame['id_directorio']).fillna(0).to_numpy(np.int64)
+    weight = frame['fact_cal'].fillna(frame['fact']).fillna(0).to_numpy(np.float64)
+    del frame
+    metrics, values = respondent_metrics(sexo, activ)
+    values = np.hstack([values, values * weight[:, np.newaxis]])
+
+    # PSUs sorted by stratum, and the (psu, cell) groups of the respondents
+    strata_psus, psu_index = np.unique(np.column_stack([estrato, psu]), axis=0, return_inverse=True)
+    psu_index = psu_index.reshape(-1)
+    cells = int(np.prod(CELL_SHAPE))
+    cell = np.ravel_multi_index(((month - 1).astype(np.int64) % 3, region.astype(np.int64) - 1, age.astype(np.int64)),
+                                CELL_SHAPE)
+    groups, group_index = np.unique(psu_index * cells + cell, return_inverse=True)
+    group_index = group_index.reshape(-1)
+    group_totals = np.column_stack([np.bincount(group_index, values[:, column], minlength=len(groups))
+                                    for column in range(values.shape[1])])
+
+    rng = np.random.default_rng(seed)
+    multipliers = bootstrap_multipliers(strata_psus[:, 0], replicates, rng)
+    totals = replicate_totals(multipliers, groups // cells, groups % cells, group_totals, cells)
+    totals = totals.reshape((replicates,) + CELL_SHAPE + (values.shape[1],))
+
+    # Region options, then age ranges as differences of cumulative sums over the ages
+    options = np.moveaxis(np.tensordot(totals, region_matrix(region_keys), axes=([2], [0])), -1, 2)
+    prefix = np.concatenate([np.zeros(options.shape[:3] + (1,) + options.shape[4:]), np.cumsum(options, axis=3)],
+                            axis=3)
+    lo, hi = np.array(age_ranges()).T
+    counts = prefix[:, :, :, hi + 1] - prefix[:, :, :, lo]
+
+    present = np.isin(np.arange(3), (month - 1).astype(np.int64) % 3)
+    result = np.full((len(PLANES), len(RATES), len(region_keys), len(lo)), np.nan, dtype=np.float32)
+    for p, weighted in enumerate(PLANES):
+        plane_counts = counts[..., len(metrics):] if weighted else counts[..., :len(metrics)]
+        rates = indicators.compute(metrics, plane_counts[:, present], RATES)
+        for r, name in enumerate(RATES):
+            # Cuts without respondents have no rate in some replicates or months
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                quarterly = np.nanmean(rates[name], axis=1)
+                result[p, r] = np.nanstd(quarterly, axis=0, ddof=1)
+    return result
+
+
+def quarters_in_table(engine):
+    with engine.connect() as connection:
+        rows = connection.execute(sa.text('select distinct ano_trimestre, mes_central from ene')).fetchall()
+    return sorted({(int(year), (int(month) - 1) // 3) for year, month in rows if year is not None and month is not None})
+
+
+def estimate(db_url, region_keys, replicates=REPLICATES, workers=None, seed=0, report=print):
+    # Standard errors [quarter, plane, rate, region option, age range] of all quarters of the ene table
+    start = time.perf_counter()
+    quarters = quarters_in_table(sa.create_engine(db_url))
+    tasks = [(db_url, year, quarter, region_keys, replicates, seed * 100003 + year * 4 + quarter)
+             for year, quarter in quarters]
+    shape = (len(PLANES), len(RATES), len(region_keys), len(age_ranges()))
+    se = np.full((len(quarters),) + shape, np.nan, dtype=np.float32)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, result in enumerate(executor.map(estimate_quarter, tasks)):
+            if result is not None:
+                se[i] = result
+            report(f'''  Q{quarters[i][1] + 1} {quarters[i][0]} done''')
+    keys = np.array([year * 4 + quarter for year, quarter in quarters], dtype=np.int64)
+    report(f'''{len(quarters)} quarters, {replicates} replicates in {time.perf_counter() - start:.1f}s''')
+    return keys, se
+
+
+def write_standard_errors(keys, se, region_keys, replicates, path=STANDARD_ERRORS_FILE):
+    meta = {'rates': list(RATES), 'planes': [bool(weighted) for weighted in PLANES],
+            'region_keys': [list(region_key) for region_key in region_keys], 'age_ranges': age_ranges(),
+            'replicates': replicates, 'z': Z_95}
+    temp_path = f'''{path}.tmp.npz'''
+    np.savez_compressed(temp_path, quarter_keys=keys, se=se, meta=np.array(json.dumps(meta)))
+    os.replace(temp_path, path)
+
+
+def main(argv):
+    from analytics import dataset
+
+    parser = argparse.ArgumentParser(prog='python -m analytics.variance',
+                                     description='Estimate the standard errors of the rates from the ene table')
+    parser.add_argument('--db-url', help='database URL, the app database by default')
+    parser.add_argument('--replicates', type=int, default=REPLICATES, help='bootstrap replicates')
+    parser.add_argument('--workers', type=int, help='worker processes, one per CPU by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=STANDARD_ERRORS_FILE)
+    args = parser.parse_args(argv[1:])
+
+    if args.db_url:
+        db_url = sa.engine.make_url(args.db_url)
+    else:
+        from app import db
+        db_url = db.url
+
+    ds = dataset.get()
+    region_keys = [ds.cube.region_key(json.loads(key)) for key in ds.regions]
+
+    keys, se = estimate(db_url, region_keys, args.replicates, args.workers, args.seed)
+    write_standard_errors(keys, se, region_keys, args.replicates, args.output)
+    print(f'''Standard errors written to {args.output}''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
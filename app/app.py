@@ -1,12 +1,14 @@
 # ENE Analytics app
 # Copyright 2020 Olga Marchevska
 #
-# Flask server and DB connection
+# Flask server and DB connection.
+# The DB engine is created on first use: importing the app neither reads creds.yaml nor imports SQLAlchemy,
+# so the pages served from the in-memory dataset start without them.
 
 import os
+import threading
 
 from flask import Flask
-import sqlalchemy as sa
 import yaml
 
 
@@ -14,25 +16,69 @@ app = Flask(__name__)
 # app_path = os.path.dirname(os.path.realpath(__file__))
 # app.config['APPLICATION_DIR'] = app_path
 
-#creds = yaml.safe_load(open(f'''{app_path}/creds.yaml'''))
-creds = yaml.safe_load(open(f'''creds.yaml'''))
 
-db_user = creds['DB'].get("DB_USER")
-db_pass = creds['DB'].get("DB_PASS")
-db_name = creds['DB'].get("DB_NAME")
-cloud_sql_connection_name = creds['DB'].get("CLOUD_SQL_CONNECTION_NAME")
+# creds.yaml without a DB section
+class DatabaseConfigError(Exception):
+    pass
 
-# Identify if running on GAE or locally and set DB URL respectively
-if os.environ.get("GAE_APPLICATION") is not None:
-    db_url = f'''mysql+pymysql://{db_user}:{db_pass}@/{db_name}?unix_socket=/cloudsql/{cloud_sql_connection_name}'''
-else:
+
+def read_db_url():
+    #creds = yaml.safe_load(open(f'''{app_path}/creds.yaml'''))
+    creds = yaml.safe_load(open(f'''creds.yaml'''))
+    db_creds = creds.get('DB') if isinstance(creds, dict) else None
+    if not isinstance(db_creds, dict):
+        raise DatabaseConfigError('creds.yaml has no DB section')
+
+    db_user = db_creds.get("DB_USER")
+    db_pass = db_creds.get("DB_PASS")
+    db_name = db_creds.get("DB_NAME")
+    cloud_sql_connection_name = db_creds.get("CLOUD_SQL_CONNECTION_NAME")
+
+    # Identify if running on GAE or locally and set DB URL respectively
+    if os.environ.get("GAE_APPLICATION") is not None:
+        return f'''mysql+pymysql://{db_user}:{db_pass}@/{db_name}?unix_socket=/cloudsql/{cloud_sql_connection_name}'''
     db_host = 'localhost'
-    db_url = f'''mysql+pymysql://{db_user}:{db_pass}@{db_host}:3306/{db_name}'''
-
-db = sa.create_engine(
-    db_url,
-    pool_size=5,
-    max_overflow=2,
-    pool_timeout=30,  # 30 seconds
-    pool_recycle=1800,  # 30 minutes
-)
+    return f'''mysql+pymysql://{db_user}:{db_pass}@{db_host}:3306/{db_name}'''
+
+
+def create_db_engine():
+    import sqlalchemy as sa
+
+    return sa.create_engine(
+        read_db_url(),
+        pool_size=5,
+        max_overflow=2,
+        pool_timeout=30,  # 30 seconds
+        pool_recycle=1800,  # 30 minutes
+    )
+
+
+class LazyEngine:
+    # Stands for the SQLAlchemy engine, created by factory on the first use of any of its attributes
+    def __init__(self, factory):
+        self._factory = factory
+        self._engine = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self._factory()
+        return self._engine
+
+    @property
+    def created(self):
+        return self._engine is not None
+
+    def dispose(self):
+        # Nothing to dispose of before the first use
+        if self._engine is not None:
+            self._engine.dispose()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+db = LazyEngine(create_db_engine)
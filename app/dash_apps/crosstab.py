@@ -0,0 +1,259 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Dash application for ad-hoc crosstabs of the ENE microdata: any two categorical columns of a moving quarter,
+# filtered by the values of up to two other columns, counted or weighted by the expansion factors.
+# A respondent is in three overlapping moving quarters, whose expansion factors each add up to the population,
+# so a crosstab covers one period (ano_trimestre, mes_central) and not a whole year.
+
+import json
+import logging
+import time
+
+import flask
+import dash
+from dash import Dash, callback_context
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output, State
+import sqlalchemy as sa
+import yaml
+
+from analytics.figure_cache import FlightError
+from analytics.microdata import CROSSTAB_COLUMNS, column_label, microdata_index, value_labels
+from analytics.periods import moving_quarter_labels
+from app import DatabaseConfigError
+from dash_apps import instrumentation
+
+
+# Functional layout for a Dash app
+def serve_dash_app_layout(*args, **kwargs):
+    return html.Div([
+        dcc.Location(id='url', refresh=False),
+        html.H1('Crosstabs of the ENE microdata',
+                style={'textAlign': 'center'}),
+
+        dcc.Loading(id="loading", type='circle', fullscreen=True, style={'opacity': 0.5},
+                    children=[html.Div('', id='loading_div'), html.Div('', id='loading_div1')]),
+        html.Div('', id='page_data'),
+    ])
+
+
+ene_crosstab_app = Dash(__name__, server=flask.Flask(__name__),
+                        routes_pathname_prefix='/dash/crosstab/',
+                        external_stylesheets=['/static/css/dash_style.css'])
+ene_crosstab_app.layout = serve_dash_app_layout
+ene_crosstab_app.config['suppress_callback_exceptions'] = True
+instrumentation.instrument(ene_crosstab_app)
+
+FILTERS = [1, 2]
+
+logger = logging.getLogger()
+
+# Failures reaching the database: creds.yaml missing or incomplete, connection or query errors
+# The requests waiting for a period read by another one get its failure as the cause of a FlightError
+DATABASE_ERRORS = (sa.exc.SQLAlchemyError, OSError, DatabaseConfigError, yaml.YAMLError, FlightError)
+
+
+def database_failure(e):
+    return e.__cause__ if isinstance(e, FlightError) and e.__cause__ is not None else e
+
+
+# -------------------------------------------------------------------------------------
+# Load page data
+# -------------------------------------------------------------------------------------
+
+def period_value(year, month):
+    return f'''{year}-{month:02d}'''
+
+
+def parse_period(value):
+    # (year, month) of a period_select value, '2020-02'
+    year, month = value.split('-')
+    return int(year), int(month)
+
+
+def period_options(periods):
+    # Newest first, labelled as the moving quarters of the charts
+    years, months = zip(*periods)
+    labels = moving_quarter_labels(years, months)
+    return [{'label': str(label), 'value': period_value(year, month)}
+            for year, month, label in reversed(list(zip(years, months, labels)))]
+
+
+def column_options():
+    return [{'label': column_label(name), 'value': name} for name in CROSSTAB_COLUMNS]
+
+
+def format_value(value, percentages):
+    return f'''{value:.1f}%''' if percentages else f'''{value:,.0f}'''
+
+
+def generate_crosstab_table(frame, percentages=None):
+    # html.Table of a crosstab with its totals, as counts or row/column percentages
+    frame = frame.copy()
+    frame['Total'] = frame.sum(axis=1)
+    frame.loc['Total'] = frame.sum(axis=0)
+    if percentages == 'row':
+        frame = frame.div(frame['Total'], axis=0) * 100
+    elif percentages == 'column':
+        frame = frame.div(frame.loc['Total'], axis=1) * 100
+
+    header = html.Tr([html.Th('')] + [html.Th(str(column)) for column in frame.columns])
+    rows = [html.Tr([html.Th(str(label))] + [html.Td(format_value(value, percentages)) for value in values],
+                    className='total' if label == 'Total' else '')
+            for label, values in zip(frame.index, frame.fillna(0).to_numpy())]
+    return html.Table([header] + rows, className='crosstab')
+
+
+@ene_crosstab_app.callback(
+    [Output('loading_div', 'children'), Output('page_data', 'children')],
+    [Input('url', 'pathname')],
+    []
+)
+def display_page(*args, **kwargs):
+    ctx = callback_context
+    if ctx.inputs['url.pathname'] is None:
+        raise dash.exceptions.PreventUpdate
+
+    # Periods of the ene table the crosstabs are computed from, not those of the aggregate CSV
+    try:
+        periods = microdata_index.periods()
+    except DATABASE_ERRORS as e:
+        e = database_failure(e)
+        logger.warning(f'''The periods of the microdata can't be read from the database: {e.__class__.__name__}: {e}''')
+        return '', html.P(f'''The periods of the microdata can't be read from the database: {e.__class__.__name__}''')
+    if not periods:
+        return '', html.P('The ene table has no microdata')
+
+    filter_rows = []
+    for i in FILTERS:
+        filter_rows.append(html.Tr([
+            html.Td(f'''Filter {i}:''', className='label'),
+            html.Td([
+                dcc.Dropdown(id=f'''filter_column_{i}''', options=column_options(), placeholder='column',
+                             style={'width': '300px', 'display': 'inline-block', 'verticalAlign': 'top'}),
+                dcc.Dropdown(id=f'''filter_values_{i}''', options=[], multi=True, placeholder='any value',
+                             style={'width': '400px', 'display': 'inline-block', 'marginLeft': '10px'}),
+            ], className='input'),
+        ], style={'height': '50px'}))
+
+    page_data_div = html.Div([
+        html.Table([
+            html.Tr([
+                html.Td('Moving quarter:', className='label'),
+                html.Td(
+                    # The last period is preselected only when already indexed, a page load doesn't read a period
+                    dcc.Dropdown(id='period_select', options=period_options(periods),
+                                 value=period_value(*periods[-1]) if microdata_index.is_indexed(periods[-1]) else None,
+                                 placeholder='moving quarter', clearable=False, style={'width': '250px'}),
+                    className='input',
+                ),
+            ], style={'height': '50px'}),
+            html.Tr([
+                html.Td('Rows:', className='label'),
+                html.Td(
+                    dcc.Dropdown(id='row_column', options=column_options(), value='activ', clearable=False,
+                                 style={'width': '710px'}),
+                    className='input',
+                ),
+            ], style={'height': '50px'}),
+            html.Tr([
+                html.Td('Columns:', className='label'),
+                html.Td(
+                    dcc.Dropdown(id='col_column', options=column_options(), value='sexo', clearable=False,
+                                 style={'width': '710px'}),
+                    className='input',
+                ),
+            ], style={'height': '50px'}),
+        ] + filter_rows + [
+            html.Tr([
+                html.Td('Values:', className='label'),
+                html.Td([
+                    dcc.RadioItems(
+                        id='weighting',
+                        options=[{'label': 'survey respondents', 'value': 0},
+                                 {'label': 'weighted by the expansion factors', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    dcc.RadioItems(
+                        id='percentages',
+                        options=[{'label': 'totals', 'value': 'none'},
+                                 {'label': 'row percentages', 'value': 'row'},
+                                 {'label': 'column percentages', 'value': 'column'}],
+                        value='none',
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                ], className='input'),
+            ], style={'height': '70px'}),
+        ]),
+        html.Div('', id='crosstab_div', style={'margin': '20px'}),
+    ])
+
+    return '', page_data_div
+
+
+def update_filter_values(column, period):
+    if column not in CROSSTAB_COLUMNS or period is None:
+        return []
+    try:
+        index = microdata_index.get(parse_period(period))
+        labels = value_labels(microdata_index.engine, column)
+    except DATABASE_ERRORS as e:
+        e = database_failure(e)
+        logger.warning(f'''No values of {column}, the microdata of {period} can't be read from the database: '''
+                       f'''{e.__class__.__name__}: {e}''')
+        return []
+    return [{'label': f'''{value} - {labels[value]}''' if value in labels else str(value), 'value': int(value)}
+            for value in index.values(column).tolist()]
+
+
+for i in FILTERS:
+    ene_crosstab_app.callback(
+        Output(f'''filter_values_{i}''', 'options'),
+        [Input(f'''filter_column_{i}''', 'value'), Input('period_select', 'value')],
+        []
+    )(update_filter_values)
+
+
+@ene_crosstab_app.callback(
+    [Output('loading_div1', 'children'), Output('crosstab_div', 'children')],
+    [Input('period_select', 'value'), Input('row_column', 'value'), Input('col_column', 'value'),
+     Input('weighting', 'value'), Input('percentages', 'value')] +
+    [Input(f'''filter_values_{i}''', 'value') for i in FILTERS],
+    [State(f'''filter_column_{i}''', 'value') for i in FILTERS]
+)
+def update_crosstab(*args, **kwargs):
+    ctx = callback_context
+    period = ctx.inputs['period_select.value']
+    row_column, col_column = ctx.inputs['row_column.value'], ctx.inputs['col_column.value']
+    if period is None or not row_column or not col_column:
+        raise dash.exceptions.PreventUpdate
+
+    filters = {}
+    for i in FILTERS:
+        column, values = ctx.states[f'''filter_column_{i}.value'''], ctx.inputs[f'''filter_values_{i}.value''']
+        if column and values:
+            # Two filters on the same column select the values in both
+            filters[column] = sorted(set(filters[column]) & set(values)) if column in filters else sorted(values)
+
+    start = time.perf_counter()
+    try:
+        frame, rows = microdata_index.crosstab(parse_period(period), row_column, col_column, filters,
+                                               weighted=bool(ctx.inputs['weighting.value']))
+    except DATABASE_ERRORS as e:
+        e = database_failure(e)
+        logger.warning(f'''The microdata of {period} can't be read from the database: {e.__class__.__name__}: {e}''')
+        return '', html.P(f'''The microdata of {period} can't be read from the database: {e.__class__.__name__}''')
+    except ValueError as e:
+        return '', html.P(str(e))
+    seconds = time.perf_counter() - start
+
+    percentages = ctx.inputs['percentages.value']
+    label = moving_quarter_labels(*parse_period(period))
+    return '', html.Div([
+        html.P(f'''{rows:,} respondents in {label} match the filters {json.dumps(filters) if filters else ''} '''
+               f'''(computed in {seconds * 1000:.0f} ms)'''),
+        generate_crosstab_table(frame, None if percentages == 'none' else percentages),
+    ])
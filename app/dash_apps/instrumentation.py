@@ -0,0 +1,143 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Instrumentation of the Flask servers and the Dash callbacks, and the Prometheus /metrics endpoint.
+# Every request is timed by the route it matched, and every callback of an instrumented Dash app by its
+# function. The callback responses (_dash-update-component) get a Server-Timing header with the stages
+# timed while computing them (analytics/metrics.py), the callback function, and the rest of the request:
+# Dash dispatch, JSON serialization and compression of the response.
+#   instrumentation.instrument(ene_workforce_app)    # before registering the callbacks
+#   instrumentation.init_app(app, 'main')
+#   instrumentation.init_metrics(app, dash_apps)
+
+import functools
+import time
+
+import flask
+
+from analytics import dataset, figure_cache, metrics
+
+
+UPDATE_ROUTE = '/_dash-update-component'
+
+request_seconds = metrics.histogram('ene_request_seconds', 'Latency of the requests by server and route',
+                                    ['server', 'route'])
+callback_seconds = metrics.histogram('ene_callback_seconds', 'Time spent in the function of a Dash callback',
+                                     ['app', 'callback'])
+
+
+def app_name(dash_app):
+    # 'workforce' for the Dash app served under /dash/workforce/
+    return dash_app.config.routes_pathname_prefix.strip('/').split('/')[-1]
+
+
+def timed_callback(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        flask.g.ene_callback = func.__name__
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            callback_seconds.observe(seconds, name, func.__name__)
+            metrics.add_request_time('callback', seconds)
+    return wrapper
+
+
+def instrument(dash_app):
+    # Time the callbacks registered from now on with dash_app.callback, and the requests of its server
+    name = app_name(dash_app)
+    register = dash_app.callback
+
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+        return lambda func: decorator(timed_callback(name, func))
+
+    dash_app.callback = callback
+    init_app(dash_app.server, name)
+
+
+def server_timing(stages, total):
+    # Server-Timing header value, durations in milliseconds
+    callback = stages.pop('callback', 0.0)
+    entries = [f'''{stage};dur={seconds * 1000:.2f}''' for stage, seconds in stages.items()]
+    name = flask.g.get('ene_callback')
+    entries.append(f'''callback;dur={callback * 1000:.2f}''' + (f''';desc="{name}"''' if name else ''))
+    entries.append(f'''dash;dur={(total - callback) * 1000:.2f};desc="dispatch, serialization, compression"''')
+    entries.append(f'''total;dur={total * 1000:.2f}''')
+    return ', '.join(entries)
+
+
+def start_request():
+    flask.g.ene_request_start = time.perf_counter()
+    metrics.start_request()
+
+
+def finish_request(name, response):
+    start = flask.g.pop('ene_request_start', None)
+    stages = metrics.stop_request()
+    if start is None:
+        return response
+    total = time.perf_counter() - start
+    rule = flask.request.url_rule
+    request_seconds.observe(total, name, rule.rule if rule is not None else 'unmatched')
+    if flask.request.path.endswith(UPDATE_ROUTE):
+        response.headers['Server-Timing'] = server_timing(stages, total)
+    return response
+
+
+def init_app(server, name):
+    # Registered before the other response processing, so the request times include it
+    server.before_request(start_request)
+    server.after_request(functools.partial(finish_request, name))
+
+
+def cache_lines():
+    stats = figure_cache.cache.stats()
+    flights = figure_cache.flights.stats()
+    lines = []
+    for name, kind, help, value in [
+        ('ene_figure_cache_entries', 'gauge', 'Figures in the cache', stats['entries']),
+        ('ene_figure_cache_max_entries', 'gauge', 'Size bound of the figure cache', stats['max_entries']),
+        ('ene_figure_cache_hits_total', 'counter', 'Figure cache hits', stats['hits']),
+        ('ene_figure_cache_misses_total', 'counter', 'Figure cache misses', stats['misses']),
+        ('ene_figure_cache_hit_ratio', 'gauge', 'Hits of all the figure cache lookups', stats['hit_rate']),
+        ('ene_figure_cache_evictions_total', 'counter', 'Figures evicted from the cache', stats['evictions']),
+        ('ene_figure_cache_invalidations_total', 'counter', 'Cache invalidations by a new dataset version',
+         stats['invalidations']),
+        ('ene_single_flight_in_flight', 'gauge', 'Figures being computed', flights['in_flight']),
+        ('ene_single_flight_computations_total', 'counter', 'Figure computations started', flights['computations']),
+        ('ene_single_flight_coalesced_total', 'counter', 'Requests that waited for a computation of the same figure',
+         flights['coalesced']),
+        ('ene_single_flight_timeouts_total', 'counter', 'Waits for a computation that timed out', flights['timeouts']),
+    ]:
+        lines += metrics.metric_lines(name, kind, help, [({}, value)])
+    return lines
+
+
+def dataset_lines():
+    ds = dataset.get()
+    lines = metrics.metric_lines('ene_dataset_info', 'gauge', 'Version and source of the loaded dataset',
+                                 [({'version': ds.version, 'source': ds.source}, 1)])
+    for name, help, value in [
+        ('ene_dataset_load_seconds', 'Time to load the dataset', ds.load_seconds or 0.0),
+        ('ene_dataset_memory_bytes', 'Memory of the dataset', ds.memory_bytes),
+        ('ene_process_rss_bytes', 'Resident memory of the process', dataset.process_rss_bytes()),
+    ]:
+        lines += metrics.metric_lines(name, 'gauge', help, [({}, value)])
+    return lines
+
+
+def init_metrics(server, dash_apps=None):
+    # /metrics endpoint of server, with the load times of the Dash apps of the loader dash_apps
+    def dash_app_lines():
+        if dash_apps is None:
+            return []
+        return metrics.metric_lines('ene_dash_app_load_seconds', 'gauge', 'Time to import and warm up a Dash app',
+                                    [({'app': name}, seconds) for name, seconds in dash_apps.load_seconds.items()])
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return flask.Response(metrics.render([cache_lines, dataset_lines, dash_app_lines]),
+                              content_type='text/plain; version=0.0.4; charset=utf-8')
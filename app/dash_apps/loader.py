@@ -0,0 +1,79 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Lazy loading of the Dash apps. Every Dash app runs on its own Flask server, and the requests under
+# /dash/<name>/ are dispatched to it by a WSGI middleware wrapping the main app. The module of a Dash app
+# (with its plotly/pandas imports and callbacks) is imported on the first request of its pages, and the
+# default view of the page is computed right then, so the process starts without any of them.
+#   from dash_apps import loader
+#   app.wsgi_app = loader.LazyDashApps(app.wsgi_app, on_load=responses.init_app)
+
+import importlib
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+# name: module and attribute of the Dash app served under /dash/<name>/
+DASH_APPS = {
+    'workforce': ('dash_apps.workforce', 'ene_workforce_app'),
+    'workforce_by_region': ('dash_apps.workforce_by_region', 'ene_workforce_by_region_app'),
+    'unemployment': ('dash_apps.unemployment', 'ene_unemployment_app'),
+    'unemployment_by_age': ('dash_apps.unemployment_by_age', 'ene_unemployment_app'),
+    'crosstab': ('dash_apps.crosstab', 'ene_crosstab_app'),
+}
+
+PREFIX = '/dash/'
+
+
+class LazyDashApps:
+    def __init__(self, wsgi_app, on_load=None, apps=DASH_APPS):
+        self.wsgi_app = wsgi_app
+        self.on_load = on_load
+        self.apps = apps
+        self.servers = {}
+        self.modules = {}
+        self.load_seconds = {}
+        self._lock = threading.Lock()
+
+    def load(self, name):
+        # Flask server of the Dash app name, imported on the first call
+        server = self.servers.get(name)
+        if server is not None:
+            return server
+        with self._lock:
+            if name not in self.servers:
+                start = time.perf_counter()
+                module_name, attribute = self.apps[name]
+                module = importlib.import_module(module_name)
+                server = getattr(module, attribute).server
+                if self.on_load is not None:
+                    self.on_load(server)
+                if hasattr(module, 'warm_up'):
+                    module.warm_up()
+                self.load_seconds[name] = time.perf_counter() - start
+                logger.info(f'''Loaded Dash app {name} in {self.load_seconds[name]:.2f}s''')
+                self.modules[name] = module
+                self.servers[name] = server
+        return self.servers[name]
+
+    def load_all(self):
+        for name in self.apps:
+            self.load(name)
+
+    def warm_up(self):
+        # Default views of the Dash apps loaded so far, e.g. for a new dataset before it is swapped in
+        for module in list(self.modules.values()):
+            if hasattr(module, 'warm_up'):
+                module.warm_up()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(PREFIX):
+            name = path[len(PREFIX):].split('/', 1)[0]
+            if name in self.apps:
+                # The Dash routes keep their /dash/<name>/ prefix
+                return self.load(name)(environ, start_response)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,47 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Dataset hot reload on the Flask servers. Every request is pinned to the dataset current when it started,
+# so a reload (analytics/reloader.py) swapping the dataset doesn't change it in the middle of a request.
+# /reload shows the reload status (GET) and reloads the dataset (POST). A POST needs the token in
+# ENE_RELOAD_TOKEN, in an X-Reload-Token header or a token field, and is refused when it is not set.
+#   reloading.init_app(server)
+#   reloading.init_reload(app, data_reloader)
+#   curl -X POST -H "X-Reload-Token: $ENE_RELOAD_TOKEN" http://localhost:8080/reload
+
+import hmac
+import os
+
+import flask
+
+from analytics import dataset
+
+
+def pin_dataset():
+    dataset.pin()
+
+
+def unpin_dataset(exception=None):
+    dataset.unpin()
+
+
+def init_app(server):
+    server.before_request(pin_dataset)
+    server.teardown_request(unpin_dataset)
+
+
+def authorized():
+    token = os.environ.get('ENE_RELOAD_TOKEN')
+    given = flask.request.headers.get('X-Reload-Token') or flask.request.values.get('token') or ''
+    return bool(token) and hmac.compare_digest(given.encode(), token.encode())
+
+
+def init_reload(server, reloader):
+    @server.route('/reload', methods=['GET', 'POST'])
+    def reload_endpoint():
+        if flask.request.method == 'GET':
+            return flask.jsonify(reloader.status())
+        if not authorized():
+            return flask.jsonify({'result': 'forbidden'}), 403
+        status = reloader.trigger(force=flask.request.values.get('force') in ('1', 'true'))
+        return flask.jsonify(status), 409 if status['result'] == 'busy' else 200
@@ -0,0 +1,107 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Compressed, revalidated responses of the Flask server. Text responses (Dash layouts, callback results,
+# admin pages) are compressed with brotli when the module is installed and the client accepts it, gzip
+# otherwise. The GET responses get a weak ETag made of the dataset version and a hash of the body, so a client
+# repeating a request with If-None-Match gets a 304 without the body, and a dataset reload changes every ETag.
+# The callback POSTs are only compressed. Bodies with an ETag (the Dash component bundles, the layouts) are
+# compressed once, the last compressed ones are kept by ETag.
+#   from dash_apps import responses
+#   responses.init_app(app)
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import flask
+
+from analytics import dataset
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/css', 'text/plain', 'application/javascript',
+                      'text/javascript'}
+# Smaller bodies fit in a packet anyway
+MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Compressed bodies kept, by path, ETag and encoding
+MAX_COMPRESSED = 128
+
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+def accepted_encoding(accept_encoding):
+    encodings = {part.split(';')[0].strip().lower() for part in (accept_encoding or '').split(',')
+                 if not part.strip().endswith(';q=0')}
+    if brotli is not None and 'br' in encodings:
+        return 'br'
+    if 'gzip' in encodings:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def compressed_body(body, encoding, etag):
+    # body compressed with encoding, from the bodies compressed before when it has an ETag
+    if etag is None:
+        return compress(body, encoding)
+    key = (flask.request.path, etag, encoding)
+    with _compressed_lock:
+        compressed = _compressed.get(key)
+        if compressed is not None:
+            _compressed.move_to_end(key)
+            return compressed
+    compressed = compress(body, encoding)
+    with _compressed_lock:
+        _compressed[key] = compressed
+        while len(_compressed) > MAX_COMPRESSED:
+            _compressed.popitem(last=False)
+    return compressed
+
+
+def response_etag(body):
+    ds = dataset.get()
+    return f'''{ds.version}-{hashlib.sha1(body).hexdigest()[:16]}'''
+
+
+def process_response(response):
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            response.mimetype not in COMPRESSIBLE_TYPES or 'Content-Encoding' in response.headers:
+        return response
+
+    # Revalidation of the GET responses only (layouts, dependencies, pages): the callback POSTs are never
+    # revalidated by the browsers. The responses of the Dash component bundles already have their own ETags.
+    body = response.get_data()
+    response.vary.add('Accept-Encoding')
+    if flask.request.method in ('GET', 'HEAD') and 'ETag' not in response.headers:
+        etag = response_etag(body)
+        response.set_etag(etag, weak=True)
+        response.headers.setdefault('Cache-Control', 'no-cache')
+        if flask.request.if_none_match.contains_weak(etag):
+            response.status_code = 304
+            response.set_data(b'')
+            return response
+
+    encoding = accepted_encoding(flask.request.headers.get('Accept-Encoding'))
+    if encoding is None or len(body) < MIN_SIZE:
+        return response
+    response.set_data(compressed_body(body, encoding, response.headers.get('ETag')))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(server):
+    server.after_request(process_response)
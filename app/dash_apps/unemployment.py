@@ -3,18 +3,17 @@
 #
 # Dash application for unemployment dynamics analysis, split by region, gender, and age
 
-import datetime as dt
+import json
 
 import flask
 import dash
 from dash import Dash, callback_context
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-import plotly.graph_objs as go
-import pandas as pd
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
-from app import app, db
+from analytics import charts, dataset, figure_cache, indicators
+from dash_apps import instrumentation
 
 
 # Functional layout for a Dash app
@@ -32,93 +31,62 @@ def serve_dash_app_layout(*args, **kwargs):
     ])
 
 
-ene_unemployment_app = Dash(__name__, server=app, routes_pathname_prefix='/dash/unemployment/',
-                         external_stylesheets=['/static/css/dash_style.css'])
+ene_unemployment_app = Dash(__name__, server=flask.Flask(__name__),
+                            routes_pathname_prefix='/dash/unemployment/',
+                            external_stylesheets=['/static/css/dash_style.css'],
+                            external_scripts=['/static/js/charts.js'])
 ene_unemployment_app.layout = serve_dash_app_layout
 ene_unemployment_app.config['suppress_callback_exceptions'] = True
+instrumentation.instrument(ene_unemployment_app)
 
 
 # -------------------------------------------------------------------------------------
 # Load page data
 # -------------------------------------------------------------------------------------
 
-def calc_quarter(row):
-    return f'''Q{pd.Timestamp(dt.date(int(row['year']), int(row['month']), 1)).quarter} {int(row['year'])}'''
+@figure_cache.memoize
+def generate_unemployment_chart_data(region_list=[0], age_range=[1, 12], weighted=False, monthly=False):
+    ds = dataset.get()
+    cube = ds.cube
+    counts = cube.counts(region_list, age_range, weighted)
 
-
-def get_quarters():
-    src_data = pd.read_csv('data/csv/agg_by_gender_age_month_region.zip')
-    src_data['quarter'] = src_data.apply(calc_quarter, axis=1)
-    return src_data['quarter'].unique()
-
-
-def get_age_str(min_age, max_age):
-    if min_age == 12:
-        return '70+'
-    elif max_age == 12:
-        return f'''{10 + min_age * 5}-70+'''
-    else:
-        return f'''{10 + min_age * 5}-{15 + max_age * 5}'''
-
-
-def generate_unemployment_chart_figure(region_list=[0], age_range=[1, 12], date_range=None):
-    src_data = pd.read_csv('data/csv/agg_by_gender_age_month_region.zip').reset_index()
-
-    if region_list != [0]:
-        src_data = src_data[src_data.region.isin(region_list)]
-    src_data = src_data[(age_range[0] <= src_data.tramo_edad) & (src_data.tramo_edad <= age_range[1])]
-
-    # Monthly aggregate data
-    month_data = src_data.drop(['region', 'tramo_edad'], axis='columns').groupby(
-        ['year', 'month']).sum().reset_index()
-    month_data['perc_unemployed'] = 1.0 * month_data.unemployed/month_data.is_workforce
-    month_data['perc_unemployed_m'] = 1.0 * month_data.male_unemployed/month_data.male_workforce
-    month_data['perc_unemployed_f'] = 1.0 * month_data.female_unemployed/month_data.female_workforce
-
-    # Quarterly aggregate data
-    month_data['quarter'] = month_data.apply(calc_quarter, axis=1)
-    q_data = month_data.drop(['year', 'month'], axis='columns').groupby('quarter').mean().sort_values(
-        by='index').reset_index()
-
-    if date_range is None:
-        date_range = [0, len(q_data) - 1]
-    temp = q_data.iloc[date_range[0]:date_range[1] + 1]
+    # Quarterly aggregate data: mean of the monthly rates, or the rates of every moving quarter
+    rates = indicators.by_period(cube, counts, ['unemployment_rate', 'unemployment_rate_m', 'unemployment_rate_f'],
+                                 monthly)
 
     # Chart formatting
-    regions = dict(pd.read_csv('data/csv/regions.csv', index_col='id', squeeze=True))
-    region_name = regions[str(region_list).replace(' ', '')]
-    age_str = get_age_str(age_range[0], age_range[1])
-
-    chart_mode = 'lines' if len(temp) > 10 else 'lines+markers'
-    x_range = [-1, len(temp)] if len(temp) > 10 else [-0.1*len(temp), len(temp) - 1 + 0.1*len(temp)]
-    max_unemployment_rate = max(temp.perc_unemployed.max(), temp.perc_unemployed_f.max(), temp.perc_unemployed_m.max())
-    y_range = [-0.02 * max_unemployment_rate, 1.1 * max_unemployment_rate]
-
-    return {
-        'data': [
-            {'x': temp.quarter, 'y': temp.perc_unemployed, 'mode': chart_mode, 'name': 'all population',
-             'line': {'color': 'rgb(153, 0, 102)', 'width': 4}, 'legendgroup': 'group'},
-            {'x': temp.quarter, 'y': temp.perc_unemployed_m, 'mode': chart_mode, 'name': 'men',
-             'line': {'color': 'rgb(0, 153, 153)', 'width': 3}, 'legendgroup': 'group1'},
-            {'x': temp.quarter, 'y': temp.perc_unemployed_f, 'mode': chart_mode, 'name': 'women',
-             'line': {'color': 'rgb(255, 153, 0)', 'width': 3}, 'legendgroup': 'group2'},
-            {'x': temp.quarter, 'y': [temp.perc_unemployed.mean()] * len(temp), 'mode': 'lines',
-             'line': {'color': 'rgba(153, 153, 153, 0.5)', 'width': 2, 'dash': 'dot'},
-             'name': 'average', 'legendgroup': 'group3'},
-            {'x': temp.quarter, 'y': [temp.perc_unemployed_m.mean()] * len(temp), 'mode': 'lines',
-             'line': {'color': 'rgba(153, 153, 153, 0.5)', 'width': 2, 'dash': 'dot'},
-             'name': 'average', 'legendgroup': 'group3', 'showlegend': False},
-            {'x': temp.quarter, 'y': [temp.perc_unemployed_f.mean()] * len(temp), 'mode': 'lines',
-             'line': {'color': 'rgba(153, 153, 153, 0.5)', 'width': 2, 'dash': 'dot'},
-             'name': 'average', 'legendgroup': 'group3', 'showlegend': False},
+    region_name = ds.region_name(region_list)
+    age_str = charts.get_age_str(age_range[0], age_range[1])
+    weighted_str = ', weighted' if weighted else ''
+    monthly_str = ', moving quarters' if monthly else ''
+
+    return charts.quarterly_chart_data(
+        ds.quarters,
+        f'''Unemployment rate, age: {age_str} ({region_name}{weighted_str}{monthly_str})''',
+        [
+            {'y': rates['unemployment_rate'], 'average': True,
+             'margin': ds.confidence_margin('unemployment_rate', region_list, age_range, weighted, monthly),
+             'style': {'name': 'all population', 'legendgroup': 'group',
+                       'line': {'color': 'rgb(153, 0, 102)', 'width': 4}}},
+            {'y': rates['unemployment_rate_m'], 'average': True,
+             'margin': ds.confidence_margin('unemployment_rate_m', region_list, age_range, weighted, monthly),
+             'style': {'name': 'men', 'legendgroup': 'group1',
+                       'line': {'color': 'rgb(0, 153, 153)', 'width': 3}}},
+            {'y': rates['unemployment_rate_f'], 'average': True,
+             'margin': ds.confidence_margin('unemployment_rate_f', region_list, age_range, weighted, monthly),
+             'style': {'name': 'women', 'legendgroup': 'group2',
+                       'line': {'color': 'rgb(255, 153, 0)', 'width': 3}}},
         ],
-        'layout': {'title': {'text': f'''Unemployment rate, age: {age_str} ({region_name})'''},
-                   'xaxis': {'showgrid': False, 'range': x_range},
-                   'yaxis': {'tickformat': ',.0%', 'range': y_range},
-                   'legend': {'x': 1.01, 'y': 0.5, 'orientation': 'v'},
-                   'margin': {'t': 80}
-                   }
-    }
+        months=ds.moving_quarters if monthly else None,
+        month_quarters=ds.month_quarters if monthly else None,
+    )
+
+
+@figure_cache.memoize
+def generate_unemployment_chart_figure(region_list=[0], age_range=[1, 12], date_range=None, weighted=False,
+                                       monthly=False):
+    return charts.build_quarterly_figure(generate_unemployment_chart_data(region_list, age_range, weighted, monthly),
+                                         date_range)
 
 
 @ene_unemployment_app.callback(
@@ -132,10 +100,13 @@ def display_page(*args, **kwargs):
         raise dash.exceptions.PreventUpdate
 
     # Unemployment rate, dynamics
-    regions = dict(pd.read_csv('data/csv/regions.csv', index_col='id', squeeze=True))
-    quarters = get_quarters()
+    ds = dataset.get()
+    regions = ds.regions
+    quarters = ds.quarters
 
     page_data_div = html.Div([
+        # Quarterly series of the selection, drawn and sliced to the time period in the browser
+        dcc.Store(id='chart_data', data=generate_unemployment_chart_data()),
         html.Table([
             html.Tr([
                 html.Td(
@@ -149,7 +120,6 @@ def display_page(*args, **kwargs):
                 html.Td(
                     dcc.Graph(
                         id='unemployment_dynamics',
-                        figure=generate_unemployment_chart_figure(),
                         style={'width': '800px', 'height': '430px'}
                     ),
                     style={'width': '800px'}
@@ -178,7 +148,7 @@ def display_page(*args, **kwargs):
                             max=12,
                             step=1,
                             value=[1, 12],
-                            marks={i: get_age_str(i, i) for i in range(1, 13)},
+                            marks={i: charts.get_age_str(i, i) for i in range(1, 13)},
                         ),
                         style={'width': '600px', 'height': '60px', 'marginLeft': '10px'}
                     ),
@@ -207,6 +177,38 @@ def display_page(*args, **kwargs):
                 ],
                 style={'height': '60px'}
             ),
+            # Calendar quarters, or the moving quarter centred on every month
+            html.Tr([
+                html.Td('Periods:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='period_mode',
+                        options=[{'label': 'calendar quarters', 'value': 0},
+                                 {'label': 'moving quarters (monthly)', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'}
+            ),
+            # Expansion factor weighting, offered only when the aggregate has the weighted totals
+            html.Tr([
+                html.Td('Estimates:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='weighting',
+                        options=[{'label': 'survey respondents', 'value': 0},
+                                 {'label': 'weighted by the expansion factors', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'} if ds.has_weights else {'display': 'none'}
+            ),
         ]),
     ],
     )
@@ -215,9 +217,11 @@ def display_page(*args, **kwargs):
 
 
 @ene_unemployment_app.callback(
-    [Output('loading_div1', 'children'), Output('unemployment_dynamics', 'figure')],
-    [Input('region_select', 'value'), Input('age_range', 'value'), Input('unemployment_date_range', 'value')],
-    [State('region_select', 'value'), State('age_range', 'value'), State('unemployment_date_range', 'value')]
+    [Output('loading_div1', 'children'), Output('chart_data', 'data')],
+    [Input('region_select', 'value'), Input('age_range', 'value'), Input('weighting', 'value'),
+     Input('period_mode', 'value')],
+    [State('region_select', 'value'), State('age_range', 'value'), State('weighting', 'value'),
+     State('period_mode', 'value')]
 
 )
 def update_unemployment_chart(*args, **kwargs):
@@ -225,8 +229,22 @@ def update_unemployment_chart(*args, **kwargs):
     if len(ctx.triggered) != 1:
         raise dash.exceptions.PreventUpdate
 
-    regions = eval(ctx.states['region_select.value'])
+    regions = json.loads(ctx.states['region_select.value'])
     ages = ctx.states['age_range.value']
-    date_range = ctx.inputs['unemployment_date_range.value']
+    weighted = bool(ctx.states['weighting.value']) and dataset.get().has_weights
+    monthly = bool(ctx.states['period_mode.value'])
+
+    return '', generate_unemployment_chart_data(regions, ages, weighted, monthly)
+
+
+# Moving the time period slider only re-slices the series in the store, with no server request
+ene_unemployment_app.clientside_callback(
+    ClientsideFunction(namespace='charts', function_name='quarterly_figure'),
+    Output('unemployment_dynamics', 'figure'),
+    [Input('chart_data', 'data'), Input('unemployment_date_range', 'value')]
+)
+
 
-    return '', generate_unemployment_chart_figure(regions, ages, date_range)
+def warm_up():
+    # Default view of the page, computed when the app is loaded
+    generate_unemployment_chart_figure()
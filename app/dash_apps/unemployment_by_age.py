@@ -3,18 +3,17 @@
 #
 # Dash application to compare unemployment by age groups: 1 - clusters with dynamics, 2 - box charts for all age ranges
 
-import datetime as dt
+import json
 
 import flask
 import dash
 from dash import Dash, callback_context
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-import plotly.graph_objs as go
-import pandas as pd
+from dash.dependencies import ClientsideFunction, Input, Output
 
-from app import app, db
+from analytics import bucketing, charts, dataset, figure_cache
+from dash_apps import instrumentation
 
 
 # Functional layout for a Dash app
@@ -32,86 +31,60 @@ def serve_dash_app_layout(*args, **kwargs):
     ])
 
 
-ene_unemployment_app = Dash(__name__, server=app, routes_pathname_prefix='/dash/unemployment_by_age/',
-                         external_stylesheets=['/static/css/dash_style.css'])
+ene_unemployment_app = Dash(__name__, server=flask.Flask(__name__),
+                            routes_pathname_prefix='/dash/unemployment_by_age/',
+                            external_stylesheets=['/static/css/dash_style.css'],
+                            external_scripts=['/static/js/charts.js'])
 ene_unemployment_app.layout = serve_dash_app_layout
 ene_unemployment_app.config['suppress_callback_exceptions'] = True
+instrumentation.instrument(ene_unemployment_app)
 
 
 # -------------------------------------------------------------------------------------
 # Load page data
 # -------------------------------------------------------------------------------------
 
-def calc_quarter(row):
-    return f'''Q{pd.Timestamp(dt.date(int(row['year']), int(row['month']), 1)).quarter} {int(row['year'])}'''
+# Unemployment rate indicator of every gender
+UNEMPLOYMENT_RATES = {0: 'unemployment_rate', 1: 'unemployment_rate_m', 2: 'unemployment_rate_f'}
 
 
-def get_quarters():
-    src_data = pd.read_csv('data/csv/agg_by_gender_age_month_region.zip')
-    src_data['quarter'] = src_data.apply(calc_quarter, axis=1)
-    return src_data['quarter'].unique()
+@figure_cache.memoize
+def generate_unemployment_by_age_rates(region_list=[0], weighted=False, monthly=False):
+    # Quarterly aggregate data: mean of the monthly rates for every age group and gender,
+    # or the rates of every moving quarter
+    ds = dataset.get()
+    return bucketing.bucket_rates(ds.cube, region_list, ds.age_buckets, list(UNEMPLOYMENT_RATES.values()), weighted,
+                                  monthly)
 
 
-def get_age_str(min_age, max_age):
-    if min_age == 12:
-        return '70+'
-    elif max_age == 12:
-        return f'''{10 + min_age * 5}-70+'''
-    else:
-        return f'''{10 + min_age * 5}-{15 + max_age * 5}'''
-
-
-def generate_unemployment_by_age_chart_figure(region_list=[0], gender=0, date_range=None):
-    src_data = pd.read_csv('data/csv/agg_by_gender_age_month_region.zip').reset_index()
-    age_ranges = dict(pd.read_csv('data/csv/age_ranges.csv', index_col='range', squeeze=True))
-
-    if region_list != [0]:
-        src_data = src_data[src_data.region.isin(region_list)]
-
-    # Monthly aggregate data
-    month_data = pd.DataFrame()
-    for range, label in age_ranges.items():
-        temp = src_data[src_data.tramo_edad.isin(eval(range))].drop(['region', 'tramo_edad'], axis='columns').groupby(
-            ['year', 'month']).sum()
-        if gender == 0:
-            month_data[label] = 1.0 * (temp.male_unemployed + temp.female_unemployed)/temp.is_workforce
-        elif gender == 1:
-            month_data[label] = 1.0 * temp.male_unemployed/temp.male_workforce
-        else:
-            month_data[label] = 1.0 * temp.female_unemployed/temp.female_workforce
-    month_data = month_data.reset_index()
-
-    # Quarterly aggregate data
-    month_data['quarter'] = month_data.apply(calc_quarter, axis=1)
-    q_data = month_data.reset_index().drop(['year', 'month'], axis='columns').groupby('quarter').mean().sort_values(
-        by='index').reset_index()
-
-    if date_range is None:
-        date_range = [0, len(q_data) - 1]
-    temp = q_data.iloc[date_range[0]:date_range[1] + 1]
+@figure_cache.memoize
+def generate_unemployment_by_age_chart_data(region_list=[0], gender=0, weighted=False, monthly=False):
+    ds = dataset.get()
+    rates = generate_unemployment_by_age_rates(region_list, weighted, monthly)[UNEMPLOYMENT_RATES[gender]]
+    series = [{'y': rates[label].to_numpy(), 'style': {'name': label, 'line': {'width': 3}},
+               'margin': ds.confidence_margin(UNEMPLOYMENT_RATES[gender], region_list, json.loads(ages), weighted,
+                                              monthly)}
+              for ages, label in ds.age_ranges.items()]
 
     # Chart formatting
-    regions = dict(pd.read_csv('data/csv/regions.csv', index_col='id', squeeze=True))
-    region_name = regions[str(region_list).replace(' ', '')]
+    region_name = ds.region_name(region_list)
     gender_str = {0: 'all population', 1: 'men', 2: 'women'}[gender]
+    weighted_str = ', weighted' if weighted else ''
+    monthly_str = ', moving quarters' if monthly else ''
+
+    return charts.quarterly_chart_data(ds.quarters,
+                                       f'''Unemployment rate for {gender_str}, {region_name}{weighted_str}{monthly_str}''',
+                                       series,
+                                       months=ds.moving_quarters if monthly else None,
+                                       month_quarters=ds.month_quarters if monthly else None)
 
-    chart_mode = 'lines' if len(temp) > 10 else 'lines+markers'
-    x_range = [-1, len(temp)] if len(temp) > 10 else [-0.1*len(temp), len(temp) - 1 + 0.1*len(temp)]
-    max_unemployment_rate = max([temp[label].max() for label in age_ranges.values()])
-    y_range = [-0.02 * max_unemployment_rate, 1.1 * max_unemployment_rate]
-
-    return {
-        'data': [
-            {'x': temp.quarter, 'y': temp[label], 'mode': chart_mode, 'name': label,
-             'line': {'width': 3}} for label in age_ranges.values()
-        ],
-        'layout': {'title': {'text': f'''Unemployment rate for {gender_str}, {region_name}'''},
-                   'xaxis': {'showgrid': False, 'range': x_range},
-                   'yaxis': {'tickformat': ',.0%', 'range': y_range},
-                   'legend': {'x': 1.01, 'y': 0.5, 'orientation': 'v'},
-                   'margin': {'t': 80}
-                   }
-    }
+
+@figure_cache.memoize
+def generate_unemployment_by_age_chart_figure(region_list=[0], gender=0, date_range=None, weighted=False,
+                                              monthly=False):
+    return charts.build_quarterly_figure(generate_unemployment_by_age_chart_data(region_list, gender, weighted,
+                                                                                 monthly),
+                                         date_range)
 
 
 @ene_unemployment_app.callback(
@@ -125,10 +98,13 @@ def display_page(*args, **kwargs):
         raise dash.exceptions.PreventUpdate
 
     # Unemployment rate, dynamics
-    regions = dict(pd.read_csv('data/csv/regions.csv', index_col='id', squeeze=True))
-    quarters = get_quarters()
+    ds = dataset.get()
+    regions = ds.regions
+    quarters = ds.quarters
 
     page_data_div = html.Div([
+        # Quarterly series of the selection, drawn and sliced to the time period in the browser
+        dcc.Store(id='chart_data', data=generate_unemployment_by_age_chart_data()),
         html.Table([
             html.Tr([
                 html.Td(
@@ -143,7 +119,6 @@ def display_page(*args, **kwargs):
                 html.Td(
                     dcc.Graph(
                         id='unemployment_dynamics',
-                        figure=generate_unemployment_by_age_chart_figure(),
                         style={'width': '800px', 'height': '430px'},
                         ),
                     style={'width': '800px'}
@@ -203,6 +178,38 @@ def display_page(*args, **kwargs):
                 ],
                 style={'height': '60px'}
             ),
+            # Calendar quarters, or the moving quarter centred on every month
+            html.Tr([
+                html.Td('Periods:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='period_mode',
+                        options=[{'label': 'calendar quarters', 'value': 0},
+                                 {'label': 'moving quarters (monthly)', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'}
+            ),
+            # Expansion factor weighting, offered only when the aggregate has the weighted totals
+            html.Tr([
+                html.Td('Estimates:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='weighting',
+                        options=[{'label': 'survey respondents', 'value': 0},
+                                 {'label': 'weighted by the expansion factors', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'} if ds.has_weights else {'display': 'none'}
+            ),
         ]),
     ],
     )
@@ -211,8 +218,9 @@ def display_page(*args, **kwargs):
 
 
 @ene_unemployment_app.callback(
-    [Output('loading_div1', 'children'), Output('unemployment_dynamics', 'figure')],
-    [Input('region_select', 'value'), Input('gender_select', 'value'), Input('unemployment_date_range', 'value')]
+    [Output('loading_div1', 'children'), Output('chart_data', 'data')],
+    [Input('region_select', 'value'), Input('gender_select', 'value'), Input('weighting', 'value'),
+     Input('period_mode', 'value')]
 
 )
 def update_unemployment_chart(*args, **kwargs):
@@ -220,8 +228,22 @@ def update_unemployment_chart(*args, **kwargs):
     if len(ctx.triggered) != 1:
         raise dash.exceptions.PreventUpdate
 
-    regions = eval(ctx.inputs['region_select.value'])
+    regions = json.loads(ctx.inputs['region_select.value'])
     gender = ctx.inputs['gender_select.value']
-    date_range = ctx.inputs['unemployment_date_range.value']
+    weighted = bool(ctx.inputs['weighting.value']) and dataset.get().has_weights
+    monthly = bool(ctx.inputs['period_mode.value'])
+
+    return '', generate_unemployment_by_age_chart_data(regions, gender, weighted, monthly)
+
+
+# Moving the time period slider only re-slices the series in the store, with no server request
+ene_unemployment_app.clientside_callback(
+    ClientsideFunction(namespace='charts', function_name='quarterly_figure'),
+    Output('unemployment_dynamics', 'figure'),
+    [Input('chart_data', 'data'), Input('unemployment_date_range', 'value')]
+)
+
 
-    return '', generate_unemployment_by_age_chart_figure(regions, gender, date_range)
+def warm_up():
+    # Default view of the page, computed when the app is loaded
+    generate_unemployment_by_age_chart_figure()
@@ -0,0 +1,253 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Dash application comparing workforce participation and unemployment across all regions, as a grid of
+# small charts. The series of all regions come from one reduction over the region axis of the cube, and the
+# grid is assembled in the browser from the periods and the values of every panel.
+
+import json
+
+import flask
+import dash
+from dash import Dash, callback_context
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import ClientsideFunction, Input, Output
+import numpy as np
+
+from analytics import charts, dataset, figure_cache, indicators
+from dash_apps import instrumentation
+
+
+# Functional layout for a Dash app
+def serve_dash_app_layout(*args, **kwargs):
+    return html.Div([
+        dcc.Location(id='url', refresh=False),
+        html.H1('Regional Comparison',
+                style={'textAlign': 'center'}),
+
+        dcc.Loading(id="loading", type='circle', fullscreen=True, style={'opacity': 0.5},
+                    children=[html.Div('', id='loading_div'), html.Div('', id='loading_div1')]),
+        html.Div('', id='page_data'),
+    ])
+
+
+ene_workforce_by_region_app = Dash(__name__, server=flask.Flask(__name__),
+                                   routes_pathname_prefix='/dash/workforce_by_region/',
+                                   external_stylesheets=['/static/css/dash_style.css'],
+                                   external_scripts=['/static/js/charts.js'])
+ene_workforce_by_region_app.layout = serve_dash_app_layout
+ene_workforce_by_region_app.config['suppress_callback_exceptions'] = True
+instrumentation.instrument(ene_workforce_by_region_app)
+
+
+# -------------------------------------------------------------------------------------
+# Load page data
+# -------------------------------------------------------------------------------------
+
+INDICATOR_NAMES = {'participation_rate': 'Workforce participation', 'unemployment_rate': 'Unemployment rate'}
+
+GENDER_STYLES = [
+    {'name': 'all population', 'line': {'color': 'rgb(153, 0, 102)', 'width': 2}},
+    {'name': 'men', 'line': {'color': 'rgb(0, 153, 153)', 'width': 1.5}},
+    {'name': 'women', 'line': {'color': 'rgb(255, 153, 0)', 'width': 1.5}},
+]
+
+
+def region_order(ds):
+    # Regions from north to south, in the order of the zones of regions.csv, then any other region
+    order = []
+    for key in ds.regions:
+        region_list = json.loads(key)
+        if len(region_list) > 1:
+            order += [r for r in region_list if r not in order]
+    return order + [int(r) for r in ds.cube.region_ids if r not in order]
+
+
+@figure_cache.memoize
+def generate_region_rates(name='unemployment_rate', age_range=[1, 12], by_age=False, weighted=False, monthly=False):
+    # Values [period, region, series] of indicator name for every region: by gender for the ages of
+    # age_range, or for every age group of age_ranges.csv with by_age (age_range is then unused, None)
+    ds = dataset.get()
+    cube = ds.cube
+    if by_age:
+        counts = ds.age_buckets.reduce(cube.region_age_counts(weighted), axis=2)
+        return indicators.by_period(cube, counts, [name], monthly)[name]
+    names = [name, f'''{name}_m''', f'''{name}_f''']
+    rates = indicators.by_period(cube, cube.region_counts(age_range, weighted), names, monthly)
+    return np.stack([rates[n] for n in names], axis=-1)
+
+
+@figure_cache.memoize
+def generate_region_grid_data(name='unemployment_rate', age_range=[1, 12], by_age=False, weighted=False,
+                              monthly=False):
+    ds = dataset.get()
+    # The series by age group are the same for every age range, they are cached once
+    rates = generate_region_rates(name, None if by_age else age_range, by_age, weighted, monthly)
+    order = region_order(ds)
+    rates = rates[:, np.array(order) - 1]
+
+    if by_age:
+        styles = [{'name': label, 'line': {'width': 1.5}} for label in ds.age_ranges.values()]
+        age_str = 'by age group'
+    else:
+        styles = GENDER_STYLES
+        age_str = f'''age: {charts.get_age_str(age_range[0], age_range[1])}'''
+    weighted_str = ', weighted' if weighted else ''
+    monthly_str = ', moving quarters' if monthly else ''
+
+    return charts.grid_chart_data(
+        ds.moving_quarters if monthly else ds.quarters,
+        f'''{INDICATOR_NAMES[name]}, {age_str}{weighted_str}{monthly_str}''',
+        [ds.region_names.get((r,), str(r)).strip() for r in order],
+        [{'y': rates[..., i], 'style': style} for i, style in enumerate(styles)],
+        y_range=[-0.02, 1.005] if name == 'participation_rate' else None,
+    )
+
+
+@figure_cache.memoize
+def generate_region_grid_figure(name='unemployment_rate', age_range=[1, 12], by_age=False, weighted=False,
+                                monthly=False):
+    return charts.build_grid_figure(generate_region_grid_data(name, None if by_age else age_range, by_age, weighted,
+                                                              monthly))
+
+
+@ene_workforce_by_region_app.callback(
+    [Output('loading_div', 'children'), Output('page_data', 'children')],
+    [Input('url', 'pathname')],
+    []
+)
+def display_page(*args, **kwargs):
+    ctx = callback_context
+    if ctx.inputs['url.pathname'] is None:
+        raise dash.exceptions.PreventUpdate
+
+    ds = dataset.get()
+
+    page_data_div = html.Div([
+        html.Table([
+            html.Tr([
+                html.Td('Indicator:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='indicator_select',
+                        options=[{'label': label, 'value': key} for key, label in INDICATOR_NAMES.items()],
+                        value='unemployment_rate',
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'}
+            ),
+            html.Tr([
+                html.Td('Age range:', className='label'),
+                html.Td(
+                    html.Div(
+                        dcc.RangeSlider(
+                            id='age_range',
+                            min=1,
+                            max=12,
+                            step=1,
+                            value=[1, 12],
+                            marks={i: charts.get_age_str(i, i) for i in range(1, 13)},
+                        ),
+                        style={'width': '600px', 'height': '60px', 'marginLeft': '10px'}
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '60px'}
+            ),
+            html.Tr([
+                html.Td('Series:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='series_select',
+                        options=[{'label': 'by gender, for the age range', 'value': 0},
+                                 {'label': 'by age group', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'}
+            ),
+            # Calendar quarters, or the moving quarter centred on every month
+            html.Tr([
+                html.Td('Periods:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='period_mode',
+                        options=[{'label': 'calendar quarters', 'value': 0},
+                                 {'label': 'moving quarters (monthly)', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'}
+            ),
+            # Expansion factor weighting, offered only when the aggregate has the weighted totals
+            html.Tr([
+                html.Td('Estimates:', className='label'),
+                html.Td(
+                    dcc.RadioItems(
+                        id='weighting',
+                        options=[{'label': 'survey respondents', 'value': 0},
+                                 {'label': 'weighted by the expansion factors', 'value': 1}],
+                        value=0,
+                        labelStyle={'display': 'inline-block', 'marginRight': '20px'},
+                    ),
+                    className='input',
+                ),
+                ],
+                style={'height': '40px'} if ds.has_weights else {'display': 'none'}
+            ),
+        ]),
+        # Periods and values of all panels, assembled into the grid in the browser
+        dcc.Store(id='grid_data', data=generate_region_grid_data()),
+        dcc.Graph(
+            id='region_grid',
+            style={'width': '1100px', 'height': '900px'}
+        ),
+    ],
+    )
+
+    return '', page_data_div
+
+
+@ene_workforce_by_region_app.callback(
+    [Output('loading_div1', 'children'), Output('grid_data', 'data')],
+    [Input('indicator_select', 'value'), Input('age_range', 'value'), Input('series_select', 'value'),
+     Input('period_mode', 'value'), Input('weighting', 'value')]
+)
+def update_region_grid(*args, **kwargs):
+    ctx = callback_context
+    if len(ctx.triggered) != 1:
+        raise dash.exceptions.PreventUpdate
+
+    name = ctx.inputs['indicator_select.value']
+    ages = ctx.inputs['age_range.value']
+    by_age = bool(ctx.inputs['series_select.value'])
+    # The age range slider doesn't change the series by age group
+    ages = None if by_age else ages
+    monthly = bool(ctx.inputs['period_mode.value'])
+    weighted = bool(ctx.inputs['weighting.value']) and dataset.get().has_weights
+
+    return '', generate_region_grid_data(name, ages, by_age, weighted, monthly)
+
+
+# The periods are sent once for all the panels, the traces get them in the browser
+ene_workforce_by_region_app.clientside_callback(
+    ClientsideFunction(namespace='charts', function_name='grid_figure'),
+    Output('region_grid', 'figure'),
+    [Input('grid_data', 'data')]
+)
+
+
+def warm_up():
+    # Default view of the page, computed when the app is loaded
+    generate_region_grid_data()
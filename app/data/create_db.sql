@@ -331,7 +331,8 @@ create table ene (
 	foreign key (ocup_form) references ene_ocup_form(id) on delete set null,
 	-- foreign key (b11_proxy) references ene_yes_no(id) on delete set null,
 	foreign key (activ) references ene_activ(id) on delete set null
-)
-
-
+);
 
+-- Monthly aggregates by region, age range and sex (analytics/sql_aggregates.py), weighted or not, are computed
+-- from this index only
+create index ene_period_region_age on ene (ano_trimestre, mes_central, region, tramo_edad, sexo, activ, fact_cal, fact);
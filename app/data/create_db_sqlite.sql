@@ -225,4 +225,8 @@ create table ene (
     p_ocupada tinyint(1), -- 0/1
     publico tinyint(1), -- 0/1
     privado tinyint(1) -- 0/1
-)
+);
+
+-- Monthly aggregates by region, age range and sex (analytics/sql_aggregates.py), weighted or not, are computed
+-- from this index only
+create index ene_period_region_age on ene (ano_trimestre, mes_central, region, tramo_edad, sexo, activ, fact_cal, fact);
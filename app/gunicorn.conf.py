@@ -0,0 +1,46 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Gunicorn configuration for production serving:
+#   cd app && gunicorn -c gunicorn.conf.py main:app
+#
+# The app is imported once in the master process (preload_app), which loads the dataset and, with the eager
+# startup set here by default (ENE_STARTUP), imports the Dash apps and warms their figure caches. Workers are
+# then forked from the master and share that memory copy-on-write. The number of workers is set with
+# WEB_CONCURRENCY, and the threads of every worker with GUNICORN_THREADS. Per-worker memory can be checked with:
+#   cd app && python -m tools.worker_memory gunicorn.pid
+
+import gc
+import multiprocessing
+import os
+
+
+os.environ.setdefault('ENE_STARTUP', 'eager')
+
+bind = f'''0.0.0.0:{os.environ.get('PORT', '8080')}'''
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+pidfile = os.environ.get('GUNICORN_PIDFILE', 'gunicorn.pid')
+timeout = 60
+graceful_timeout = 30
+max_requests = 0
+
+
+def when_ready(server):
+    # Everything allocated while preloading the app is moved out of the garbage collector's reach, so the
+    # collections in the workers don't touch (and copy) the pages shared with the master
+    gc.collect()
+    gc.freeze()
+    server.log.info(f'''Preloaded app, forking {server.num_workers} workers''')
+
+
+def post_fork(server, worker):
+    # Connections of the DB pool can't be shared between processes, every worker opens its own. The engine is
+    # only created on the first DB use, so there is usually nothing to dispose of.
+    from app import db
+    db.dispose()
+
+    # Threads are not inherited from the master: every worker watches the dataset files for hot reloads
+    import main
+    main.data_reloader.start()
@@ -9,8 +9,9 @@ import os
 from flask import Flask, render_template
 from flask_admin import Admin, AdminIndexView, BaseView, expose
 
-from app import app, db
-from dash_apps import workforce, unemployment, unemployment_by_age
+from app import app
+from analytics import dataset, reloader
+from dash_apps import instrumentation, loader, reloading, responses
 
 
 logger = logging.getLogger()
@@ -46,17 +47,61 @@ class EneAboutView(BaseView):
 
 ene_admin = Admin(app, name='ENE Analytics', index_view=EneIndexView(url='/'))
 
+# Request timings, registered first so they include the response processing
+instrumentation.init_app(app, 'main')
+
+
+def init_server(server):
+    # Requests pinned to the dataset they started with, and compressed responses, revalidated with ETags from
+    # the dataset version
+    reloading.init_app(server)
+    responses.init_app(server)
+
+
+init_server(app)
+
+# The Dash apps under /dash/ are imported on the first request of their pages, with the same request processing
+dash_apps = loader.LazyDashApps(app.wsgi_app, on_load=init_server)
+app.wsgi_app = dash_apps
+
+# Hot reload of the dataset: file watcher (started in every worker) and /reload
+data_reloader = reloader.DatasetReloader(warm_up=dash_apps.warm_up)
+reloading.init_reload(app, data_reloader)
+
+# Prometheus metrics of the process: stage and callback timings, cache hit rates, dataset and Dash app loads
+instrumentation.init_metrics(app, dash_apps)
+
 ene_admin.add_sub_category(name="Workforce", parent_name="")
 ene_admin.add_view(EneIframeApp(name='Workforce Participation', category='Workforce',
                                 url='/workforce', endpoint='workforce'))
+ene_admin.add_view(EneIframeApp(name='Regional Comparison', category='Workforce',
+                                url='/workforce_by_region', endpoint='workforce_by_region'))
 
 ene_admin.add_sub_category(name="Unemployment", parent_name="")
 ene_admin.add_view(EneIframeApp(name='Unemployment Rate', category='Unemployment',
                                 url='/unemployment', endpoint='unemployment'))
 ene_admin.add_view(EneIframeApp(name='Unemployment By Age', category='Unemployment',
                                 url='/unemployment_by_age', endpoint='unemployment_by_age'))
+
+ene_admin.add_sub_category(name="Microdata", parent_name="")
+ene_admin.add_view(EneIframeApp(name='Crosstabs', category='Microdata',
+                                url='/crosstab', endpoint='crosstab'))
 # ene_admin.add_view(EneAboutView(name='About', url='/about', endpoint='about'))
 
 
+def warm_up():
+    # Load the shared ENE dataset (from the binary snapshot when it is current) before the first request is
+    # served. With ENE_STARTUP=eager every Dash app is also loaded and the default view of every page computed:
+    # under gunicorn this runs in the master, and the forked workers inherit it. With the default lazy startup
+    # a Dash app is loaded by the first request of its pages.
+    dataset.load()
+    if os.environ.get('ENE_STARTUP', 'lazy') == 'eager':
+        dash_apps.load_all()
+
+
+warm_up()
+
+
 if __name__ == "__main__":
+    data_reloader.start()
     app.run(host="127.0.0.1", port=8080, debug=True)
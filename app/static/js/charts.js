@@ -0,0 +1,154 @@
+// ENE Analytics app
+// Copyright 2020 Olga Marchevska
+//
+// Clientside callbacks of the Dash apps. quarterly_figure builds a chart for the selected time period
+// from the quarterly series kept in a dcc.Store, so moving the time period slider needs no server request.
+// It mirrors build_quarterly_figure() in analytics/charts.py. Monthly series keep the quarterly time period
+// slider, the months shown are those of the selected quarters.
+// grid_figure builds the small multiples of the regional comparison from the periods, sent once, and the values
+// of every panel. It mirrors build_grid_figure() in analytics/charts.py.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    charts: {
+        quarterly_figure: function (chart_data, date_range) {
+            if (!chart_data) {
+                return window.dash_clientside.no_update;
+            }
+            var quarters = chart_data.quarters;
+            if (!date_range) {
+                date_range = [0, quarters.length - 1];
+            }
+            var first = date_range[0], last = date_range[1] + 1;
+            var periods = quarters;
+            if (chart_data.months) {
+                // First month of a quarter at or after position, as bisect_left in Python
+                var first_month = function (position) {
+                    var i = 0;
+                    while (i < chart_data.month_quarters.length && chart_data.month_quarters[i] < position) {
+                        i += 1;
+                    }
+                    return i;
+                };
+                periods = chart_data.months;
+                first = first_month(first);
+                last = first_month(last);
+            }
+            var x = periods.slice(first, last);
+            var n = x.length;
+
+            var chart_mode = n > 10 ? 'lines' : 'lines+markers';
+            var x_range = n > 10 ? [-1, n] : [-0.1 * n, n - 1 + 0.1 * n];
+
+            var bands = [], traces = [], averages = [], max_value = null;
+            chart_data.series.forEach(function (series) {
+                var y = series.y.slice(first, last);
+                traces.push(Object.assign({x: x, y: y, mode: chart_mode}, series.style));
+
+                if (series.band) {
+                    var margin = series.band.margin.slice(first, last);
+                    var bound = function (sign) {
+                        return y.map(function (value, i) {
+                            return value === null || margin[i] === null ? null : value + sign * margin[i];
+                        });
+                    };
+                    var band_style = Object.assign({}, chart_data.band_style);
+                    if (series.style.legendgroup !== undefined) {
+                        band_style.legendgroup = series.style.legendgroup;
+                    }
+                    var upper = bound(1);
+                    bands.push(Object.assign({x: x, y: bound(-1)}, band_style));
+                    bands.push(Object.assign({x: x, y: upper, fill: 'tonexty', fillcolor: series.band.fillcolor},
+                                             band_style));
+                    upper.forEach(function (value) {
+                        if (value !== null) {
+                            max_value = max_value === null ? value : Math.max(max_value, value);
+                        }
+                    });
+                }
+
+                var sum = 0, count = 0;
+                y.forEach(function (value) {
+                    if (value !== null) {
+                        sum += value;
+                        count += 1;
+                        max_value = max_value === null ? value : Math.max(max_value, value);
+                    }
+                });
+                if (series.average) {
+                    var mean = count ? sum / count : null;
+                    // A line from the first to the last period
+                    var ends = n ? [x[0], x[n - 1]] : [];
+                    var average = Object.assign({x: ends, y: ends.map(function () { return mean; }), mode: 'lines'},
+                                                chart_data.average_style);
+                    if (averages.length) {
+                        average.showlegend = false;
+                    }
+                    averages.push(average);
+                }
+            });
+
+            var y_range = chart_data.y_range;
+            if (!y_range) {
+                max_value = max_value === null ? 0 : max_value;
+                y_range = [-0.02 * max_value, 1.1 * max_value];
+            }
+
+            return {
+                data: bands.concat(traces, averages),
+                layout: Object.assign({
+                    title: {text: chart_data.title},
+                    xaxis: {showgrid: false, range: x_range},
+                    yaxis: {tickformat: ',.0%', range: y_range}
+                }, chart_data.layout)
+            };
+        },
+
+        grid_figure: function (chart_data) {
+            if (!chart_data) {
+                return window.dash_clientside.no_update;
+            }
+            var x = chart_data.periods;
+            var cols = chart_data.cols;
+            var n_panels = chart_data.panel_titles.length;
+            var rows = Math.floor((n_panels + cols - 1) / cols);
+            var gap = 0.02;
+            var data = [], annotations = [];
+            var layout = {
+                title: {text: chart_data.title},
+                showlegend: true,
+                legend: {orientation: 'h', x: 0.5, xanchor: 'center', y: -0.05},
+                margin: {t: 80, l: 50, r: 20, b: 40}
+            };
+
+            chart_data.panel_titles.forEach(function (panel_title, panel) {
+                var row = Math.floor(panel / cols), col = panel % cols;
+                var suffix = panel === 0 ? '' : String(panel + 1);
+                var x_domain = [col / cols + gap, (col + 1) / cols - gap];
+                var y_domain = [1 - (row + 1) / rows + 2 * gap, 1 - row / rows - 2 * gap];
+                layout['xaxis' + suffix] = {domain: x_domain, anchor: 'y' + suffix, showgrid: false, nticks: 3,
+                                            tickangle: 0, showticklabels: row === rows - 1};
+                layout['yaxis' + suffix] = {domain: y_domain, anchor: 'x' + suffix, tickformat: ',.0%',
+                                            showticklabels: col === 0};
+                if (panel) {
+                    layout['xaxis' + suffix].matches = 'x';
+                    layout['yaxis' + suffix].matches = 'y';
+                }
+                annotations.push({text: panel_title, x: (x_domain[0] + x_domain[1]) / 2, y: y_domain[1],
+                                  xref: 'paper', yref: 'paper', xanchor: 'center', yanchor: 'bottom',
+                                  showarrow: false});
+
+                chart_data.series.forEach(function (series, i) {
+                    data.push(Object.assign({x: x, y: series.y[panel], mode: 'lines', xaxis: 'x' + suffix,
+                                             yaxis: 'y' + suffix, legendgroup: 'series' + i,
+                                             showlegend: panel === 0}, series.style));
+                });
+            });
+
+            if (n_panels) {
+                layout.yaxis.range = chart_data.y_range;
+            }
+            layout.annotations = annotations;
+            return {data: data, layout: layout};
+        }
+    }
+});
@@ -0,0 +1,321 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Benchmarks of the chart computations, run locally on the dataset files, without database or network:
+#   figures    the generate_*_figure functions over a matrix of region, age, gender, period and time period
+#              parameters, computed from scratch (cold, figure cache cleared) and from the cache (warm)
+#   callbacks  round trips of the chart callbacks through the Flask test client, at
+#              /dash/<app>/_dash-update-component
+#   pages      first page cost: the Dash layout and the display_page callback of every page
+# The time period slider is a clientside callback, so it is covered by the date_range of the figures.
+# With --scale, the suite also runs on synthetic aggregates with that many times the rows of the current one,
+# made of copies of it shifted back in time (longer series). The results are stored as JSON, and --compare
+# prints the changes against the results of another run.
+#   cd app && python -m tools.benchmark [--scale 1 10 100] [--repeat 5] [--output results.json]
+#   cd app && python -m tools.benchmark --compare benchmarks/before.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from analytics import dataset, figure_cache
+
+
+REGION_KEYS = ['[0]', '[5,13,6,7,8,16]', '[13]']
+AGE_RANGES = [[1, 12], [3, 6], [5, 5]]
+GENDERS = [0, 1, 2]
+INDICATORS = ['unemployment_rate', 'participation_rate']
+
+# Dash apps of the chart callbacks, and the inputs of their callbacks in the order of the callback
+CHART_CALLBACKS = {
+    'workforce': ['region_select', 'age_range', 'weighting', 'period_mode'],
+    'unemployment': ['region_select', 'age_range', 'weighting', 'period_mode'],
+    'unemployment_by_age': ['region_select', 'gender_select', 'weighting', 'period_mode'],
+}
+
+app_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+RESULTS_DIR = os.path.join(app_path, 'benchmarks')
+
+
+# -------------------------------------------------------------------------------------
+# Synthetic datasets
+# -------------------------------------------------------------------------------------
+
+def scaled_dataset(ds, scale):
+    # Dataset with scale times the rows of ds: copies of its aggregate shifted back by whole spans of its years
+    if scale == 1:
+        return ds
+    agg = ds.agg
+    years = agg['year'].to_numpy(dtype=np.int64)
+    span = int(years.max() - years.min() + 1)
+    copies = []
+    for i in range(scale):
+        copy = agg.copy()
+        copy['year'] = years - i * span
+        copies.append(copy)
+    scaled = pd.concat(copies[::-1], ignore_index=True)
+    synthetic = dataset.EneDataset(scaled, dict(ds.regions), dict(ds.age_ranges), f'''{ds.version}-x{scale}''',
+                                   source='synthetic')
+    synthetic.standard_errors = ds.standard_errors
+    return synthetic
+
+
+# -------------------------------------------------------------------------------------
+# Timing
+# -------------------------------------------------------------------------------------
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def summary(group, name, params, seconds, scale):
+    ms = [s * 1000 for s in seconds]
+    return {
+        'group': group,
+        'name': name,
+        'params': params,
+        'scale': scale,
+        'n': len(ms),
+        'mean_ms': statistics.mean(ms),
+        'p50_ms': percentile(ms, 50),
+        'p95_ms': percentile(ms, 95),
+        'min_ms': min(ms),
+    }
+
+
+def time_calls(func, repeat, cold):
+    seconds = []
+    for _ in range(repeat):
+        if cold:
+            figure_cache.cache.clear()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def date_ranges(ds):
+    last = len(ds.quarters) - 1
+    return [None, [0, min(7, last)], [max(last - 7, 0), last]]
+
+
+def figure_cases(ds):
+    # (function name, function, params) of the figure matrix
+    from dash_apps import unemployment, unemployment_by_age, workforce, workforce_by_region
+
+    weightings = [False, True] if ds.has_weights else [False]
+    cases = []
+    for key in REGION_KEYS:
+        regions = json.loads(key)
+        for weighted in weightings:
+            for monthly in [False, True]:
+                for date_range in date_ranges(ds):
+                    for ages in AGE_RANGES:
+                        params = {'region_list': regions, 'age_range': ages, 'date_range': date_range,
+                                  'weighted': weighted, 'monthly': monthly}
+                        cases.append(('generate_workforce_chart_figure', workforce.generate_workforce_chart_figure,
+                                      params))
+                        cases.append(('generate_unemployment_chart_figure',
+                                      unemployment.generate_unemployment_chart_figure, params))
+                    for gender in GENDERS:
+                        params = {'region_list': regions, 'gender': gender, 'date_range': date_range,
+                                  'weighted': weighted, 'monthly': monthly}
+                        cases.append(('generate_unemployment_by_age_chart_figure',
+                                      unemployment_by_age.generate_unemployment_by_age_chart_figure, params))
+    for name in INDICATORS:
+        for by_age in [False, True]:
+            for monthly in [False, True]:
+                params = {'name': name, 'by_age': by_age, 'monthly': monthly}
+                cases.append(('generate_region_grid_figure', workforce_by_region.generate_region_grid_figure, params))
+    return cases
+
+
+def run_figures(ds, repeat, scale):
+    results = []
+    for name, func, params in figure_cases(ds):
+        for cold in [True, False]:
+            func(**params)
+            seconds = time_calls(lambda: func(**params), repeat, cold)
+            results.append(summary('figures_cold' if cold else 'figures_warm', name, params, seconds, scale))
+    return results
+
+
+def callback_body(app_name, values):
+    # _dash-update-component request of the chart callback of app_name, with the input values
+    outputs = [{'id': 'loading_div1', 'property': 'children'}, {'id': 'chart_data', 'property': 'data'}]
+    inputs = [{'id': component, 'property': 'value', 'value': value}
+              for component, value in zip(CHART_CALLBACKS[app_name], values)]
+    body = {
+        'output': '..loading_div1.children...chart_data.data..',
+        'outputs': outputs,
+        'inputs': inputs,
+        'changedPropIds': [f'''{CHART_CALLBACKS[app_name][0]}.value'''],
+    }
+    if app_name != 'unemployment_by_age':
+        body['state'] = inputs
+    return body
+
+
+def page_body(app_name):
+    return {
+        'output': '..loading_div.children...page_data.children..',
+        'outputs': [{'id': 'loading_div', 'property': 'children'}, {'id': 'page_data', 'property': 'children'}],
+        'inputs': [{'id': 'url', 'property': 'pathname', 'value': f'''/dash/{app_name}/'''}],
+        'changedPropIds': ['url.pathname'],
+    }
+
+
+def post(client, path, body):
+    response = client.post(path, json=body)
+    if response.status_code != 200:
+        raise RuntimeError(f'''{path} returned {response.status_code}''')
+    return response
+
+
+def run_callbacks(ds, client, repeat, scale):
+    results = []
+    weightings = [0, 1] if ds.has_weights else [0]
+    for app_name in CHART_CALLBACKS:
+        path = f'''/dash/{app_name}/_dash-update-component'''
+        second_values = GENDERS if app_name == 'unemployment_by_age' else AGE_RANGES
+        for key in REGION_KEYS:
+            for second in second_values:
+                for weighting in weightings:
+                    for period_mode in [0, 1]:
+                        body = callback_body(app_name, [key, second, weighting, period_mode])
+                        params = dict(zip(CHART_CALLBACKS[app_name], [key, second, weighting, period_mode]))
+                        for cold in [True, False]:
+                            post(client, path, body)
+                            seconds = time_calls(lambda: post(client, path, body), repeat, cold)
+                            results.append(summary('callbacks_cold' if cold else 'callbacks_warm', app_name, params,
+                                                   seconds, scale))
+    return results
+
+
+def run_pages(client, repeat, scale):
+    results = []
+    for app_name in list(CHART_CALLBACKS) + ['workforce_by_region']:
+        layout = f'''/dash/{app_name}/_dash-layout'''
+        client.get(layout)
+        results.append(summary('pages', f'''{app_name} layout''', {},
+                               time_calls(lambda: client.get(layout), repeat, False), scale))
+        path, body = f'''/dash/{app_name}/_dash-update-component''', page_body(app_name)
+        post(client, path, body)
+        results.append(summary('pages', f'''{app_name} display_page''', {},
+                               time_calls(lambda: post(client, path, body), repeat, True), scale))
+    return results
+
+
+# -------------------------------------------------------------------------------------
+# Reports
+# -------------------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=app_path).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def result_key(result):
+    return (result['group'], result['name'], result['scale'], json.dumps(result['params'], sort_keys=True))
+
+
+def print_summary(results):
+    # Mean of the p50 times of every group and name over its parameter matrix
+    groups = {}
+    for result in results:
+        groups.setdefault((result['scale'], result['group'], result['name']), []).append(result['p50_ms'])
+    print(f'''{'scale':>6} {'group':>15} {'name':>44} {'cases':>6} {'p50 ms':>9} {'max p50 ms':>11}''')
+    for (scale, group, name), p50 in groups.items():
+        print(f'''{scale:>6} {group:>15} {name:>44} {len(p50):>6} {statistics.mean(p50):9.3f} {max(p50):11.3f}''')
+
+
+def print_comparison(results, baseline):
+    # Ratio of the p50 times to those of the baseline run, by group and name, and the cases changed by 25%+
+    old = {result_key(result): result for result in baseline['results']}
+    ratios, changed = {}, []
+    for result in results:
+        before = old.get(result_key(result))
+        if before is None or not before['p50_ms']:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms']
+        ratios.setdefault((result['scale'], result['group'], result['name']), []).append(ratio)
+        if abs(ratio - 1) >= 0.25:
+            changed.append((ratio, result))
+
+    print(f'''\nCompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('timestamp')}), '''
+          f'''p50 now / before (geometric mean over the cases):''')
+    for (scale, group, name), values in ratios.items():
+        print(f'''{scale:>6} {group:>15} {name:>44} {float(np.exp(np.mean(np.log(values)))):7.2f}x''')
+    for ratio, result in sorted(changed, key=lambda item: -abs(np.log(item[0])))[:20]:
+        print(f'''  {ratio:5.2f}x {result['group']} {result['name']} {json.dumps(result['params'])}''')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of the ENE chart computations')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1],
+                        help='row count multipliers of the synthetic aggregates, 1 for the current one')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls of every case')
+    parser.add_argument('--groups', nargs='+', default=['figures', 'callbacks', 'pages'],
+                        choices=['figures', 'callbacks', 'pages'])
+    parser.add_argument('--output', default=None, help='JSON results file, by default in benchmarks/')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv[1:])
+
+    import main as app_main
+
+    client = app_main.app.test_client()
+    base = dataset.get()
+    results, datasets = [], []
+    try:
+        for scale in args.scale:
+            ds = dataset.replace(scaled_dataset(base, scale))
+            datasets.append({'scale': scale, 'version': ds.version, 'rows': len(ds.agg), 'quarters': len(ds.quarters)})
+            print(f'''Scale {scale}: {len(ds.agg)} rows, {len(ds.quarters)} quarters''', file=sys.stderr)
+            if 'figures' in args.groups:
+                results += run_figures(ds, args.repeat, scale)
+            if 'callbacks' in args.groups:
+                results += run_callbacks(ds, client, args.repeat, scale)
+            if 'pages' in args.groups:
+                results += run_pages(client, args.repeat, scale)
+    finally:
+        dataset.replace(base)
+
+    meta = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'datasets': datasets,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'''{meta['timestamp'].replace(':', '')}-{meta['commit'] or 'local'}.json''')
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+    print_summary(results)
+    print(f'''\nResults stored in {output}''')
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,228 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Load test of a running server with simulated dashboard users. Every user repeats sessions: it opens one of
+# the chart pages (/workforce, /unemployment, /unemployment_by_age) like a browser does (admin page, Dash
+# page, layout, dependencies, display_page and the first chart callback), then changes the region, age range
+# or gender selections a few times, with exponential think times in between. The time period slider is a
+# clientside callback without server request, its moves are part of the think times.
+# The number of concurrent users rises step by step, and every step reports the throughput, the p50/p95/p99
+# latencies and the error rate per endpoint. A kept-alive connection closed by the server during a think time
+# (gunicorn keeps them 2s) is reopened and the request sent again, only the errors left are counted.
+# The knee is the step with the best throughput per p95 latency, past it more users mostly add latency.
+#   make serve
+#   cd app && python -m tools.loadtest http://localhost:8080 --users 1 2 4 8 16 32 --duration 30
+
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from tools.benchmark import AGE_RANGES, CHART_CALLBACKS, GENDERS, REGION_KEYS, callback_body, page_body
+
+
+PAGES = list(CHART_CALLBACKS)
+# Selections changed by a user of every page, after opening it
+INTERACTIONS = {
+    'workforce': ['region_select', 'age_range'],
+    'unemployment': ['region_select', 'age_range'],
+    'unemployment_by_age': ['region_select', 'gender_select'],
+}
+DEFAULT_VALUES = {'region_select': '[0]', 'age_range': [1, 12], 'gender_select': 0, 'weighting': 0, 'period_mode': 0}
+OPTIONS = {'region_select': REGION_KEYS, 'age_range': AGE_RANGES, 'gender_select': GENDERS}
+
+
+class User:
+    # One simulated user with its own keep-alive connection, recording (endpoint, seconds, error) of every request
+    def __init__(self, url, think, interactions, timeout, seed):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        self.think = think
+        self.interactions = interactions
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.connection = None
+        self.records = []
+
+    def request(self, endpoint, method, path, body=None):
+        headers = {'Accept-Encoding': 'gzip'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        start = time.perf_counter()
+        error = None
+        try:
+            try:
+                reused = self.connection is not None
+                response = self.send(method, path, body, headers)
+            except (OSError, http.client.HTTPException):
+                if not reused:
+                    raise
+                # Stale keep-alive connection, once more on a new one
+                self.close()
+                start = time.perf_counter()
+                response = self.send(method, path, body, headers)
+            if response.status >= 400:
+                error = str(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            error = e.__class__.__name__
+            self.close()
+        self.records.append((endpoint, time.perf_counter() - start, error))
+
+    def send(self, method, path, body, headers):
+        if self.connection is None:
+            self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+
+    def pause(self, deadline):
+        if self.think > 0:
+            time.sleep(max(0.0, min(self.random.expovariate(1 / self.think), deadline - time.time())))
+
+    def session(self, deadline):
+        page = self.random.choice(PAGES)
+        dash_path = f'''/dash/{page}/'''
+        self.request(f'''{page} page''', 'GET', f'''/{page}/''')
+        self.request(f'''{page} dash page''', 'GET', dash_path)
+        self.request(f'''{page} layout''', 'GET', f'''{dash_path}_dash-layout''')
+        self.request(f'''{page} dependencies''', 'GET', f'''{dash_path}_dash-dependencies''')
+        update_path = f'''{dash_path}_dash-update-component'''
+        self.request(f'''{page} display_page''', 'POST', update_path, page_body(page))
+
+        values = dict(DEFAULT_VALUES)
+        self.request(f'''{page} chart''', 'POST', update_path,
+                     callback_body(page, [values[component] for component in CHART_CALLBACKS[page]]))
+        for _ in range(self.interactions):
+            self.pause(deadline)
+            if time.time() >= deadline:
+                return
+            component = self.random.choice(INTERACTIONS[page])
+            values[component] = self.random.choice(OPTIONS[component])
+            self.request(f'''{page} {component}''', 'POST', update_path,
+                         callback_body(page, [values[c] for c in CHART_CALLBACKS[page]]))
+        self.pause(deadline)
+
+    def run(self, deadline):
+        while time.time() < deadline:
+            self.session(deadline)
+        self.close()
+
+
+def run_step(args, users, seed):
+    deadline = time.time() + args.duration
+    simulated = [User(args.url, args.think, args.interactions, args.timeout, seed + i) for i in range(users)]
+    threads = [threading.Thread(target=user.run, args=(deadline,), daemon=True) for user in simulated]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return [record for user in simulated for record in user.records], elapsed
+
+
+def endpoint_stats(records, elapsed):
+    seconds = np.array([s for _, s, _ in records]) * 1000
+    errors = sum(1 for _, _, error in records if error is not None)
+    return {
+        'requests': len(records),
+        'throughput': len(records) / elapsed if elapsed else 0.0,
+        'p50_ms': float(np.percentile(seconds, 50)) if len(seconds) else None,
+        'p95_ms': float(np.percentile(seconds, 95)) if len(seconds) else None,
+        'p99_ms': float(np.percentile(seconds, 99)) if len(seconds) else None,
+        'error_rate': errors / len(records) if records else 0.0,
+    }
+
+
+def step_report(users, records, elapsed):
+    endpoints = {}
+    for record in records:
+        endpoints.setdefault(record[0], []).append(record)
+    return {
+        'users': users,
+        'seconds': elapsed,
+        'total': endpoint_stats(records, elapsed),
+        'endpoints': {endpoint: endpoint_stats(endpoint_records, elapsed)
+                      for endpoint, endpoint_records in sorted(endpoints.items())},
+        'errors': sorted({error for _, _, error in records if error is not None}),
+    }
+
+
+def format_stats(name, stats):
+    def ms(value):
+        return f'''{value:9.1f}''' if value is not None else f'''{'-':>9}'''
+    return f'''{name:>36} {stats['requests']:>9} {stats['throughput']:9.1f} {ms(stats['p50_ms'])} ''' \
+        f'''{ms(stats['p95_ms'])} {ms(stats['p99_ms'])} {stats['error_rate'] * 100:7.2f}%'''
+
+
+def print_step(report, totals_only):
+    print(f'''\n{report['users']} users, {report['seconds']:.1f}s''' +
+          (f''', errors: {', '.join(report['errors'])}''' if report['errors'] else ''))
+    print(f'''{'endpoint':>36} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}''')
+    if not totals_only:
+        for endpoint, stats in report['endpoints'].items():
+            print(format_stats(endpoint, stats))
+    print(format_stats('all', report['total']))
+
+
+def knee(reports):
+    # Step with the best throughput per p95 latency (the "power" of the server)
+    powered = [(r['total']['throughput'] / r['total']['p95_ms'], r['users']) for r in reports if r['total']['p95_ms']]
+    return max(powered)[1] if powered else None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load test of a running ENE Analytics server')
+    parser.add_argument('url', nargs='?', default='http://localhost:8080', help='base URL of the server')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='concurrent users of every step')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of every step')
+    parser.add_argument('--think', type=float, default=1.0, help='mean think time between actions, seconds')
+    parser.add_argument('--interactions', type=int, default=5, help='selection changes of every session')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout, seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of one user before the steps, not reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--totals-only', action='store_true', help='report the totals only, not every endpoint')
+    parser.add_argument('--output', default=None, help='JSON file for the reports of all the steps')
+    args = parser.parse_args(argv[1:])
+
+    if args.warmup > 0:
+        User(args.url, args.think, args.interactions, args.timeout, args.seed).run(time.time() + args.warmup)
+
+    reports = []
+    for i, users in enumerate(args.users):
+        records, elapsed = run_step(args, users, args.seed + 1000 * (i + 1))
+        reports.append(step_report(users, records, elapsed))
+        print_step(reports[-1], args.totals_only)
+
+    print(f'''\n{'users':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}''')
+    for report in reports:
+        total = report['total']
+        print(f'''{report['users']:>6} {total['throughput']:9.1f} {total['p50_ms'] or 0:9.1f} '''
+              f'''{total['p95_ms'] or 0:9.1f} {total['p99_ms'] or 0:9.1f} {total['error_rate'] * 100:7.2f}%''')
+    print(f'''Knee of the curve: {knee(reports)} users''')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'url': args.url, 'think': args.think, 'interactions': args.interactions, 'steps': reports},
+                      f, indent=1)
+    return 1 if any(report['total']['error_rate'] > 0 for report in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
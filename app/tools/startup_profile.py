@@ -0,0 +1,117 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Cold start profile of the app: imports main in a fresh interpreter with -X importtime, and breaks the
+# startup time down by imported package and module and the dataset load. With --dash, the first load of
+# every Dash app is timed in another fresh interpreter, so its imports stay out of the breakdown of main.
+# With --budget the command fails when the startup of main takes longer, so a cold start can be held to it.
+#   cd app && python -m tools.startup_profile [--top 20] [--dash] [--budget 1.5]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Run in the child interpreter: times the import of main, then the first load of every Dash app
+PROFILE_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+result = {'startup_seconds': time.perf_counter() - start}
+from analytics import dataset
+ds = dataset.get()
+result['dataset'] = {'source': ds.source, 'version': ds.version, 'load_seconds': ds.load_seconds}
+result['dash_seconds'] = {}
+if '--dash' in sys.argv:
+    for name in main.dash_apps.apps:
+        start = time.perf_counter()
+        main.dash_apps.load(name)
+        result['dash_seconds'][name] = time.perf_counter() - start
+print(json.dumps(result))
+'''
+
+
+def parse_importtime(stderr):
+    # [(module, self seconds, cumulative seconds, nesting level)] from the -X importtime lines
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, level))
+    return imports
+
+
+def package_times(imports):
+    # Self time of all the modules of every top-level package, slowest first
+    packages = {}
+    for name, self_seconds, _, _ in imports:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_seconds
+    return sorted(packages.items(), key=lambda item: -item[1])
+
+
+def run_script(options, arguments, env=None):
+    command = [sys.executable] + options + ['-c', PROFILE_SCRIPT] + arguments
+    process = subprocess.run(command, capture_output=True, text=True, env=dict(os.environ, **(env or {})),
+                             cwd=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    if process.returncode != 0:
+        raise RuntimeError(f'''Importing main failed:\n{process.stderr[-2000:]}''')
+    return json.loads(process.stdout.strip().splitlines()[-1]), process.stderr
+
+
+def run_profile(env=None):
+    # Startup of main with its imports
+    result, stderr = run_script(['-X', 'importtime'], [], env)
+    return result, parse_importtime(stderr)
+
+
+def run_dash_profile(env=None):
+    # First load of every Dash app, in an interpreter without -X importtime
+    result, _ = run_script([], ['--dash'], env)
+    return result['dash_seconds']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Cold start profile of the ENE Analytics app')
+    parser.add_argument('--top', type=int, default=20, help='number of packages and modules listed')
+    parser.add_argument('--dash', action='store_true', help='also time the first load of every Dash app')
+    parser.add_argument('--startup', choices=['lazy', 'eager'], default='lazy',
+                        help='ENE_STARTUP mode of the profiled startup')
+    parser.add_argument('--budget', type=float, default=None, help='fail if the startup takes longer (seconds)')
+    args = parser.parse_args(argv[1:])
+
+    env = {'ENE_STARTUP': args.startup}
+    result, imports = run_profile(env)
+    dash_seconds = run_dash_profile(env) if args.dash else {}
+    import_seconds = sum(self_seconds for _, self_seconds, _, _ in imports)
+
+    print(f'''Imports by package ({len(imports)} modules, {import_seconds:.3f}s):''')
+    print(f'''{'package':>32} {'self ms':>9}''')
+    for package, seconds in package_times(imports)[:args.top]:
+        print(f'''{package:>32} {seconds * 1000:9.1f}''')
+
+    print('\nSlowest modules (cumulative, top-level imports of their package):')
+    print(f'''{'module':>48} {'self ms':>9} {'cumulative ms':>14}''')
+    top_level = [i for i in imports if '.' not in i[0] or i[3] == 0]
+    for name, self_seconds, cumulative, _ in sorted(top_level, key=lambda i: -i[2])[:args.top]:
+        print(f'''{name:>48} {self_seconds * 1000:9.1f} {cumulative * 1000:14.1f}''')
+
+    ds = result['dataset']
+    print(f'''\nDataset {ds['version']} loaded from {ds['source']} in {ds['load_seconds'] * 1000:.1f} ms''')
+    for name, seconds in dash_seconds.items():
+        print(f'''Dash app {name} loaded in {seconds * 1000:.1f} ms''')
+    startup = result['startup_seconds']
+    print(f'''Startup of main ({args.startup}): {startup:.3f}s''')
+
+    if args.budget is not None and startup > args.budget:
+        print(f'''Startup exceeds the budget of {args.budget:.3f}s''')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+# ENE Analytics app
+# Copyright 2020 Olga Marchevska
+#
+# Memory used by the master and the worker processes of a running gunicorn server (Linux only).
+# RSS counts the pages shared copy-on-write with the master in every process, PSS splits them between
+# the processes sharing them, so the sum of PSS is the real memory used by the server.
+#   cd app && python -m tools.worker_memory gunicorn.pid
+
+import os
+import sys
+
+
+def read_pid(pidfile):
+    with open(pidfile) as f:
+        return int(f.read().strip())
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'''/proc/{entry}/stat''') as f:
+                    # The process name may contain spaces, the parent pid is the second field after it
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    return sorted(children)
+
+
+def memory_kb(pid):
+    # {'Rss': ..., 'Pss': ..., 'Shared_Clean': ...} in kB, from /proc/<pid>/smaps_rollup
+    memory = {}
+    with open(f'''/proc/{pid}/smaps_rollup''') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                memory[parts[0].rstrip(':')] = int(parts[1])
+    return memory
+
+
+def main(argv):
+    if len(argv) < 2:
+        print('Usage: python -m tools.worker_memory <gunicorn pidfile or master pid>')
+        return 2
+    master = int(argv[1]) if argv[1].isdigit() else read_pid(argv[1])
+
+    print(f'''{'process':>16} {'RSS MiB':>9} {'PSS MiB':>9} {'shared MiB':>11} {'private MiB':>12}''')
+    total_rss = total_pss = 0
+    for name, pid in [('master', master)] + [(f'''worker {pid}''', pid) for pid in child_pids(master)]:
+        memory = memory_kb(pid)
+        shared = memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0)
+        private = memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)
+        total_rss += memory.get('Rss', 0)
+        total_pss += memory.get('Pss', 0)
+        print(f'''{name:>16} {memory.get('Rss', 0) / 1024:9.1f} {memory.get('Pss', 0) / 1024:9.1f} '''
+              f'''{shared / 1024:11.1f} {private / 1024:12.1f}''')
+    print(f'''{'total':>16} {total_rss / 1024:9.1f} {total_pss / 1024:9.1f}''')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))